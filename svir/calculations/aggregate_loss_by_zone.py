@@ -21,15 +21,47 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
-import time
+
+import hashlib
+import os
+import threading
+import numpy
 import processing
+from collections import namedtuple, OrderedDict
 from functools import partial
 
 from qgis.core import (
-    QgsApplication, QgsProcessingFeedback, QgsProcessingContext,
-    QgsProcessingAlgRunnerTask,
+    QgsApplication, QgsCoordinateTransform, QgsFeature, QgsFeatureRequest,
+    QgsField, QgsFields, QgsGeometry, QgsMemoryProviderUtils, QgsPoint,
+    QgsProject, QgsRectangle, QgsSpatialIndex, QgsVectorLayer,
+    QgsVectorLayerFeatureSource, QgsWkbTypes, NULL,
     )
 
+from svir.utilities.shared import DOUBLE_FIELD_TYPE, INT_FIELD_TYPE
+
+# geometric predicates that can be used to match points to zones, each
+# checking the zone against the point (e.g. 'contains' means that the zone
+# contains the point)
+PREDICATES = ('intersects', 'contains', 'isEqual', 'touches', 'overlaps',
+              'within', 'crosses')
+SUMMARIES = ('count', 'sum', 'mean', 'min', 'max', 'range')
+
+# maximum number of site->zone mappings kept in memory
+ZONE_ASSIGNMENT_CACHE_SIZE = 8
+
+# what is needed to read the features of a layer from a background thread
+LayerSnapshot = namedtuple(
+    'LayerSnapshot', 'source fields crs wkb_type name')
+
+
+def snapshot_layer(layer):
+    """
+    Get a snapshot of a vector layer, whose features can be safely read from
+    a background thread (it has to be created in the main thread)
+    """
+    return LayerSnapshot(QgsVectorLayerFeatureSource(layer), layer.fields(),
+                         layer.crs(), layer.wkbType(), layer.name())
+
 
 def add_zone_id_to_points(points_layer, zonal_layer, zone_field_name):
     params = {'DISCARD_NONMATCHING': False,
@@ -52,19 +84,15 @@ def calculate_zonal_stats(callback, zonal_layer, points_layer, join_fields,
                           output_layer_name, discard_nonmatching=False,
                           predicates=('intersects',), summaries=('sum',)):
     """
-    Leveraging the QGIS processing algorithm 'Join attributes by location
-    (summary)', that is described in QGIS as follows:
-    This algorithm takes an input vector layer and creates a new vector layer
-    that is an extended version of the input one, with additional attributes in
-    its attribute table. The additional attributes and their values are taken
-    from a second vector layer. A spatial criteria is applied to select the
-    values from the second layer that are added to each feature from the first
-    layer in the resulting one. The algorithm calculates a statistical summary
-    for the values from matching features in the second layer (e.g. maximum
-    value, mean value, etc).
-    The full description of the algorithm can be obtained as follows:
-    processing.algorithmHelp('qgis:joinbylocationsummary') and it includes
-    the lists of predicates and summaries.
+    Create a copy of the zonal layer, adding for each zone a statistical
+    summary of the values of the points matching it (e.g. the sum of the
+    losses of the assets inside each zone), similarly to the QGIS processing
+    algorithm 'Join attributes by location (summary)'.
+
+    Points are read in a single pass and they are matched to zones by means
+    of a spatial index of the zones and of prepared zone geometries. Then
+    summaries are calculated with numpy group-bys. The work is done by a
+    background task, that calls the callback when it is complete.
 
     :param callback: function to be called once the aggregation is complete,
         passing the output zonal layer as a parameter
@@ -72,65 +100,475 @@ def calculate_zonal_stats(callback, zonal_layer, points_layer, join_fields,
     :param points_layer: vector layer containing points (or its path)
     :param join_fields: fields for which we want to calculate statistics
         (e.g. structural)
-    :param output_layer_name: a memory layer will be produced, named
-        'memory:output_layer_name'
+    :param output_layer_name: name of the memory layer that will be produced
     :param discard_nonmatching: discard records which could not be joined
         (in our case, purge zones that contain no loss/damage points)
-    :param predicates: geometric predicates (default: 'intersects')
+    :param predicates: geometric predicates (default: 'intersects'), chosen
+        among PREDICATES. A point matches a zone if any of them is satisfied
     :param summaries: statistics to be calculated for each join field
-        (default: 'sum')
-
-    :returns: it waits until the task is complete or terminated, then it
-        calls the callback function, passing the output QgsVectorLayer as
-        parameter, or None in case of failure
-    """
-
-    processing.Processing.initialize()
-    alg = QgsApplication.processingRegistry().algorithmById(
-        'qgis:joinbylocationsummary')
-    if alg is None:
-        raise ImportError('Unable to retrieve processing algorithm'
-                          ' qgis:joinbylocationsummary')
-    # NOTE: predicates are no more retrieavable in the c++ version of the
-    # algorithm, so we can't make sure to use the actual lists of predicates
-    # and summaries as defined in the algorithm when it is instantiated
-    predicate_keys = ['intersects', 'contains', 'isEqual', 'touches',
-                      'overlaps', 'within', 'crosses']
-    PREDICATES = dict(zip(predicate_keys, range(len(predicate_keys))))
-    summary_keys = [
-        'count', 'unique', 'min', 'max', 'range', 'sum', 'mean', 'median',
-        'stddev', 'minority', 'majority', 'q1', 'q3', 'iqr', 'empty', 'filled',
-        'min_length', 'max_length', 'mean_length']
-    SUMMARIES = dict(zip(summary_keys, range(len(summary_keys))))
-
-    context = QgsProcessingContext()
-    feedback = QgsProcessingFeedback()
-
-    params = {
-        'DISCARD_NONMATCHING': discard_nonmatching,
-        'INPUT': zonal_layer,
-        'JOIN': points_layer,
-        'PREDICATE': [PREDICATES[predicate] for predicate in predicates],
-        'JOIN_FIELDS': join_fields,
-        'SUMMARIES': [SUMMARIES[summary] for summary in summaries],
-        'OUTPUT': 'memory:%s' % output_layer_name
-        }
-
-    task = QgsProcessingAlgRunnerTask(alg, params, context, feedback)
-    task.executed.connect(partial(task_finished, context, callback))
+        (default: 'sum'), chosen among SUMMARIES
+
+    :returns: the task performing the aggregation. When the task is complete
+        or terminated, the callback function is called, passing the output
+        QgsVectorLayer as parameter, or None in case of failure
+    """
+    # NOTE: avoiding a circular import
+    from svir.tasks.aggregate_by_zone_task import AggregateByZoneTask
+
+    if isinstance(zonal_layer, str):
+        # NOTE: a new layer is opened at each call, so the zones matching
+        #       each site are cached by file instead of by layer
+        zones_key = get_zone_assignment_cache().file_key(zonal_layer)
+        zonal_layer = QgsVectorLayer(zonal_layer, 'zonal_layer', 'ogr')
+    else:
+        zones_key = get_zone_assignment_cache().layer_key(zonal_layer)
+    if isinstance(points_layer, str):
+        points_layer = QgsVectorLayer(points_layer, 'points_layer', 'ogr')
+    for predicate in predicates:
+        if predicate not in PREDICATES:
+            raise ValueError('Unknown predicate: %s' % predicate)
+    for summary in summaries:
+        if summary not in SUMMARIES:
+            raise ValueError('Unsupported summary: %s' % summary)
+    if (QgsWkbTypes.geometryType(points_layer.wkbType())
+            != QgsWkbTypes.PointGeometry
+            or QgsWkbTypes.isMultiType(points_layer.wkbType())):
+        raise TypeError('The layer %s does not contain single points'
+                        % points_layer.name())
+    for field_name in join_fields:
+        if points_layer.fields().lookupField(field_name) < 0:
+            raise KeyError('Field %s not found in layer %s' % (
+                field_name, points_layer.name()))
+    task = AggregateByZoneTask(
+        'Aggregate %s by zone' % ', '.join(join_fields),
+        zonal_layer, points_layer, join_fields, output_layer_name,
+        discard_nonmatching=discard_nonmatching,
+        predicates=predicates, summaries=summaries, zones_key=zones_key)
+    task.zonal_stats_completed.connect(callback)
     QgsApplication.taskManager().addTask(task)
+    return task
+
+
+def read_points(points, join_fields, coord_transform=None,
+                is_canceled=None):
+    """
+    Read, in a single pass, the coordinates of the points and the values of
+    the given fields
+
+    :param points: the LayerSnapshot of a layer containing points
+    :param join_fields: names of the fields to read
+    :param coord_transform: an optional QgsCoordinateTransform, to convert
+        point coordinates into the coordinate reference system of the zones
+    :param is_canceled: an optional function returning True if the
+        operation has to be interrupted
+    :returns: (xs, ys, values, valid), where values is a float64 matrix with
+        one column for each field, and valid is a boolean matrix telling
+        which values are not NULL
+    """
+    field_idxs = [points.fields.lookupField(field_name)
+                  for field_name in join_fields]
+    request = QgsFeatureRequest().setSubsetOfAttributes(field_idxs)
+    xs = []
+    ys = []
+    rows = []
+    for feat in points.source.getFeatures(request):
+        if is_canceled is not None and is_canceled():
+            return None
+        point = feat.geometry().asPoint()
+        if coord_transform is not None:
+            point = coord_transform.transform(point)
+        xs.append(point.x())
+        ys.append(point.y())
+        attributes = feat.attributes()
+        rows.append([attributes[idx] for idx in field_idxs])
+    valid = numpy.array([[value not in (None, NULL) for value in row]
+                         for row in rows], dtype=bool).reshape(
+                             len(rows), len(field_idxs))
+    values = numpy.array(
+        [[value if is_valid else numpy.nan
+          for value, is_valid in zip(row, row_valid)]
+         for row, row_valid in zip(rows, valid)],
+        dtype=numpy.float64).reshape(len(rows), len(field_idxs))
+    return (numpy.array(xs, dtype=numpy.float64),
+            numpy.array(ys, dtype=numpy.float64), values, valid)
+
+
+def match_sites_to_zones(site_xs, site_ys, zone_geometries,
+                         predicates=('intersects',), is_canceled=None):
+    """
+    Find the zones matching each site, by means of a spatial index of the
+    zones. Zone geometries are prepared only when they are candidates for
+    matching a site
+
+    :param site_xs: array of x coordinates of the sites
+    :param site_ys: array of y coordinates of the sites
+    :param zone_geometries: list of QgsGeometry of the zones
+    :param predicates: geometric predicates (see PREDICATES)
+    :param is_canceled: an optional function returning True if the
+        operation has to be interrupted
+    :returns: (site_idxs, zone_idxs), two arrays of the same length, listing
+        all matching (site, zone) pairs, sorted by site
+    """
+    index = QgsSpatialIndex()
+    for zone_idx, zone_geometry in enumerate(zone_geometries):
+        if zone_geometry.isNull():
+            continue
+        index.addFeature(zone_idx, zone_geometry.boundingBox())
+    engines = {}
+    site_idxs = []
+    zone_idxs = []
+    for site_idx, (x, y) in enumerate(zip(site_xs.tolist(),
+                                          site_ys.tolist())):
+        if is_canceled is not None and is_canceled():
+            return None
+        candidates = index.intersects(QgsRectangle(x, y, x, y))
+        if not candidates:
+            continue
+        point = QgsPoint(x, y)
+        for zone_idx in sorted(candidates):
+            engine = engines.get(zone_idx)
+            if engine is None:
+                engine = QgsGeometry.createGeometryEngine(
+                    zone_geometries[zone_idx].constGet())
+                engine.prepareGeometry()
+                engines[zone_idx] = engine
+            if any(getattr(engine, predicate)(point)
+                   for predicate in predicates):
+                site_idxs.append(site_idx)
+                zone_idxs.append(zone_idx)
+    return (numpy.array(site_idxs, dtype=numpy.int64),
+            numpy.array(zone_idxs, dtype=numpy.int64))
+
+
+def match_points_to_zones(xs, ys, zone_geometries, predicates=('intersects',),
+                          is_canceled=None, zone_fids=None, zones_key=None):
+    """
+    Find the zones matching each point. Points sharing the same coordinates
+    (e.g. different assets in the same site) are matched only once.
 
-    while True:
-        # the user can "cancel" the task, interrupting this loop
-        QgsApplication.processEvents()
-        # status can be queued, onhold, running, complete, terminated
-        if task.status() > 2:  # Complete or terminated
-            return
-        time.sleep(0.1)
+    If zones_key is given, the zones matching each site are cached, so they
+    are not searched again when points in the same sites are aggregated by
+    the same zones (e.g. for another output of the same calculation).
 
+    :param zone_fids: feature ids of the zones (needed if zones_key is given)
+    :param zones_key: (layer id, modification stamp) of the zonal layer, as
+        returned by ZoneAssignmentCache.layer_key (or file_key)
+    :returns: (point_idxs, zone_idxs), two arrays of the same length, listing
+        all matching (point, zone) pairs, sorted by point
+    """
+    sites, point_site_idxs = numpy.unique(
+        numpy.column_stack([xs, ys]).reshape(-1, 2), axis=0,
+        return_inverse=True)
+    point_site_idxs = point_site_idxs.reshape(-1)
+    cache = get_zone_assignment_cache() if zones_key is not None else None
+    cached = (cache.lookup(zones_key, predicates, sites)
+              if cache is not None else None)
+    if cached is not None:
+        site_idxs, site_zone_fids = cached
+        zone_fids = numpy.asarray(zone_fids, dtype=numpy.int64)
+        sorter = numpy.argsort(zone_fids)
+        site_zone_idxs = sorter[numpy.searchsorted(
+            zone_fids, site_zone_fids, sorter=sorter)]
+    else:
+        matches = match_sites_to_zones(
+            sites[:, 0], sites[:, 1], zone_geometries, predicates,
+            is_canceled)
+        if matches is None:
+            return None
+        site_idxs, site_zone_idxs = matches
+        if cache is not None:
+            cache.store(zones_key, predicates, sites, site_idxs,
+                        numpy.asarray(zone_fids, dtype=numpy.int64)[
+                            site_zone_idxs])
+    return expand_site_matches(
+        point_site_idxs, site_idxs, site_zone_idxs, len(sites))
+
+
+def expand_site_matches(point_site_idxs, site_idxs, site_zone_idxs,
+                        num_sites):
+    """
+    Convert (site, zone) pairs, sorted by site, into (point, zone) pairs,
+    sorted by point, given the site of each point
+    """
+    matches_per_site = numpy.bincount(site_idxs, minlength=num_sites)
+    first_match_per_site = numpy.cumsum(matches_per_site) - matches_per_site
+    matches_per_point = matches_per_site[point_site_idxs]
+    point_idxs = numpy.repeat(
+        numpy.arange(len(point_site_idxs)), matches_per_point)
+    # position of each pair among the pairs of the same point
+    pair_offsets = numpy.arange(len(point_idxs)) - numpy.repeat(
+        numpy.cumsum(matches_per_point) - matches_per_point,
+        matches_per_point)
+    zone_idxs = site_zone_idxs[
+        first_match_per_site[point_site_idxs[point_idxs]] + pair_offsets]
+    return point_idxs, zone_idxs
+
+
+def summarize_by_zone(point_idxs, zone_idxs, values, valid, num_zones,
+                      summaries=('sum',)):
+    """
+    Calculate the statistical summaries of the point values for each zone
 
-def task_finished(context, callback, successful, results):
-    if not successful:
-        callback(None)
-    output_layer = context.takeResultLayer(results['OUTPUT'])
-    callback(output_layer)
+    :param point_idxs: indices of the points of each (point, zone) pair
+    :param zone_idxs: indices of the zones of each (point, zone) pair
+    :param values: float64 matrix with one column of values for each field
+    :param valid: boolean matrix telling which values are not NULL
+    :param num_zones: number of zones
+    :param summaries: statistics to be calculated (see SUMMARIES)
+    :returns: a list containing, for each field, a dict summary ->
+        (output, output_valid), where output_valid is False for zones
+        without any (not NULL) value
+    """
+    matched = numpy.bincount(zone_idxs, minlength=num_zones) > 0
+    field_summaries = []
+    for field_idx in range(values.shape[1]):
+        is_valid = valid[point_idxs, field_idx]
+        zones = zone_idxs[is_valid]
+        field_values = values[point_idxs[is_valid], field_idx]
+        count = numpy.bincount(zones, minlength=num_zones)
+        has_values = count > 0
+        stats = {}
+        if 'count' in summaries:
+            stats['count'] = (count, matched)
+        if 'sum' in summaries or 'mean' in summaries:
+            total = numpy.bincount(
+                zones, weights=field_values, minlength=num_zones)
+            stats['sum'] = (total, has_values)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                stats['mean'] = (total / count, has_values)
+        if set(summaries) & {'min', 'max', 'range'}:
+            minimum = numpy.full(num_zones, numpy.inf)
+            numpy.minimum.at(minimum, zones, field_values)
+            maximum = numpy.full(num_zones, -numpy.inf)
+            numpy.maximum.at(maximum, zones, field_values)
+            stats['min'] = (minimum, has_values)
+            stats['max'] = (maximum, has_values)
+            stats['range'] = (maximum - minimum, has_values)
+        field_summaries.append(
+            {summary: stats[summary] for summary in summaries})
+    return field_summaries
+
+
+def aggregate_by_zone(zones, points, join_fields,
+                      output_layer_name, discard_nonmatching=False,
+                      predicates=('intersects',), summaries=('sum',),
+                      transform_context=None, is_canceled=None,
+                      set_progress=None, zones_key=None):
+    """
+    Build a memory layer copying the zones and adding the summaries of the
+    values of the points matching each zone (see calculate_zonal_stats).
+
+    :param zones: the LayerSnapshot of a layer containing polygons
+    :param points: the LayerSnapshot of a layer containing points
+    :param transform_context: the QgsCoordinateTransformContext used if the
+        two layers have different coordinate reference systems
+    :param is_canceled: an optional function returning True if the
+        operation has to be interrupted
+    :param set_progress: an optional function accepting a percentage
+    :param zones_key: an optional (layer id, modification stamp) of the
+        zonal layer, used to cache the zones matching each site
+    :returns: the output layer, or None if the operation was interrupted
+    """
+    def progress(percentage):
+        if set_progress is not None:
+            set_progress(percentage)
+
+    zone_features = list(zones.source.getFeatures())
+    zone_geometries = [feat.geometry() for feat in zone_features]
+    progress(5)
+    coord_transform = None
+    if points.crs != zones.crs:
+        coord_transform = QgsCoordinateTransform(
+            points.crs, zones.crs,
+            transform_context or QgsProject.instance().transformContext())
+    points_data = read_points(points, join_fields, coord_transform,
+                              is_canceled)
+    if points_data is None:
+        return None
+    xs, ys, values, valid = points_data
+    progress(30)
+    matches = match_points_to_zones(
+        xs, ys, zone_geometries, predicates, is_canceled,
+        zone_fids=[feat.id() for feat in zone_features],
+        zones_key=zones_key)
+    if matches is None:
+        return None
+    point_idxs, zone_idxs = matches
+    progress(80)
+    field_summaries = summarize_by_zone(
+        point_idxs, zone_idxs, values, valid, len(zone_features),
+        summaries)
+    output_layer = build_zonal_output_layer(
+        zones, zone_features, join_fields, field_summaries,
+        output_layer_name,
+        numpy.bincount(zone_idxs, minlength=len(zone_features)) > 0
+        if discard_nonmatching else None)
+    progress(100)
+    return output_layer
+
+
+def build_zonal_output_layer(zones, zone_features, join_fields,
+                             field_summaries, output_layer_name,
+                             zones_to_keep=None):
+    """
+    Create a memory layer copying the zones and adding one field for each
+    summary of each join field (named like <field>_<summary>, e.g.
+    structural_sum)
+
+    :param zones_to_keep: an optional boolean array telling which zones have
+        to be copied (by default, all of them)
+    """
+    out_fields = QgsFields(zones.fields)
+    summary_columns = []
+    for field_name, summaries in zip(join_fields, field_summaries):
+        for summary, (output, output_valid) in summaries.items():
+            field_type = (INT_FIELD_TYPE if summary == 'count'
+                          else DOUBLE_FIELD_TYPE)
+            out_fields.append(
+                QgsField('%s_%s' % (field_name, summary), field_type))
+            column = output.tolist()
+            for zone_idx in numpy.flatnonzero(~output_valid):
+                column[zone_idx] = NULL
+            summary_columns.append(column)
+    output_layer = QgsMemoryProviderUtils.createMemoryLayer(
+        output_layer_name, out_fields, zones.wkb_type, zones.crs)
+    out_features = []
+    for zone_idx, zone_feature in enumerate(zone_features):
+        if zones_to_keep is not None and not zones_to_keep[zone_idx]:
+            continue
+        out_feature = QgsFeature(out_fields)
+        out_feature.setGeometry(zone_feature.geometry())
+        out_feature.setAttributes(
+            zone_feature.attributes() +
+            [column[zone_idx] for column in summary_columns])
+        out_features.append(out_feature)
+    output_layer.dataProvider().addFeatures(out_features)
+    output_layer.updateExtents()
+    return output_layer
+
+
+class ZoneAssignmentCache(object):
+    """
+    Cache of the zones matching each site, for the zonal layers used for
+    aggregating points by zone. Entries are keyed by the id of the zonal
+    layer, a stamp that changes whenever the layer is modified, the
+    geometric predicates and a hash of the coordinates of the sites, so
+    aggregating other values for the same sites does not require to match
+    points and zones again. Entries of a zonal layer are discarded as soon
+    as the layer is modified or deleted. Zonal layers opened from a file
+    for a single aggregation are keyed by the path of the file and by its
+    modification time instead (see file_key).
+
+    :param max_entries: maximum number of site->zone mappings to keep (the
+        least recently used ones are discarded first)
+    """
+
+    def __init__(self, max_entries=ZONE_ASSIGNMENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        # key -> (site_idxs, zone_fids)
+        self._entries = OrderedDict()
+        # layer id -> modification stamp
+        self._stamps = {}
+        self._lock = threading.Lock()
+
+    def layer_key(self, layer):
+        """
+        Return (layer id, modification stamp) of the given zonal layer,
+        starting to track its modifications if needed. It has to be called
+        from the main thread.
+        """
+        layer_id = layer.id()
+        with self._lock:
+            if layer_id in self._stamps:
+                return layer_id, self._stamps[layer_id]
+            self._stamps[layer_id] = 0
+        invalidate = partial(self.invalidate, layer_id)
+        for signal in (layer.featureAdded, layer.featureDeleted,
+                       layer.geometryChanged, layer.dataChanged,
+                       layer.crsChanged):
+            signal.connect(invalidate)
+        layer.willBeDeleted.connect(partial(self.forget, layer_id))
+        return layer_id, 0
+
+    @staticmethod
+    def file_key(path):
+        """
+        Return ('file:' + path, modification time) of a zonal layer read
+        from the given path (possibly followed by '|layername=...'), without
+        tracking any layer, or None if the file can not be accessed (so
+        that nothing is cached)
+        """
+        try:
+            mtime = os.path.getmtime(path.split('|')[0])
+        except OSError:
+            return None
+        return 'file:%s' % path, mtime
+
+    @staticmethod
+    def _make_key(zones_key, predicates, sites):
+        sites_hash = hashlib.sha1(
+            numpy.ascontiguousarray(sites, dtype=numpy.float64).tobytes())
+        return tuple(zones_key) + (tuple(predicates), sites_hash.hexdigest())
+
+    def lookup(self, zones_key, predicates, sites):
+        """
+        :returns: (site_idxs, zone_fids) listing the (site, zone) pairs
+            matching the given sites, or None if they are not cached
+        """
+        key = self._make_key(zones_key, predicates, sites)
+        with self._lock:
+            matches = self._entries.get(key)
+            if matches is not None:
+                self._entries.move_to_end(key)
+            return matches
+
+    def store(self, zones_key, predicates, sites, site_idxs, zone_fids):
+        key = self._make_key(zones_key, predicates, sites)
+        with self._lock:
+            if (not zones_key[0].startswith('file:')
+                    and self._stamps.get(zones_key[0]) != zones_key[1]):
+                # the layer was modified in the meantime
+                return
+            self._entries[key] = (site_idxs, zone_fids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, layer_id, *args):
+        """
+        Discard the entries of the given zonal layer, because it was
+        modified
+        """
+        with self._lock:
+            self._stamps[layer_id] = self._stamps.get(layer_id, 0) + 1
+            self._discard_entries(layer_id)
+
+    def forget(self, layer_id, *args):
+        """
+        Discard the entries of the given zonal layer and stop tracking it,
+        because it was deleted
+        """
+        with self._lock:
+            self._stamps.pop(layer_id, None)
+            self._discard_entries(layer_id)
+
+    def _discard_entries(self, layer_id):
+        for key in [key for key in self._entries if key[0] == layer_id]:
+            del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_ZONE_ASSIGNMENT_CACHE = None
+
+
+def get_zone_assignment_cache():
+    """
+    Return the cache of site->zone mappings shared by all aggregations
+    """
+    global _ZONE_ASSIGNMENT_CACHE
+    if _ZONE_ASSIGNMENT_CACHE is None:
+        _ZONE_ASSIGNMENT_CACHE = ZoneAssignmentCache()
+    return _ZONE_ASSIGNMENT_CACHE
@@ -30,7 +30,7 @@ from svir.utilities.shared import (
     LONGLONG_FIELD_TYPE)
 
 
-def add_attribute(proposed_attr_name, dtype, layer):
+def make_field(proposed_attr_name, dtype):
     # TODO: map numpy types to qt types more precisely to optimize storage
     if dtype == 'S':
         qtype = STRING_FIELD_TYPE
@@ -46,7 +46,23 @@ def add_attribute(proposed_attr_name, dtype, layer):
         qname = 'Double'
     field = QgsField(proposed_attr_name, qtype)
     field.setTypeName(qname)
-    assigned_attr_names = ProcessLayer(layer).add_attributes(
-        [field])
+    return field
+
+
+def add_attribute(proposed_attr_name, dtype, layer):
+    assigned_attr_names = add_attributes({proposed_attr_name: dtype}, layer)
     assigned_attr_name = assigned_attr_names[proposed_attr_name]
     return assigned_attr_name
+
+
+def add_attributes(proposed_attr_dtypes, layer):
+    """
+    Add several attributes to a layer at once
+
+    :param proposed_attr_dtypes: dict {proposed_attr_name: dtype}
+    :param layer: the layer to be modified
+    :returns: dict {proposed_attr_name: assigned_attr_name}
+    """
+    fields = [make_field(proposed_attr_name, dtype)
+              for proposed_attr_name, dtype in proposed_attr_dtypes.items()]
+    return ProcessLayer(layer).add_attributes(fields)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-08
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import numpy
+
+from qgis.PyQt.QtCore import QObject
+
+from svir.calculations.process_layer import ProcessLayer
+from svir.utilities.utils import Register
+
+# classification methods, each taking a sorted float64 array of valid values
+# and the number of classes, and returning the upper bounds of the classes.
+# Keys are the ids of the corresponding QgsClassificationMethod subclasses
+CLASSIFICATION_METHODS = Register()
+
+# like QgsClassificationJenks, natural breaks are computed on a sample of at
+# most this number of values
+JENKS_MAX_SAMPLE_SIZE = 3000
+# number of rows of the matrix of costs that are computed at once
+JENKS_BLOCK_SIZE = 500
+
+CLASSIFICATION_PROPERTY_PREFIX = 'irmt/classification'
+
+
+@CLASSIFICATION_METHODS.add('Jenks')
+def jenks_breaks(values, n_classes):
+    """
+    Fisher-Jenks natural breaks, minimizing the sum of squared deviations
+    from the class means. Values are sampled (including the extremes) if they
+    are more than JENKS_MAX_SAMPLE_SIZE.
+    """
+    if len(values) > JENKS_MAX_SAMPLE_SIZE:
+        sample_idxs = numpy.linspace(
+            0, len(values) - 1, JENKS_MAX_SAMPLE_SIZE).round().astype(int)
+        values = values[sample_idxs]
+    n_values = len(values)
+    n_classes = min(n_classes, n_values)
+    if n_classes < 2:
+        return [values[-1]]
+    # NOTE: values are centered to limit the loss of precision in the sums
+    centered = values - values.mean()
+    sums = numpy.concatenate(([0.], numpy.cumsum(centered)))
+    sq_sums = numpy.concatenate(([0.], numpy.cumsum(centered ** 2)))
+    # costs[j] is the minimum sum of squared deviations obtained splitting
+    # the first j values into the current number of classes
+    ends = numpy.arange(n_values + 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        costs = sq_sums - sums ** 2 / ends
+    costs[0] = 0.
+    starts = numpy.arange(n_values + 1)
+    class_starts = numpy.zeros((n_classes + 1, n_values + 1), dtype=int)
+    for n_cls in range(2, n_classes + 1):
+        new_costs = numpy.full(n_values + 1, numpy.inf)
+        for block_start in range(n_cls, n_values + 1, JENKS_BLOCK_SIZE):
+            block_ends = ends[block_start:block_start + JENKS_BLOCK_SIZE]
+            counts = block_ends[:, None] - starts[None, :]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                block_costs = costs[None, :] + (
+                    sq_sums[block_ends][:, None] - sq_sums[None, :]
+                    - (sums[block_ends][:, None] - sums[None, :]) ** 2
+                    / counts)
+            # the last class starts after the first n_cls - 1 values and it
+            # contains at least one value
+            block_costs[(counts < 1)
+                        | (starts[None, :] < n_cls - 1)] = numpy.inf
+            best_starts = block_costs.argmin(axis=1)
+            new_costs[block_ends] = block_costs[
+                numpy.arange(len(block_ends)), best_starts]
+            class_starts[n_cls, block_ends] = best_starts
+        costs = new_costs
+    breaks = [values[-1]]
+    end = n_values
+    for n_cls in range(n_classes, 1, -1):
+        end = class_starts[n_cls, end]
+        breaks.append(values[end - 1])
+    return breaks[::-1]
+
+
+@CLASSIFICATION_METHODS.add('Quantile')
+def quantile_breaks(values, n_classes):
+    """
+    Breaks such that each class contains (about) the same number of values
+    """
+    return list(numpy.quantile(
+        values, numpy.arange(1, n_classes + 1) / n_classes))
+
+
+@CLASSIFICATION_METHODS.add('EqualInterval')
+def equal_interval_breaks(values, n_classes):
+    """
+    Breaks splitting the range of values into classes of the same width
+    """
+    minimum, maximum = values[0], values[-1]
+    return [minimum + (maximum - minimum) * cls / n_classes
+            for cls in range(1, n_classes + 1)]
+
+
+@CLASSIFICATION_METHODS.add('Pretty')
+def pretty_breaks(values, n_classes):
+    """
+    About n_classes equally spaced round values (1, 2 or 5 times a power of
+    10) covering the range of values, computed like
+    QgsSymbolLayerUtils::prettyBreaks (based on R's pretty)
+    """
+    minimum, maximum = values[0], values[-1]
+    min_count = n_classes // 3
+    shrink = 0.75
+    high_bias = 1.5
+    adjust_bias = 0.5 + 1.5 * high_bias
+    dx = maximum - minimum
+    if dx == 0 and maximum == 0:
+        cell = 1.0
+        small = True
+    else:
+        cell = max(abs(minimum), abs(maximum))
+        small = dx < cell * max(1, n_classes) * 1e-07 * 3.0
+    if small:
+        if cell > 10:
+            cell = 9 + cell / 10
+        cell *= shrink
+        if min_count > 1:
+            cell /= min_count
+    else:
+        cell = dx
+        if n_classes > 1:
+            cell /= n_classes
+    cell = max(cell, 20 * 1e-07)
+    base = 10.0 ** numpy.floor(numpy.log10(cell))
+    unit = base
+    if 2 * base - cell < high_bias * (cell - unit):
+        unit = 2.0 * base
+        if 5 * base - cell < adjust_bias * (cell - unit):
+            unit = 5.0 * base
+            if 10.0 * base - cell < high_bias * (cell - unit):
+                unit = 10.0 * base
+    start = int(numpy.floor(minimum / unit + 1e-07))
+    end = int(numpy.ceil(maximum / unit - 1e-07))
+    while start * unit > minimum + 1e-07 * unit:
+        start -= 1
+    while end * unit < maximum - 1e-07 * unit:
+        end += 1
+    k = int(numpy.floor(0.5 + end - start))
+    if k < min_count:
+        k = min_count - k
+        if start >= 0:
+            end += k // 2
+            start = start - k // 2 + k % 2
+        else:
+            start -= k // 2
+            end += k // 2 + k % 2
+    breaks = [start * unit + idx * unit for idx in range(1, end - start + 1)]
+    if not breaks:
+        return [maximum]
+    breaks[0] = max(breaks[0], minimum)
+    breaks[-1] = min(breaks[-1], maximum)
+    if minimum < 0 < maximum:
+        # the break closest to zero is set exactly to zero
+        breaks[int(numpy.argmin(numpy.abs(breaks)))] = 0.0
+    return breaks
+
+
+def classify_column(column, method, n_classes):
+    """
+    Summarize a column of values for styling purposes, computing the breaks
+    of the classes with the given method
+
+    :param column: float64 array (missing values are nan)
+    :param method: one of the keys of CLASSIFICATION_METHODS
+    :param n_classes: maximum number of classes
+    :returns: a dict containing the minimum valid value, the number of
+        unique valid values, if there are missing values and the upper bounds
+        of the classes (empty if there are less than 3 unique values)
+    """
+    has_null = bool(numpy.isnan(column).any())
+    values = numpy.sort(column[~numpy.isnan(column)])
+    num_unique = int(numpy.count_nonzero(numpy.diff(values))) + 1 \
+        if len(values) else 0
+    breaks = []
+    if num_unique > 2:
+        breaks = [float(upper) for upper in CLASSIFICATION_METHODS[method](
+            values, min(num_unique, n_classes))]
+    return dict(minimum=float(values[0]) if len(values) else None,
+                num_unique=num_unique, has_null=has_null, breaks=breaks)
+
+
+def _property_name(calc_id, field_name, method, n_classes):
+    return '%s/%s/%s/%s/%s' % (CLASSIFICATION_PROPERTY_PREFIX, calc_id,
+                               field_name, method, n_classes)
+
+
+class ClassificationCache(QObject):
+    """
+    Watch a layer whose classifications are cached in its custom properties,
+    dropping them whenever attribute values or fields of the layer change
+    (e.g. after a transformation or an edit with the field calculator). The
+    object is owned by the layer, so it lives as long as the layer does.
+    """
+
+    def __init__(self, layer):
+        super().__init__(layer)
+        self.layer = layer
+        # NOTE: the layer can be loaded from a project with cached values
+        self.is_empty = not self._cached_keys()
+        layer.attributeValueChanged.connect(self.clear)
+        layer.committedAttributeValuesChanges.connect(self.clear)
+        layer.updatedFields.connect(self.clear)
+        # NOTE: e.g. after values are written directly through the provider
+        #       and the layer is reloaded
+        layer.dataChanged.connect(self.clear)
+
+    def _cached_keys(self):
+        return [key for key in self.layer.customPropertyKeys()
+                if key.startswith(CLASSIFICATION_PROPERTY_PREFIX + '/')]
+
+    def clear(self, *args):
+        if self.is_empty:
+            return
+        for key in self._cached_keys():
+            self.layer.removeCustomProperty(key)
+        self.is_empty = True
+
+
+def watch_classification_cache(layer):
+    """
+    Make sure the classifications cached on the layer are dropped when its
+    data changes
+
+    :returns: the ClassificationCache of the layer
+    """
+    cache = layer.findChild(ClassificationCache)
+    if cache is None:
+        cache = ClassificationCache(layer)
+    return cache
+
+
+def classify_layer_fields(layer, field_names, method, n_classes):
+    """
+    Classify the values of one or more numeric fields of a layer, reading all
+    the missing columns at once. Results of layers loaded from the outputs of
+    a calculation are stored as custom properties of the layer, keyed by
+    (calc_id, field_name, method, n_classes), so they are saved with the
+    project and they are reused when the layer is restyled, until the data
+    of the layer changes (see ClassificationCache).
+
+    :returns: a dict {field_name: classification} (see classify_column)
+    """
+    calc_id = layer.customProperty('calc_id')
+    cache = None
+    if calc_id is not None:
+        cache = watch_classification_cache(layer)
+    classifications = {}
+    missing_fields = []
+    for field_name in field_names:
+        if calc_id is not None:
+            cached = layer.customProperty(
+                _property_name(calc_id, field_name, method, n_classes))
+            if cached:
+                classifications[field_name] = json.loads(cached)
+                continue
+        missing_fields.append(field_name)
+    if not missing_fields:
+        return classifications
+    _, columns = ProcessLayer(layer).read_columns(missing_fields)
+    for field_name in missing_fields:
+        classification = classify_column(
+            columns[field_name], method, n_classes)
+        classifications[field_name] = classification
+        if cache is not None:
+            layer.setCustomProperty(
+                _property_name(calc_id, field_name, method, n_classes),
+                json.dumps(classification))
+            cache.is_empty = False
+    return classifications
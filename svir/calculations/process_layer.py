@@ -25,7 +25,8 @@
 import sys
 
 import uuid
-from numpy.testing import assert_almost_equal
+import hashlib
+import numpy
 from pprint import pformat
 from qgis.core import (
                        QgsFeatureRequest,
@@ -35,16 +36,22 @@ from qgis.core import (
                        QgsVectorDataProvider,
                        QgsProject,
                        QgsField,
+                       QgsFields,
+                       NULL,
                        edit,
                        )
 
-from svir.calculations.transformation_algs import TRANSFORMATION_ALGS, \
-    transform
+from svir.calculations.transformation_algs import (
+    to_column, from_column, transform_column)
 from svir.utilities.shared import (
     DEBUG, DOUBLE_FIELD_TYPE, DOUBLE_FIELD_TYPE_NAME)
 
 from svir.utilities.utils import tr, log_msg
 
+# number of features whose values are read or written at once while
+# transforming an attribute
+TRANSFORM_CHUNK_SIZE = 10000
+
 
 class ProcessLayer(object):
     """
@@ -118,50 +125,183 @@ class ProcessLayer(object):
                      " reference system: %s" % this_layer_projection)
             return True, msg
 
-    def has_same_content_as(self, other_layer):
+    def has_same_content_as(self, other_layer, rtol=0.0, atol=1.5e-7):
         """
-        Check if the layer has the same content as another layer
+        Check if the layer has the same content as another layer, i.e. the
+        same fields (in the same order) and, feature by feature, the same
+        values. Numeric values are compared with the given tolerances (by
+        default, as numpy.testing.assert_almost_equal does)
 
         :param other_layer: layer to compare with
         :type other_layer: QgsVectorLayer
         """
-        len_this = self.layer.featureCount()
-        len_other = other_layer.featureCount()
-        # Check if the layers have the same number of rows (features)
-        if len_this != len_other:
+        if self.layer.fields().names() != other_layer.fields().names():
             return False
-        # Check if the layers have the same field names (columns)
-        this_fields = [field.name() for field in self.layer.fields()]
-        other_fields = [field.name() for field in other_layer.fields()]
-        if this_fields != other_fields:
+        if self.layer.featureCount() != other_layer.featureCount():
             return False
-        this_features = self.layer.getFeatures()
-        other_features = other_layer.getFeatures()
-        # we already checked that the layers have the same number of features
-        # and now we want to make sure that for each feature the contents are
-        # the same
-        for i in range(len_this):
-            this_feature = next(this_features)
-            other_feature = next(other_features)
-            this_feat_data = this_feature.attributes()
-            other_feat_data = other_feature.attributes()
-            if len(this_feat_data) != len(other_feat_data):
-                return False
-            for j in range(len(this_feat_data)):
-                if isinstance(this_feat_data[j], (int, float, complex)):
-                    try:
-                        assert_almost_equal(this_feat_data[j],
-                                            other_feat_data[j])
-                    except AssertionError:
-                        return False
-                else:
-                    if this_feat_data[j] != other_feat_data[j]:
-                        return False
-        return True
+        diff = self.compare_content_with(other_layer, rtol=rtol, atol=atol)
+        return not diff['field_diffs']
+
+    def read_columns(self, field_names=None):
+        """
+        Read the attribute table of the layer with a single request, as a
+        dict of columns. Numeric fields are read as float64 arrays (missing
+        values are nan), the others as object arrays (missing values are None)
+
+        :param field_names: names of the fields to read (by default, all)
+        :returns: (feat_ids, columns)
+        """
+        fields = self.layer.fields()
+        if field_names is None:
+            field_names = fields.names()
+        field_idxs = [self.find_attribute_id(name) for name in field_names]
+        request = QgsFeatureRequest().setFlags(
+            QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(field_idxs)
+        feat_ids = []
+        rows = []
+        for feat in self.layer.getFeatures(request):
+            feat_ids.append(feat.id())
+            attrs = feat.attributes()
+            rows.append([attrs[field_idx] for field_idx in field_idxs])
+        columns = {}
+        for col_idx, field_idx in enumerate(field_idxs):
+            values = [row[col_idx] for row in rows]
+            if fields.at(field_idx).isNumeric():
+                columns[field_names[col_idx]] = to_column(values)[0]
+            else:
+                column = numpy.empty(len(values), dtype=object)
+                column[:] = [None if value in (None, NULL) else value
+                             for value in values]
+                columns[field_names[col_idx]] = column
+        return numpy.array(feat_ids, dtype=numpy.int64), columns
+
+    def compare_content_with(self, other_layer, rtol=0.0, atol=1.5e-7):
+        """
+        Compare the attribute table of the layer with the one of another
+        layer, column by column. Features are matched by position (in the
+        order in which they are read from the layers). Numeric columns are
+        compared with numpy.isclose, using the given tolerances, and missing
+        values are considered equal to each other.
+
+        :param other_layer: layer to compare with
+        :type other_layer: QgsVectorLayer
+        :returns: a dict containing:
+            feature_counts: the numbers of features of the two layers
+            missing_fields: fields of this layer that the other one lacks
+            extra_fields: fields of the other layer that this one lacks
+            field_diffs: for each field in common whose values differ, the
+                number of features for which they differ (features of the
+                longer layer that have no counterpart count as different)
+            differing_feat_ids: ids of the features of this layer having
+                at least one value different from the other layer, or having
+                no counterpart in it
+        """
+        this_fields = self.layer.fields().names()
+        other_fields = other_layer.fields().names()
+        common_fields = [name for name in this_fields if name in other_fields]
+        this_feat_ids, this_columns = self.read_columns(common_fields)
+        other_feat_ids, other_columns = ProcessLayer(
+            other_layer).read_columns(common_fields)
+        this_count, other_count = len(this_feat_ids), len(other_feat_ids)
+        min_count, max_count = sorted([this_count, other_count])
+        differing = numpy.zeros(max_count, dtype=bool)
+        differing[min_count:] = True
+        field_diffs = {}
+        for name in common_fields:
+            this_column = this_columns[name][:min_count]
+            other_column = other_columns[name][:min_count]
+            if (this_column.dtype == numpy.float64
+                    and other_column.dtype == numpy.float64):
+                field_differing = ~numpy.isclose(
+                    this_column, other_column, rtol=rtol, atol=atol,
+                    equal_nan=True)
+            else:
+                field_differing = numpy.array(
+                    [this_value != other_value
+                     for this_value, other_value in zip(
+                         self._to_objects(this_column),
+                         self._to_objects(other_column))], dtype=bool)
+            n_differing = int(field_differing.sum()) + max_count - min_count
+            if n_differing:
+                field_diffs[name] = n_differing
+                differing[:min_count] |= field_differing
+        return dict(
+            feature_counts=(this_count, other_count),
+            missing_fields=[name for name in this_fields
+                            if name not in other_fields],
+            extra_fields=[name for name in other_fields
+                          if name not in this_fields],
+            field_diffs=field_diffs,
+            differing_feat_ids=this_feat_ids[
+                differing[:this_count]].tolist())
+
+    @staticmethod
+    def _to_objects(column):
+        if column.dtype == numpy.float64:
+            objects = column.astype(object)
+            objects[numpy.isnan(column)] = None
+            return objects
+        return column
+
+    def content_digest(self, decimals=7):
+        """
+        Compute a fingerprint of each column of the attribute table. Two
+        layers can then be compared through their digests (e.g. stored after
+        a previous run), without reading the features of both of them.
+        Numeric values are rounded to the given number of decimals before
+        hashing them.
+
+        :param decimals: number of decimals taken into account for numeric
+            values
+        :returns: a dict {field_name: sha1 hexdigest}
+        """
+        _, columns = self.read_columns()
+        digests = {}
+        for field_name, column in columns.items():
+            digest = hashlib.sha1()
+            if column.dtype == numpy.float64:
+                # NOTE: adding 0.0 turns -0.0 into 0.0, and nan is
+                #       assigned again to make its binary representation
+                #       unique
+                values = numpy.round(column, decimals) + 0.0
+                values[numpy.isnan(values)] = numpy.nan
+                digest.update(b'float64:')
+                digest.update(values.tobytes())
+            else:
+                digest.update(b'object:')
+                for value in column:
+                    digest.update(repr(value).encode('utf8'))
+                    digest.update(b'\0')
+            digests[field_name] = digest.hexdigest()
+        return digests
+
+    @staticmethod
+    def launder_attribute_name(input_attribute_name, is_shapefile=False,
+                               suffix_num=None):
+        """
+        Return the name to be proposed for an attribute, optionally adding a
+        numeric suffix to distinguish it from existing attributes. Names of
+        attributes of shapefiles are truncated to 10 characters and converted
+        to upper case.
+        """
+        if is_shapefile:
+            if suffix_num is None:
+                max_name_len = 10
+            else:
+                # 10 = shapefile limit
+                # 1 = underscore
+                max_name_len = 10 - len(str(suffix_num)) - 1
+            name = input_attribute_name[:max_name_len].upper().replace(
+                ' ', '_')
+        else:
+            name = input_attribute_name
+        if suffix_num is None:
+            return name
+        return '%s_%d' % (name, suffix_num)
 
     def add_attributes(self, attribute_list, simulate=False):
         """
-        Add attributes to the layer
+        Add attributes to the layer, all at once
 
         :param attribute_list: list of QgsField to add to the layer
         :type attribute_list: list of QgsField
@@ -180,62 +320,47 @@ class ProcessLayer(object):
                             ' editable format before attempting to add'
                             ' attributes to it.'
                             % self.layer.providerType())
+        is_shapefile = self.layer.providerType() == 'ogr'
         aliases = dict()
         proposed_attribute_dict = {}
         proposed_attribute_list = []
+        # NOTE: names assigned to the attributes added in this same call are
+        #       taken into account too
+        assigned_attribute_names = set(self.layer.fields().names())
+        for input_attribute in attribute_list:
+            input_attribute_name = input_attribute.name()
+            proposed_attribute_name = self.launder_attribute_name(
+                input_attribute_name, is_shapefile)
+            i = 1
+            while proposed_attribute_name in assigned_attribute_names:
+                # If the attribute is already assigned, change the
+                # proposed_attribute_name
+                proposed_attribute_name = self.launder_attribute_name(
+                    input_attribute_name, is_shapefile, i)
+                i += 1
+            assigned_attribute_names.add(proposed_attribute_name)
+            proposed_attribute_dict[input_attribute_name] = \
+                proposed_attribute_name
+            input_attribute.setName(proposed_attribute_name)
+            proposed_attribute_list.append(input_attribute)
+            if proposed_attribute_name != input_attribute_name:
+                aliases[proposed_attribute_name] = input_attribute_name
+        if simulate or not proposed_attribute_list:
+            return proposed_attribute_dict
         with edit(self.layer):
-            # add attributes
             layer_pr = self.layer.dataProvider()
-            for input_attribute in attribute_list:
-                input_attribute_name = input_attribute.name()
-                if self.layer.providerType() == 'ogr':
-                    proposed_attribute_name = \
-                        input_attribute_name[:10].upper().replace(' ', '_')
-                else:
-                    proposed_attribute_name = input_attribute_name
-                i = 1
-                while True:
-                    current_attribute_names = \
-                        [attribute.name() for attribute in self.layer.fields()]
-                    if proposed_attribute_name in current_attribute_names:
-                        # If the attribute is already assigned, change the
-                        # proposed_attribute_name
-                        if self.layer.providerType() == 'ogr':
-                            i_num_digits = len(str(i))
-                            # 10 = shapefile limit
-                            # 1 = underscore
-                            max_name_len = 10 - i_num_digits - 1
-                            proposed_attribute_name = '%s_%d' % (
-                                input_attribute_name[:max_name_len].upper(
-                                    ).replace(' ', '_'), i)
-                        else:
-                            proposed_attribute_name = '%s_%d' % (
-                                input_attribute_name, i)
-                        i += 1
-                    else:
-                        # If the attribute name is not already assigned,
-                        # add it to the proposed_attribute_dict
-                        proposed_attribute_dict[input_attribute_name] = \
-                            proposed_attribute_name
-                        input_attribute.setName(proposed_attribute_name)
-                        proposed_attribute_list.append(input_attribute)
-                        break
-                if proposed_attribute_name != input_attribute_name:
-                    aliases[proposed_attribute_name] = input_attribute_name
-            if not simulate:
-                added_ok = layer_pr.addAttributes(proposed_attribute_list)
-                if not added_ok:
-                    raise AttributeError(
-                        'Unable to add attributes %s' %
-                        proposed_attribute_list)
-        with edit(self.layer):
-            # add aliases
-            if not simulate:
+            added_ok = layer_pr.addAttributes(proposed_attribute_list)
+            if not added_ok:
+                raise AttributeError(
+                    'Unable to add attributes %s' %
+                    proposed_attribute_list)
+            if aliases:
+                self.layer.updateFields()
+                fields = self.layer.fields()
                 for proposed_attribute_name in aliases:
-                    attribute_id = self.layer.fields().indexOf(
-                        proposed_attribute_name)
                     self.layer.setFieldAlias(
-                        attribute_id, aliases[proposed_attribute_name])
+                        fields.indexOf(proposed_attribute_name),
+                        aliases[proposed_attribute_name])
         return proposed_attribute_dict
 
     def delete_attributes(self, attribute_list):
@@ -277,7 +402,7 @@ class ProcessLayer(object):
     def transform_attribute(
             self, input_attr_name, algorithm_name, variant="",
             inverse=False, new_attr_name=None, new_attr_alias=None,
-            simulate=False):
+            simulate=False, set_progress=None, is_canceled=None):
         """
         Use one of the available transformation algorithms to transform an
         attribute of the layer, and add a new attribute with the
@@ -297,7 +422,13 @@ class ProcessLayer(object):
         :param simulate: if True, the method will just simulate the creation
                          of the target attribute and return the name that would
                          be assigned to it
-        :returns: (actual_new_attr_name, invalid_input_values)
+        :param set_progress: optional callback receiving the percentage of
+                             completion of the transformation
+        :param is_canceled: optional callback returning True if the
+                            transformation has to be interrupted
+        :returns: (actual_new_attr_name, invalid_input_values), or None if the
+                  transformation was canceled (in which case the layer is
+                  left unchanged)
         """
         caps = self.layer.dataProvider().capabilities()
         if not (caps & QgsVectorDataProvider.ChangeAttributeValues):
@@ -332,27 +463,37 @@ class ProcessLayer(object):
                 actual_new_attr_name = attr_names_dict[new_attr_name]
                 return actual_new_attr_name
 
-        # a dict will contain all the values for the chosen input attribute,
-        # keeping as key, for each value, the id of the corresponding feature
-        initial_dict = dict()
+        # read the ids of the features and the corresponding values of the
+        # chosen input attribute, with a single request
+        # NOTE: reading takes roughly the first half of the progress, and
+        #       writing the results the second half
+        feat_count = self.layer.featureCount()
+        feat_ids = []
+        input_values = []
         request = QgsFeatureRequest().setFlags(
             QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(
-                [input_attr_name], self.layer.fields())
+                [input_attr_id])
         for feat in self.layer.getFeatures(request):
-            initial_dict[feat.id()] = feat[input_attr_id]
-
-        # get the transformation algorithm from the register
-        algorithm = TRANSFORMATION_ALGS[algorithm_name]
-
-        # transform the values in the dictionary with the chosen algorithm
-        invalid_input_values = None
-        try:
-            transformed_dict, invalid_input_values = transform(
-                initial_dict, algorithm, variant, inverse)
-        except ValueError:
-            raise
-        except NotImplementedError:
-            raise
+            feat_ids.append(feat.id())
+            input_values.append(feat[input_attr_id])
+            if len(feat_ids) % TRANSFORM_CHUNK_SIZE == 0:
+                if is_canceled is not None and is_canceled():
+                    return None
+                if set_progress is not None and feat_count > 0:
+                    set_progress(50 * len(feat_ids) / feat_count)
+
+        # transform the column of values with the chosen algorithm (it might
+        # raise ValueError or NotImplementedError)
+        values, valid = to_column(input_values)
+        output, output_valid, invalid_idxs = transform_column(
+            values, valid, algorithm_name, variant, inverse)
+        # missing values and values that could not be transformed are NULL
+        transformed_values = from_column(
+            output, output_valid, valid, missing_value=NULL)
+        invalid_input_values = [
+            input_values[idx] for idx in invalid_idxs] or None
+        if is_canceled is not None and is_canceled():
+            return None
 
         if overwrite:
             actual_new_attr_name = input_attr_name
@@ -364,27 +505,107 @@ class ProcessLayer(object):
             # get the id of the new attribute
             new_attr_id = self.find_attribute_id(actual_new_attr_name)
         if new_attr_alias:
-            with edit(self.layer):
-                self.layer.setFieldAlias(new_attr_id, new_attr_alias)
-
-        # TODO: perhaps there is a better way to get a list of feature ids.
-        #       Here we are retrieving no geometries and no fields, which
-        #       sounds the closest way to obtain it.
-        request = QgsFeatureRequest().setFlags(
-            QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(
-                [], self.layer.fields())
-        with edit(self.layer):
-            # write transformed values
-            for feat in self.layer.getFeatures(request):
-                feat_id = feat.id()
-                value = transformed_dict[feat_id]
-                try:
-                    value = float(value)
-                except Exception:
-                    pass
-                self.layer.changeAttributeValue(feat_id, new_attr_id, value)
+            # NOTE: aliases are part of the layer configuration, so they
+            #       can be set also while the layer is being edited
+            self.layer.setFieldAlias(new_attr_id, new_attr_alias)
+
+        fields = self.layer.fields()
+        is_provider_field = (
+            fields.fieldOrigin(new_attr_id) == QgsFields.OriginProvider)
+        # NOTE: values are written directly through the data provider, unless
+        #       the layer is being edited (changes would bypass the edit
+        #       buffer) or the field is not stored by the provider
+        if is_provider_field and not self.layer.isEditable():
+            written_ok = self._write_column_to_provider(
+                feat_ids, transformed_values, input_values,
+                fields.fieldOriginIndex(new_attr_id), overwrite,
+                set_progress, is_canceled)
+        else:
+            written_ok = self._write_column_to_edit_buffer(
+                feat_ids, transformed_values, new_attr_id,
+                set_progress, is_canceled)
+        if not written_ok:  # canceled
+            if not overwrite:
+                self.delete_attributes([actual_new_attr_name])
+            return None
         return actual_new_attr_name, invalid_input_values
 
+    def _write_column_to_provider(
+            self, feat_ids, values, original_values, provider_attr_id,
+            overwrite, set_progress=None, is_canceled=None):
+        """
+        Write a column of values in chunks, bypassing the edit buffer. If the
+        operation is canceled and the original attribute was being
+        overwritten, the values already written are restored.
+
+        :returns: False if the operation was canceled, True otherwise
+        """
+        layer_pr = self.layer.dataProvider()
+        tot_feats = len(feat_ids)
+        for start in range(0, tot_feats, TRANSFORM_CHUNK_SIZE):
+            if is_canceled is not None and is_canceled():
+                if overwrite:
+                    for restore_start in range(
+                            0, start, TRANSFORM_CHUNK_SIZE):
+                        restore_stop = restore_start + TRANSFORM_CHUNK_SIZE
+                        layer_pr.changeAttributeValues({
+                            feat_id: {provider_attr_id: value}
+                            for feat_id, value in zip(
+                                feat_ids[restore_start:restore_stop],
+                                original_values[restore_start:restore_stop])})
+                    self.layer.reload()
+                return False
+            stop = start + TRANSFORM_CHUNK_SIZE
+            if not layer_pr.changeAttributeValues({
+                    feat_id: {provider_attr_id: value}
+                    for feat_id, value in zip(
+                        feat_ids[start:stop], values[start:stop])}):
+                raise RuntimeError(
+                    'Unable to write the transformed values to layer %s: %s'
+                    % (self.layer.name(), layer_pr.errors()))
+            if set_progress is not None:
+                set_progress(50 + 50 * min(stop, tot_feats) / tot_feats)
+        # NOTE: features cached by the layer still contain the old values
+        self.layer.reload()
+        self.layer.triggerRepaint()
+        return True
+
+    def _write_column_to_edit_buffer(
+            self, feat_ids, values, attr_id, set_progress=None,
+            is_canceled=None):
+        """
+        Write a column of values through the edit buffer of the layer. If the
+        layer is already being edited, changes are left uncommitted in a
+        single undoable command; otherwise they are committed at the end.
+
+        :returns: False if the operation was canceled, True otherwise
+        """
+        was_editable = self.layer.isEditable()
+        if not was_editable:
+            self.layer.startEditing()
+        self.layer.beginEditCommand(
+            'Transform attribute %s' % self.layer.fields().at(attr_id).name())
+        tot_feats = len(feat_ids)
+        for start in range(0, tot_feats, TRANSFORM_CHUNK_SIZE):
+            if is_canceled is not None and is_canceled():
+                self.layer.destroyEditCommand()
+                if not was_editable:
+                    self.layer.rollBack()
+                return False
+            stop = start + TRANSFORM_CHUNK_SIZE
+            for feat_id, value in zip(feat_ids[start:stop],
+                                      values[start:stop]):
+                self.layer.changeAttributeValue(feat_id, attr_id, value)
+            if set_progress is not None:
+                set_progress(50 + 50 * min(stop, tot_feats) / tot_feats)
+        self.layer.endEditCommand()
+        if not was_editable:
+            if not self.layer.commitChanges():
+                raise RuntimeError(
+                    'Unable to write the transformed values to layer %s: %s'
+                    % (self.layer.name(), self.layer.commitErrors()))
+        return True
+
     def find_attribute_id(self, attribute_name):
         """
         Get the id of the attribute called attribute_name
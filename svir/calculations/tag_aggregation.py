@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-08-19
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+
+import numpy
+
+# keys of the extracted npz files that do not correspond to realizations or
+# statistics
+NON_RLZ_KEYS = ('imtls', 'array', 'extra')
+
+# value of a tag that stands for all its values, one by one
+ALL_VALUES = '*'
+
+_NO_ASSETS = numpy.zeros(0, dtype=int)
+
+
+def decode_tag_values(column):
+    """
+    Convert a column of tag values (possibly bytes and quoted) into strings
+    """
+    if column.dtype.kind == 'S':
+        column = numpy.char.decode(column, 'utf8')
+    return numpy.char.strip(column.astype(str), '"')
+
+
+class TagAggregator(object):
+    """
+    Aggregate values by asset locally, for any combination of tags, instead
+    of asking the OpenQuake Engine to aggregate them each time the selection
+    of tags changes.
+
+    For each tag, an inverted index associates to each value of the tag the
+    indices of the assets having that value, so selecting assets costs about
+    the number of assets with the selected values.
+
+    :param records_by_rlz: dict {rlz_or_stat: structured array}, with a record
+        for each asset (in the same order for all the realizations or
+        statistics), as extracted for outputs by asset
+    :param tag_names: names of the fields of the records containing tags
+    """
+
+    def __init__(self, records_by_rlz, tag_names):
+        self.records_by_rlz = OrderedDict(records_by_rlz)
+        self.rlzs_or_stats = list(self.records_by_rlz)
+        first_records = self.records_by_rlz[self.rlzs_or_stats[0]]
+        self.num_assets = len(first_records)
+        # tag_name -> {tag_value: indices of the assets}
+        self.index = {}
+        for tag_name in tag_names:
+            tag_values, codes = numpy.unique(
+                decode_tag_values(first_records[tag_name]),
+                return_inverse=True)
+            order = numpy.argsort(codes, kind='stable')
+            bounds = numpy.searchsorted(
+                codes[order], numpy.arange(len(tag_values) + 1))
+            self.index[tag_name] = {
+                str(tag_value): order[bounds[idx]:bounds[idx + 1]]
+                for idx, tag_value in enumerate(tag_values)}
+        # field_names -> array (num_assets, num_rlzs, num_fields)
+        self._values = {}
+
+    @classmethod
+    def from_npz(cls, npz, tag_names):
+        """
+        Build the aggregator from an extracted npz with an array for each
+        realization or statistic, indexing the given tags that are fields of
+        the records
+        """
+        rlzs_or_stats = [key for key in sorted(npz) if key not in NON_RLZ_KEYS]
+        records_by_rlz = OrderedDict(
+            (rlz_or_stat, npz[rlz_or_stat]) for rlz_or_stat in rlzs_or_stats)
+        field_names = records_by_rlz[rlzs_or_stats[0]].dtype.names
+        return cls(records_by_rlz, [tag_name for tag_name in tag_names
+                                    if tag_name in field_names])
+
+    def select(self, selection):
+        """
+        Select the assets having, for each tag of the selection, one of the
+        selected values of the tag
+
+        :param selection: dict {tag_name: list of tag values}
+        :returns: a boolean mask of the selected assets
+        :raises KeyError: if one of the tags is not indexed
+        """
+        mask = numpy.ones(self.num_assets, dtype=bool)
+        for tag_name, tag_values in selection.items():
+            tag_index = self.index[tag_name]
+            tag_mask = numpy.zeros(self.num_assets, dtype=bool)
+            for tag_value in tag_values:
+                tag_mask[tag_index.get(tag_value, _NO_ASSETS)] = True
+            mask &= tag_mask
+        return mask
+
+    def get_values(self, field_names):
+        """
+        :returns: a float64 array (num_assets, num_rlzs, num_fields)
+        :raises KeyError: if one of the fields is missing
+        """
+        field_names = tuple(field_names)
+        if field_names not in self._values:
+            for field_name in field_names:
+                if field_name not in self.records_by_rlz[
+                        self.rlzs_or_stats[0]].dtype.names:
+                    raise KeyError(field_name)
+            # NOTE: only the values of the latest fields are kept
+            self._values.clear()
+            self._values[field_names] = numpy.stack([
+                numpy.column_stack([
+                    numpy.asarray(records[field_name], dtype=numpy.float64)
+                    for field_name in field_names])
+                for records in self.records_by_rlz.values()], axis=1)
+        return self._values[field_names]
+
+    def aggregate(self, field_names, selection):
+        """
+        Sum the given fields over the selected assets
+
+        :returns: a float64 array (num_rlzs, num_fields), or None if no asset
+            is selected
+        """
+        values = self.get_values(field_names)
+        mask = self.select(selection)
+        if not mask.any():
+            return None
+        return values[mask].sum(axis=0)
+
+    def aggregate_by_tag(self, field_names, selection, tag_name):
+        """
+        Sum the given fields over the selected assets, separately for each
+        value of the given tag (or for each of its selected values, if any
+        value other than ALL_VALUES is selected). Values without any selected
+        asset are discarded.
+
+        :returns: (tag_values, array (num_tag_values, num_rlzs, num_fields))
+        """
+        values = self.get_values(field_names)
+        tag_index = self.index[tag_name]
+        tag_values = [tag_value for tag_value in selection.get(tag_name, ())
+                      if tag_value != ALL_VALUES]
+        if not tag_values:
+            tag_values = sorted(tag_index)
+        other_mask = self.select({
+            other_tag: other_values
+            for other_tag, other_values in selection.items()
+            if other_tag != tag_name})
+        aggregated_values = []
+        sums = []
+        for tag_value in tag_values:
+            asset_idxs = tag_index.get(tag_value, _NO_ASSETS)
+            asset_idxs = asset_idxs[other_mask[asset_idxs]]
+            if len(asset_idxs):
+                aggregated_values.append(tag_value)
+                sums.append(values[asset_idxs].sum(axis=0))
+        if not sums:
+            return [], numpy.zeros((0,) + values.shape[1:])
+        return aggregated_values, numpy.array(sums)
@@ -23,17 +23,94 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import math
-from numpy import mean, std, argwhere, amax, amin, log10, log
+
+import numpy
+from numpy import (mean, std, log10, log, exp, argsort, arange, empty,
+                   empty_like, full, flatnonzero, diff, append, cumsum,
+                   errstate, isinf, isfinite)
 from qgis.core import NULL
 
 from svir.utilities.utils import Register
 
+# list-based algorithms, each taking a list of values (possibly containing
+# missing values) and returning (transformed_values, invalid_input_values)
 TRANSFORMATION_ALGS = Register()
+# the corresponding columnar algorithms, each taking a float64 array and a
+# validity mask and returning (output, output_valid, invalid_idxs)
+COLUMNAR_TRANSFORMATION_ALGS = Register()
 RANK_VARIANTS = ('AVERAGE', 'MIN', 'MAX', 'DENSE', 'ORDINAL')
 QUADRATIC_VARIANTS = ('INCREASING', 'DECREASING')
 LOG10_VARIANTS = ('INCREMENT BY ONE IF ZEROS ARE FOUND',
                   'IGNORE ZEROS')
+NO_INVALID_IDXS = numpy.empty(0, dtype=numpy.int64)
+
+
+def to_column(input_values):
+    """
+    Convert a sequence of numbers, that might contain missing values (None or
+    NULL), into a float64 array and a boolean array telling which values are
+    valid (missing values are set to nan in the float64 array)
+
+    :param input_values: a sequence (or an iterable) of numbers
+    :returns: (values, valid)
+    """
+    input_values = list(input_values)
+    valid = numpy.array([value not in (None, NULL) for value in input_values],
+                        dtype=bool)
+    if valid.all():
+        values = numpy.array(input_values, dtype=numpy.float64)
+    else:
+        values = numpy.array(
+            [value if is_valid else numpy.nan
+             for value, is_valid in zip(input_values, valid)],
+            dtype=numpy.float64)
+    return values, valid
+
+
+def from_column(output, output_valid, valid, missing_value=None,
+                invalid_value=NULL):
+    """
+    Convert the output of a columnar transformation into a list
+
+    :param output: the float64 array produced by the transformation
+    :param output_valid: the boolean array telling which outputs are valid
+    :param valid: the boolean array telling which inputs were valid
+    :param missing_value: value to be used where the input was missing
+    :param invalid_value: value to be used where the input was valid, but
+                          it could not be transformed
+    :returns: a list of floats, containing missing_value or invalid_value
+              where the output is not valid
+    """
+    output_list = output.tolist()
+    for idx in flatnonzero(~output_valid):
+        output_list[idx] = invalid_value if valid[idx] else missing_value
+    return output_list
+
+
+def transform_column(values, valid, algorithm_name, variant_name="",
+                     inverse=False):
+    """
+    Use the chosen algorithm (and optional variant and/or inversion) on a
+    column of values, ignoring the missing ones
+
+    :param values: float64 array containing the values to transform
+    :param valid: boolean array, False where values are missing (values
+                  in those positions are ignored)
+    :param algorithm_name: the name of the transformation algorithm
+    :param variant_name: the (optional) variant to be used
+    :param inverse: a boolean (default False) to run the inverse function
+                    if available
+    :returns: (output, output_valid, invalid_idxs), where output is a float64
+              array, output_valid is a boolean array telling which outputs
+              are valid (outputs are not valid where inputs are missing or
+              where they could not be transformed) and invalid_idxs is the
+              array of indices of the valid inputs that could not be
+              transformed
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    valid = numpy.asarray(valid, dtype=bool)
+    algorithm = COLUMNAR_TRANSFORMATION_ALGS[algorithm_name]
+    return algorithm(values, valid, variant_name, inverse)
 
 
 def transform(features_dict, algorithm, variant_name="", inverse=False):
@@ -50,25 +127,111 @@ def transform(features_dict, algorithm, variant_name="", inverse=False):
                     if available
     :returns: (transformed_dict, invalid_input_values)
     """
-    # make a copy of the dictionary containing features (ids and values) and
-    # remove elements containing missing values, so the transformation is
-    # performed only on the subset of valid values
-    f_dict_copy = features_dict.copy()
-    # elements with null value will be saved in another dict, so they can be
-    # re-added afterwards
-    dict_of_null_values = {}
-    for key, value in f_dict_copy.items():
-        if type(value) in (NULL, type(None)):
-            dict_of_null_values[key] = value
-    for key in list(dict_of_null_values.keys()):
-        del f_dict_copy[key]
-    transformed_list, invalid_input_values = algorithm(
-        list(f_dict_copy.values()), variant_name, inverse)
-    transformed_dict = dict(
-        list(zip(list(f_dict_copy.keys()), transformed_list)))
-    # add to the transformed_dict the null elements that were removed
-    transformed_dict.update(dict_of_null_values)
-    return transformed_dict, invalid_input_values
+    algorithm_name = get_algorithm_name(algorithm)
+    input_values = list(features_dict.values())
+    values, valid = to_column(input_values)
+    output, output_valid, invalid_idxs = transform_column(
+        values, valid, algorithm_name, variant_name, inverse)
+    transformed_list = from_column(output, output_valid, valid)
+    # elements with null value keep their original value
+    for idx in flatnonzero(~valid):
+        transformed_list[idx] = input_values[idx]
+    transformed_dict = dict(zip(features_dict.keys(), transformed_list))
+    invalid_input_values = [input_values[idx] for idx in invalid_idxs]
+    return transformed_dict, invalid_input_values or None
+
+
+def get_algorithm_name(algorithm):
+    """
+    Get the name under which the given list-based algorithm is registered
+    in TRANSFORMATION_ALGS
+
+    :raises: KeyError if the algorithm is not registered
+    """
+    for algorithm_name, registered_algorithm in TRANSFORMATION_ALGS.items():
+        if registered_algorithm is algorithm:
+            return algorithm_name
+    raise KeyError('Transformation algorithm not found: %s' % algorithm)
+
+
+def _transform_list(input_values, algorithm_name, variant_name, inverse):
+    values, valid = to_column(input_values)
+    output, output_valid, invalid_idxs = transform_column(
+        values, valid, algorithm_name, variant_name, inverse)
+    invalid_input_values = [input_values[idx] for idx in invalid_idxs]
+    return (from_column(output, output_valid, valid),
+            invalid_input_values or None)
+
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('RANK')
+def rank_column(values, valid, variant_name="AVERAGE", inverse=False):
+    """
+    Columnar version of rank (see its documentation). The input values are
+    sorted only once (with a stable sort), then the rank of each value is
+    obtained from the position and the size of the group of ties it belongs
+    to.
+    """
+    if variant_name not in RANK_VARIANTS:
+        raise NotImplementedError(
+            "%s variant not implemented" % variant_name)
+    output = full(len(values), numpy.nan)
+    valid_values = values[valid]
+    len_values = len(valid_values)
+    if not len_values:
+        return output, valid.copy(), NO_INVALID_IDXS
+    if not inverse:  # high values get high ranks
+        order = argsort(valid_values, kind='stable')
+    else:  # inverse, i.e., small inputs get high ranks
+        # sort by decreasing value, keeping ties in their original order,
+        # so the leftmost tie is still the first one to be ranked
+        order = (len_values - 1 -
+                 argsort(valid_values[::-1], kind='stable'))[::-1]
+    sorted_values = valid_values[order]
+    # each group of ties starts where the sorted value changes
+    is_group_start = empty(len_values, dtype=bool)
+    is_group_start[0] = True
+    is_group_start[1:] = sorted_values[1:] != sorted_values[:-1]
+    group_starts = flatnonzero(is_group_start)
+    group_sizes = diff(append(group_starts, len_values))
+    group_idxs = cumsum(is_group_start) - 1
+    # for each sorted position, the position where its group of ties starts
+    # and how many ties the group contains
+    start = group_starts[group_idxs]
+    size = group_sizes[group_idxs]
+    if variant_name == "AVERAGE":
+        # e.g., if 4 inputs are equal, and they would receive
+        # ranks from 3 to 6, all of them will obtain rank 4.5
+        # Afterwards the ranks increase from 7 on.
+        # NOTE: the same operations as in the previous implementation are
+        #       used, in order to obtain exactly the same floats
+        if not inverse:
+            sorted_ranks = (2 * (start + 1) + size - 1) / 2.0
+        else:
+            sorted_ranks = len_values - (
+                2 * (len_values - start) - size - 1) / 2.0
+    elif variant_name == "MIN":
+        # e.g., if 4 inputs are equal, and they would receive
+        # ranks from 3 to 6, all of them will obtain rank 3.
+        # Afterwards the ranks increase from 7 on.
+        sorted_ranks = start + 1
+    elif variant_name == "MAX":
+        # e.g., if 4 inputs are equal, and they would receive
+        # ranks from 3 to 6, all of them will obtain rank 6
+        # Afterwards the ranks increase from 7 on.
+        sorted_ranks = start + size
+    elif variant_name == "DENSE":
+        # the same as for "MIN", but instead of ranking the
+        # next elements counting from 7 on, the ranks will
+        # increase from 4 on (no "jumps").
+        sorted_ranks = group_idxs + 1
+    else:  # "ORDINAL"
+        # the ties are ranked in a "ordinal" way, assigning
+        # the smallest rank to the leftmost tie found, and so on.
+        sorted_ranks = arange(1, len_values + 1)
+    ranks = empty_like(sorted_ranks)
+    ranks[order] = sorted_ranks
+    output[valid] = ranks
+    return output, valid.copy(), NO_INVALID_IDXS
 
 
 @TRANSFORMATION_ALGS.add('RANK')
@@ -84,98 +247,37 @@ def rank(input_values, variant_name="AVERAGE", inverse=False):
     :param inverse: instead of giving the highest rank to the biggest
                     input value, give the highest rank to the smallest
                     input value
-    :returns: list of ranks corresponding to the input data
+    :returns: list of ranks corresponding to the input data (missing
+              values are not ranked and they produce None)
     :raises: NotImplementedError if variant_name is not implemented
     """
-    input_copy = input_values[:]
-    len_input_values = len(input_values)
-    rank_list = [0] * len_input_values
-    previous_ties = 0
-    if not inverse:  # high values get high ranks
-        # obtain a value above the maximum value contained in input_values,
-        # so it will never be picked as the minimum element of the list
-        above_max_input = max([value for value in input_values]) + 1
-        curr_idx = 1
-        while curr_idx <= len_input_values:
-            # get the list of indices of the min elements of input_copy.
-            # note that we might have ties.
-            bottom_indices = argwhere(
-                input_copy == amin(input_copy)).flatten().tolist()
-            bottom_amount = len(bottom_indices)
-            for bottom_idx in bottom_indices:
-                if variant_name == "AVERAGE":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 4.5
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = \
-                        (2 * curr_idx + bottom_amount - 1) / 2.0
-                elif variant_name == "MIN":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 3.
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = curr_idx
-                elif variant_name == "MAX":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 6
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = curr_idx + bottom_amount - 1
-                elif variant_name == "DENSE":
-                    # the same as for "MIN", but instead of ranking the
-                    # next elements counting from 7 on, the ranks will
-                    # increase from 4 on (no "jumps").
-                    rank_list[bottom_idx] = curr_idx - previous_ties
-                elif variant_name == "ORDINAL":
-                    # the ties are ranked in a "ordinal" way, assigning
-                    # the smallest rank to the leftmost tie found, and so on.
-                    rank_list[bottom_idx] = curr_idx
-                    curr_idx += 1
-                else:
-                    raise NotImplementedError(
-                        "%s variant not implemented" % variant_name)
-                # "discard" the tie, so it will not be found as the min in
-                # the next iteration (instead of removing it, which would
-                # modify the list indices, I make it bigger than the
-                # biggest input)
-                input_copy[bottom_idx] = above_max_input
-            if variant_name != "ORDINAL":
-                # necessary adjustment in case of "ORDINAL"
-                curr_idx += bottom_amount
-            # necessary for the "DENSE" variant, to keep a count of ties
-            previous_ties += bottom_amount - 1
+    values, valid = to_column(input_values)
+    output, output_valid, _ = rank_column(
+        values, valid, variant_name, inverse)
+    if variant_name != "AVERAGE":
+        # all variants but AVERAGE produce integer ranks
+        output = numpy.where(output_valid, output, 0).astype(numpy.int64)
+    return from_column(output, output_valid, valid), None
 
-    else:  # inverse, i.e., small inputs get high ranks
-        # same as the direct methods, but proceeding top->down
-        below_min_input = min([value if value not in (None, NULL) else None
-                              for value in input_values]) - 1
-        curr_idx = len_input_values
-        while curr_idx > 0:
-            top_indices = argwhere(
-                input_copy == amax(input_copy)).flatten().tolist()
-            top_amount = len(top_indices)
-            for top_idx in top_indices:
-                if variant_name == "AVERAGE":
-                    rank_list[top_idx] = (
-                        len_input_values - (2 * curr_idx - top_amount - 1) /
-                        2.0)
-                elif variant_name == "MIN":
-                    rank_list[top_idx] = len_input_values - curr_idx + 1
-                elif variant_name == "MAX":
-                    rank_list[top_idx] = (
-                        len_input_values - curr_idx + top_amount)
-                elif variant_name == "DENSE":
-                    rank_list[top_idx] = \
-                        len_input_values - curr_idx - previous_ties + 1
-                elif variant_name == "ORDINAL":
-                    rank_list[top_idx] = len_input_values - curr_idx + 1
-                    curr_idx -= 1
-                else:
-                    raise NotImplementedError(
-                        "%s variant not implemented" % variant_name)
-                input_copy[top_idx] = below_min_input
-            if variant_name != "ORDINAL":
-                curr_idx -= top_amount
-            previous_ties += top_amount - 1
-    return rank_list, None
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('Z_SCORE')
+def z_score_column(values, valid, variant_name=None, inverse=False):
+    """
+    Columnar version of z_score (see its documentation)
+    """
+    if variant_name:
+        raise NotImplementedError("%s variant not implemented" % variant_name)
+    valid_values = values[valid]
+    mean_val = mean(valid_values)
+    stddev_val = std(valid_values)
+    if stddev_val == 0:
+        raise ValueError("The Z-Score transformation can not be performed "
+                         "if the standard deviation of the input values is 0")
+    if inverse:
+        # multiply each input element by -1
+        values = -values
+    output = (values - mean_val) / stddev_val
+    return output, valid.copy(), NO_INVALID_IDXS
 
 
 @TRANSFORMATION_ALGS.add('Z_SCORE')
@@ -186,27 +288,29 @@ def z_score(input_values, variant_name=None, inverse=False):
     Inverse:
         Multiply each input by -1, before doing exactly the same
     """
+    return _transform_list(input_values, 'Z_SCORE', variant_name, inverse)
+
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('MIN_MAX')
+def min_max_column(values, valid, variant_name=None, inverse=False):
+    """
+    Columnar version of min_max (see its documentation)
+    """
     if variant_name:
         raise NotImplementedError("%s variant not implemented" % variant_name)
-    mean_val = mean([value for value in input_values
-                     if value not in (None, NULL)])
-    stddev_val = std([value for value in input_values
-                      if value not in (None, NULL)])
-    if stddev_val == 0:
-        raise ValueError("The Z-Score transformation can not be performed "
-                         "if the standard deviation of the input values is 0")
-    input_copy = input_values[:]
+    valid_values = values[valid]
+    min_value = valid_values.min()
+    max_value = valid_values.max()
+    # Get the range of the list
+    min_max_range = float(max_value - min_value)
+    if min_max_range == 0:
+        raise ValueError("The min_max transformation can not be performed"
+                         " if the range of valid values (max-min) is zero.")
+    # Transform
+    output = (values - min_value) / min_max_range
     if inverse:
-        # multiply each input_values element by -1
-        input_copy[:] = [-x
-                         if x not in (None, NULL)
-                         else None
-                         for x in input_values]
-    output_values = [
-        float((x - mean_val) / stddev_val)
-        if x not in (None, NULL) else None
-        for x in input_copy]
-    return output_values, None
+        output = 1.0 - output
+    return output, valid.copy(), NO_INVALID_IDXS
 
 
 @TRANSFORMATION_ALGS.add('MIN_MAX')
@@ -217,27 +321,33 @@ def min_max(input_values, variant_name=None, inverse=False):
     Inverse:
         :math:`f(x_i) = 1 - \frac{x_i - \min(x)}{\max(x) - \min(x)}`
     """
-    if variant_name:
-        raise NotImplementedError("%s variant not implemented" % variant_name)
-    min_value = min((value for value in input_values
-                    if value not in (None, NULL)))
-    max_value = max((value for value in input_values
-                    if value not in (None, NULL)))
-    # Get the range of the list
-    min_max_range = float(max_value - min_value)
-    if min_max_range == 0:
-        raise ValueError("The min_max transformation can not be performed"
-                         " if the range of valid values (max-min) is zero.")
-    # Transform
+    return _transform_list(input_values, 'MIN_MAX', variant_name, inverse)
+
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('LOG10')
+def log10_column(values, valid, variant_name='IGNORE ZEROS', inverse=False):
+    """
+    Columnar version of log10_ (see its documentation)
+    """
     if inverse:
-        output_values = [1.0 - ((x - min_value) / min_max_range)
-                         if x not in (None, NULL) else None
-                         for x in input_values]
-    else:
-        output_values = [(x - min_value) / min_max_range
-                         if x not in (None, NULL) else None
-                         for x in input_values]
-    return output_values, None
+        raise NotImplementedError(
+            "Inverse transformation for log10 is not implemented")
+    if variant_name not in LOG10_VARIANTS:
+        raise NotImplementedError(
+            "%s variant not implemented" % variant_name)
+    output_valid = valid.copy()
+    is_zero = valid & (values == 0)
+    # NOTE: negative inputs produce nan
+    with errstate(divide='ignore', invalid='ignore'):
+        if is_zero.any():
+            if variant_name == 'INCREMENT BY ONE IF ZEROS ARE FOUND':
+                output = log10(values + 1)
+            else:  # 'IGNORE ZEROS'
+                output = log10(values)
+                output_valid &= ~is_zero
+        else:
+            output = log10(values)
+    return output, output_valid, NO_INVALID_IDXS
 
 
 @TRANSFORMATION_ALGS.add('LOG10')
@@ -256,34 +366,31 @@ def log10_(input_values,
     Then use numpy.log10 function to perform the log10 transformation on the
     list of values
     """
+    return _transform_list(input_values, 'LOG10', variant_name, inverse)
+
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('QUADRATIC')
+def simple_quadratic_column(values, valid, variant_name="INCREASING",
+                            inverse=False):
+    """
+    Columnar version of simple_quadratic (see its documentation)
+    """
+    bottom = 0.0
+    max_input = values[valid].max()
+    if max_input - bottom == 0:
+        raise ZeroDivisionError("It is impossible to perform the "
+                                "transformation if the maximum "
+                                "input value is 0")
+    squared_range = (max_input - bottom) ** 2
+    if variant_name == "INCREASING":
+        output = (values - bottom) ** 2 / squared_range
+    elif variant_name == "DECREASING":
+        output = (max_input - (values - bottom)) ** 2 / squared_range
+    else:
+        raise NotImplementedError("%s variant not implemented" % variant_name)
     if inverse:
-        raise NotImplementedError(
-            "Inverse transformation for log10 is not implemented")
-    if variant_name not in LOG10_VARIANTS:
-        raise NotImplementedError(
-            "%s variant not implemented" % variant_name)
-    if any(n == 0 for n in input_values):
-        if variant_name == 'INCREMENT BY ONE IF ZEROS ARE FOUND':
-            corrected_input = [input_value + 1 for input_value in input_values]
-            output_values = [
-                float(value) if value not in (None, NULL) else None
-                for value in list(log10(corrected_input))]
-            return output_values, None
-        elif variant_name == 'IGNORE ZEROS':
-            output_values = []
-            for input_value in input_values:
-                if input_value in (0, NULL):
-                    output_value = NULL
-                    output_values.append(output_value)
-                else:
-                    output_values.append(log10(input_value))
-            for i, value in enumerate(output_values):
-                if value in (NULL, None):
-                    continue
-                output_values[i] = float(value)
-            return output_values, None
-    output_values = [float(value) for value in list(log10(input_values))]
-    return output_values, None
+        output = 1.0 - output
+    return output, valid.copy(), NO_INVALID_IDXS
 
 
 @TRANSFORMATION_ALGS.add('QUADRATIC')
@@ -298,25 +405,29 @@ def simple_quadratic(input_values, variant_name="INCREASING", inverse=False):
     Inverse:
         For each output x, the final output will be 1 - x
     """
-    bottom = 0.0
-    max_input = max(input_values)
-    if max_input - bottom == 0:
-        raise ZeroDivisionError("It is impossible to perform the "
-                                "transformation if the maximum "
-                                "input value is 0")
-    squared_range = (max_input - bottom) ** 2
-    if variant_name == "INCREASING":
-        output_values = [
-            (x - bottom) ** 2 / squared_range for x in input_values]
-    elif variant_name == "DECREASING":
-        output_values = [(max_input - (x - bottom)) ** 2 / squared_range
-                         for x in input_values]
+    return _transform_list(input_values, 'QUADRATIC', variant_name, inverse)
 
-    else:
+
+@COLUMNAR_TRANSFORMATION_ALGS.add('SIGMOID')
+def sigmoid_column(values, valid, variant_name="", inverse=False):
+    """
+    Columnar version of sigmoid (see its documentation). Inputs for which
+    the function can not be computed (e.g. 1 for the inverse function, or
+    inputs for which the exponential would overflow for the direct one) are
+    reported as invalid.
+    """
+    if variant_name:
         raise NotImplementedError("%s variant not implemented" % variant_name)
-    if inverse:
-        output_values[:] = [1.0 - x for x in output_values]
-    return output_values, None
+    with errstate(over='ignore', divide='ignore', invalid='ignore'):
+        if inverse:
+            output = log(values / (1 - values))
+            computable = values != 1
+        else:  # direct
+            exp_values = exp(-values)
+            output = 1 / (1 + exp_values)
+            computable = ~(isinf(exp_values) & isfinite(values))
+    invalid = valid & ~computable
+    return output, valid & computable, flatnonzero(invalid)
 
 
 @TRANSFORMATION_ALGS.add('SIGMOID')
@@ -328,24 +439,4 @@ def sigmoid(input_values, variant_name="", inverse=False):
     Inverse function:
         :math:`f(x) = \ln(\frac{x}{1-x})`
     """
-    if variant_name:
-        raise NotImplementedError("%s variant not implemented" % variant_name)
-    output_values = []
-    invalid_input_values = []
-    if inverse:
-        for y in input_values:
-            try:
-                output = float(log(y / (1 - y)))
-            except Exception:
-                output = NULL
-                invalid_input_values.append(y)
-            output_values.append(output)
-    else:  # direct
-        for x in input_values:
-            try:
-                output = float(1 / (1 + math.exp(-x)))
-            except Exception:
-                output = NULL
-                invalid_input_values.append(x)
-            output_values.append(output)
-    return output_values, invalid_input_values
+    return _transform_list(input_values, 'SIGMOID', variant_name, inverse)
@@ -35,6 +35,7 @@ import numpy
 from qgis.PyQt.QtCore import (QDir,
                               Qt,
                               QTimer,
+                              QModelIndex,
                               pyqtSlot,
                               QRegExp,
                               QSettings)
@@ -46,11 +47,10 @@ from qgis.PyQt.QtWidgets import (QDialog,
                                  QFileDialog,
                                  QInputDialog,
                                  QMessageBox)
-from qgis.PyQt.QtGui import QColor, QBrush, QRegExpValidator
+from qgis.PyQt.QtGui import QRegExpValidator
 from qgis.gui import QgsMessageBar
 from qgis.core import QgsTask, QgsApplication
 
-from requests import Session
 from requests.exceptions import (ConnectionError,
                                  InvalidSchema,
                                  MissingSchema,
@@ -80,6 +80,13 @@ from svir.utilities.utils import (WaitCursorManager,
                                   ServerError,
                                   RedirectionError,
                                   )
+from svir.utilities.engine_client import EngineSession
+from svir.ui.calc_list_model import (CalcListModel,
+                                     CalcActionsDelegate,
+                                     CALC_ACTIONS,
+                                     CALC_COLUMNS,
+                                     CALC_ID_COLUMN,
+                                     )
 from svir.dialogs.load_ruptures_as_layer_dialog import (
     LoadRupturesAsLayerDialog)
 from svir.dialogs.load_csv_as_layer_dialog import (
@@ -191,6 +198,26 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         self.message_bar = QgsMessageBar(self)
         self.layout().insertWidget(0, self.message_bar)
 
+        # NOTE: the list of calculations is polled every few seconds, so
+        #       the model updates only the rows that changed, and the buttons
+        #       are drawn by a delegate instead of being widgets
+        self.calc_list_model = CalcListModel(self)
+        self.calc_list_tbl.setModel(self.calc_list_model)
+        # NOTE: only the rows added by a refresh are resized
+        self.calc_list_model.rowsInserted.connect(self.on_calc_rows_inserted)
+        self.calc_list_model.modelReset.connect(
+            self.calc_list_tbl.resizeRowsToContents)
+        self.calc_actions_delegate = CalcActionsDelegate(self.calc_list_tbl)
+        self.calc_actions_delegate.action_clicked.connect(
+            self.on_calc_action_btn_clicked)
+        for col in range(len(CALC_COLUMNS),
+                         len(CALC_COLUMNS) + len(CALC_ACTIONS)):
+            self.calc_list_tbl.setItemDelegateForColumn(
+                col, self.calc_actions_delegate)
+            self.calc_list_tbl.setColumnWidth(col, BUTTON_WIDTH)
+        self.calc_list_tbl.horizontalHeader().setStyleSheet(
+            "font-weight: bold;")
+        self.set_calc_list_widths(self.col_widths)
         self.calc_list_tbl.horizontalHeader().sectionResized.connect(
             self.on_column_resized)
 
@@ -208,6 +235,10 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             # ignoring columns with buttons
             self.col_widths[index] = new_size
 
+    def on_calc_rows_inserted(self, parent, first, last):
+        for row in range(first, last + 1):
+            self.calc_list_tbl.resizeRowToContents(row)
+
     def on_job_id_chosen(self):
         try:
             job_id = int(self.retrieve_job_by_id_le.text())
@@ -269,7 +300,8 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             log_msg(msg, level='W', message_bar=self.message_bar)
 
     def login(self):
-        self.session = Session()
+        self.log_request_metrics()
+        self.session = EngineSession()
         if not self.forced_hostname:
             self.hostname, username, password = get_credentials()
         # try without authentication (if authentication is disabled server
@@ -294,7 +326,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             try:
                 # FIXME: enable the user to set verify=True
                 resp = self.session.get(
-                    engine_version_url, timeout=10, verify=False,
+                    engine_version_url, verify=False,
                     allow_redirects=False, stream=True)
                 if resp.status_code == 302:
                     raise RedirectionError(
@@ -319,7 +351,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         try:
             # FIXME: enable the user to set verify=True
             resp = self.session.get(
-                calc_list_url, timeout=10, verify=False,
+                calc_list_url, verify=False,
                 allow_redirects=False, stream=True)
             if resp.status_code == 404:
                 raise FileNotFoundError(
@@ -352,123 +384,36 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             self.calc_list = [self.calc_list]
             self.current_calc_id = self.pointed_calc_id = int(job_id)
             self.update_output_list(int(job_id))
-        selected_keys = [
-            'description', 'id', 'calculation_mode', 'owner', 'status']
-        col_names = [
-            'Description', 'Job ID', 'Calculation Mode', 'Owner', 'Status']
+        self.calc_list_model.update_calcs(self.calc_list)
+        if self.pointed_calc_id:
+            # NOTE: the selection follows the rows that are inserted or
+            # removed, so the view is scrolled only if the pointed
+            # calculation is not selected yet (or if it disappeared)
+            selected_rows = [
+                index.row() for index in
+                self.calc_list_tbl.selectionModel().selectedRows()]
+            if (self.calc_list_model.row_of(self.pointed_calc_id)
+                    not in selected_rows):
+                self.highlight_and_scroll_to_calc_id(self.pointed_calc_id)
         if not self.calc_list:
-            self.calc_list_tbl.blockSignals(True)
-            if self.calc_list_tbl.rowCount() > 0:
-                self.calc_list_tbl.clearContents()
-                self.calc_list_tbl.setRowCount(0)
-            else:
-                self.calc_list_tbl.setRowCount(0)
-                self.calc_list_tbl.setColumnCount(len(col_names))
-                self.calc_list_tbl.setHorizontalHeaderLabels(col_names)
-                self.calc_list_tbl.horizontalHeader().setStyleSheet(
-                    "font-weight: bold;")
-                self.set_calc_list_widths(self.col_widths)
-            self.calc_list_tbl.blockSignals(False)
             return False
-        actions = [
-            {'label': 'Console', 'bg_color': '#3cb3c5', 'txt_color': 'white'},
-            {'label': 'Remove', 'bg_color': '#d9534f', 'txt_color': 'white'},
-            {'label': 'Outputs', 'bg_color': '#3cb3c5', 'txt_color': 'white'},
-            {'label': 'Continue', 'bg_color': 'white', 'txt_color': 'black'},
-            {'label': 'Abort', 'bg_color': '#d9534f', 'txt_color': 'white'},
-        ]
-        self.calc_list_tbl.blockSignals(True)
-        self.calc_list_tbl.clearContents()
-        self.calc_list_tbl.setRowCount(len(self.calc_list))
-        self.calc_list_tbl.setColumnCount(len(selected_keys) + len(actions))
-        for row, calc in enumerate(self.calc_list):
-            calc_status = calc['status']
-            for col, key in enumerate(selected_keys):
-                item = QTableWidgetItem()
-                try:
-                    value = self.calc_list[row][key]
-                except KeyError:
-                    # from engine2.5 to engine2.6, job_type was changed into
-                    # calculation_mode. This check prevents the plugin to break
-                    # wnen using an old version of the engine.
-                    if key == 'calculation_mode':
-                        value = 'unknown'
-                    else:
-                        # if any other unexpected keys are used, it is safer to
-                        # raise a KeyError
-                        raise
-                item.setData(Qt.DisplayRole, value)
-                # set default colors
-                row_bg_color = Qt.white
-                row_txt_color = Qt.black
-                if calc_status == 'failed':
-                    row_bg_color = QColor('#f2dede')
-                elif calc_status in ['complete', 'shared']:
-                    row_bg_color = QColor('#dff0d8')
-                item.setBackground(row_bg_color)
-                item.setForeground(QBrush(row_txt_color))
-                self.calc_list_tbl.setItem(row, col, item)
-            for col, action in enumerate(actions, len(selected_keys)):
-                btn_lbl = action['label']
-
-                # Do not display the Abort button unless the calc is running
-                if btn_lbl == 'Abort' and not calc['is_running']:
-                    continue
-
-                # Display the Remove button only if calc is failed, complete or shared
-                if btn_lbl == 'Remove' and calc_status not in ('failed',
-                                                               'complete',
-                                                               'shared'):
-                    continue
-
-                # Display the Outputs and Continue buttons
-                # only if the calc is complete or shared
-                if (btn_lbl in ('Outputs', 'Continue') and
-                        calc_status not in ['complete', 'shared']):
-                    continue
-
-                button = QPushButton()
-                button.setText(btn_lbl)
-                style = 'background-color: %s; color: %s' % (
-                    action['bg_color'], action['txt_color'])
-                button.setStyleSheet(style)
-                button.clicked.connect(lambda checked=False, calc_id=calc['id'], action=btn_lbl: (  # NOQA
-                    self.on_calc_action_btn_clicked(calc_id, action)))
-                self.calc_list_tbl.setCellWidget(row, col, button)
-                self.calc_list_tbl.setColumnWidth(col, BUTTON_WIDTH)
-        empty_col_names = [''] * len(actions)
-        headers = col_names + empty_col_names
-        self.calc_list_tbl.setHorizontalHeaderLabels(headers)
-        self.calc_list_tbl.horizontalHeader().setStyleSheet(
-            "font-weight: bold;")
-        self.set_calc_list_widths(self.col_widths)
-        if self.pointed_calc_id:
-            self.highlight_and_scroll_to_calc_id(self.pointed_calc_id)
         # if a running calculation is selected, the corresponding outputs will
         # be displayed (once) automatically at completion
         if (self.pointed_calc_id and
                 self.output_list_tbl.rowCount() == 0):
             self.update_output_list(self.pointed_calc_id)
-        self.calc_list_tbl.blockSignals(False)
         return True
 
     def get_row_by_calc_id(self, calc_id):
-        # find QTableItem corresponding to that calc_id
-        calc_id_col_idx = 1
-        for row in range(self.calc_list_tbl.rowCount()):
-            item_calc_id = self.calc_list_tbl.item(row, calc_id_col_idx)
-            if int(item_calc_id.text()) == calc_id:
-                return row
-        return None
+        return self.calc_list_model.row_of(calc_id)
 
     def highlight_and_scroll_to_calc_id(self, calc_id):
         row = self.get_row_by_calc_id(calc_id)
         if row is not None:
             self.calc_list_tbl.selectRow(row)
-            calc_id_col_idx = 1
-            item_calc_id = self.calc_list_tbl.item(row, calc_id_col_idx)
-            self.calc_list_tbl.scrollToItem(
-                item_calc_id, QAbstractItemView.PositionAtCenter)
+            self.calc_list_tbl.scrollTo(
+                self.calc_list_model.index(row, CALC_ID_COLUMN),
+                QAbstractItemView.PositionAtCenter)
         else:
             self.pointed_calc_id = None
             self.calc_list_tbl.clearSelection()
@@ -580,7 +525,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             try:
                 # FIXME: enable the user to set verify=True
                 resp = self.session.get(
-                    calc_log_url, timeout=10, verify=False, stream=True)
+                    calc_log_url, verify=False, stream=True)
             except HANDLED_EXCEPTIONS as exc:
                 self._handle_exception(exc)
                 return exc
@@ -602,7 +547,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             try:
                 # FIXME: enable the user to set verify=True
                 resp = self.session.get(
-                    calc_status_url, timeout=10, verify=False, stream=True)
+                    calc_status_url, verify=False, stream=True)
             except HANDLED_EXCEPTIONS as exc:
                 self._handle_exception(exc)
                 return exc
@@ -619,7 +564,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         msg = 'Aborting calculation...' if abort else 'Removing calculation...'
         with WaitCursorManager(msg, self.message_bar):
             try:
-                resp = self.session.post(url, timeout=10, stream=True)
+                resp = self.session.post(url, stream=True)
             except HANDLED_EXCEPTIONS as exc:
                 self._handle_exception(exc)
                 return exc
@@ -735,8 +680,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
                                 run_calc_url, files, data),
                             level='I', print_to_stderr=True)
                     resp = self.session.post(
-                        run_calc_url, files=files, data=data, timeout=20,
-                        stream=True)
+                        run_calc_url, files=files, data=data, stream=True)
                 except HANDLED_EXCEPTIONS as exc:
                     self._handle_exception(exc)
                     return exc
@@ -755,7 +699,7 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         data = {'filename': checksum_file_path, 'checksum': str(ipt_checksum)}
         try:
             resp = self.session.post(
-                on_same_fs_url, data=data, timeout=20, stream=True)
+                on_same_fs_url, data=data, stream=True)
         except HANDLED_EXCEPTIONS as exc:
             self._handle_exception(exc)
             return False
@@ -768,11 +712,13 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         else:
             return result
 
-    @pyqtSlot(int, int)
-    def on_calc_list_tbl_cellClicked(self, row, column):
-        calc_id_col_idx = 1
-        item_calc_id = self.calc_list_tbl.item(row, calc_id_col_idx)
-        calc_id = int(item_calc_id.text())
+    @pyqtSlot(QModelIndex)
+    def on_calc_list_tbl_clicked(self, index):
+        if index.column() >= len(CALC_COLUMNS):
+            # clicks on buttons are handled by the delegate
+            return
+        row = index.row()
+        calc_id = self.calc_list_model.calc_id(row)
         if (self.pointed_calc_id is not None
                 and self.pointed_calc_id == calc_id):
             self.pointed_calc_id = None
@@ -831,8 +777,8 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         with WaitCursorManager():
             try:
                 # FIXME: enable the user to set verify=True
-                resp = self.session.get(output_list_url, timeout=10,
-                                        verify=False, stream=True)
+                resp = self.session.get(output_list_url, verify=False,
+                                        stream=True)
             except HANDLED_EXCEPTIONS as exc:
                 self._handle_exception(exc)
                 return exc
@@ -1155,6 +1101,18 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         # QObject.disconnect(self.timer, SIGNAL('timeout()'))
         self.is_polling = False
         self.reconnect_btn.setEnabled(True)
+        self.log_request_metrics()
+
+    def log_request_metrics(self):
+        # NOTE: the counters are reset, so each message summarizes the
+        #       requests made since the previous one
+        if self.session is None:
+            return
+        metrics = self.session.metrics
+        if metrics.summary():
+            log_msg('Requests to the OpenQuake Engine server %s:\n%s' % (
+                self.hostname, metrics))
+            metrics.reset()
 
     @pyqtSlot()
     def on_run_calc_btn_clicked(self):
@@ -26,9 +26,9 @@ from qgis.PyQt.QtWidgets import (
     QGroupBox, QVBoxLayout, QHBoxLayout, QRadioButton, QCheckBox, QWidget,
     QLabel, QDialog)
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication,)
+    QgsTask, QgsApplication,)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
-from svir.utilities.utils import WaitCursorManager, log_msg
+from svir.utilities.utils import log_msg
 from svir.ui.multi_select_combo_box import MultiSelectComboBox
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
@@ -37,6 +37,9 @@ class LoadAssetRiskAsLayerDialog(LoadOutputAsLayerDialog):
     """
     Dialog to load asset_risk from an oq-engine output, as layer
     """
+
+    use_npz_provider = True
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock, session, hostname,
                  calc_id, output_type='asset_risk', path=None, mode=None,
                  engine_version=None, calculation_mode=None):
@@ -199,25 +202,14 @@ class LoadAssetRiskAsLayerDialog(LoadOutputAsLayerDialog):
         return field_types
 
     def read_npz_into_layer(self, field_types, **kwargs):
-        with edit(self.layer):
-            lons = self.dataset['lon']
-            lats = self.dataset['lat']
-            feats = []
-            for row_idx, row in enumerate(self.dataset):
-                # add a feature
-                feat = QgsFeature(self.layer.fields())
-                for field_name in field_types:
-                    value = row[field_name].item()
-                    if isinstance(value, bytes):
-                        value = value.decode('utf8')
-                    feat.setAttribute(field_name, value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(lons[row_idx], lats[row_idx])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        columns = {field_name: self.dataset[field_name]
+                   for field_name in field_types}
+        added_ok = self.add_features_from_columns(
+            self.layer, columns,
+            lons=self.dataset['lon'], lats=self.dataset['lat'])
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def accept(self):
@@ -249,12 +241,18 @@ class LoadAssetRiskAsLayerDialog(LoadOutputAsLayerDialog):
     def on_asset_risk_downloaded(self, extracted_npz):
         self.npz_file = extracted_npz
         self.dataset = self.npz_file['array']
-        with WaitCursorManager('Creating layer...', self.iface.messageBar()):
-            self.layer = self.build_layer()
-            self.style_maps(
-                self.layer, self.default_field_name,
-                self.iface, self.output_type, perils=self.perils,
-                render_higher_on_top=self.higher_on_top_chk.isChecked())
+        self.build_layers_in_task(
+            [{}], self.on_asset_risk_layer_built,
+            self.on_asset_risk_layers_completed)
+
+    def on_asset_risk_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer)
+        self.style_maps(
+            layer, self.default_field_name,
+            self.iface, self.output_type, perils=self.perils,
+            render_higher_on_top=self.higher_on_top_chk.isChecked())
+
+    def on_asset_risk_layers_completed(self):
         if (self.zonal_layer_cbx.currentText()
                 and self.zonal_layer_gbx.isChecked()):
             self.aggregate_by_zone()
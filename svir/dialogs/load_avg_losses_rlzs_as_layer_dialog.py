@@ -23,9 +23,8 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy
-import collections
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication)
+    QgsTask, QgsApplication)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
 from svir.utilities.utils import WaitCursorManager, log_msg, get_loss_types
 from svir.tasks.extract_npz_task import ExtractNpzTask
@@ -142,33 +141,24 @@ class LoadAvgLossesRlzsAsLayerDialog(LoadOutputAsLayerDialog):
         rlz_or_stat = kwargs['rlz_or_stat']
         loss_type = kwargs['loss_type']
         taxonomy = kwargs['taxonomy']
-        with edit(self.layer):
-            feats = []
-            grouped_by_site = self.group_by_site(
-                self.npz_file, rlz_or_stat, loss_type, taxonomy)
-            for row in grouped_by_site:
-                # add a feature
-                feat = QgsFeature(self.layer.fields())
-                field_idx = 0
-                for field_name, field_type in field_types.items():
-                    if field_name in ['lon', 'lat']:
-                        field_idx += 1
-                        continue
-                    value = row[field_idx].item()
-                    if isinstance(value, bytes):
-                        value = value.decode('utf8')
-                    feat.setAttribute(field_name, value)
-                    field_idx += 1
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(row['lon'], row['lat'])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        grouped_by_site = self.group_by_site(
+            self.npz_file, rlz_or_stat, loss_type, taxonomy)
+        # NOTE: fields of grouped_by_site correspond positionally to
+        # field_types
+        columns = {
+            field_name: grouped_by_site[grouped_by_site.dtype.names[idx]]
+            for idx, field_name in enumerate(field_types)
+            if field_name not in ['lon', 'lat']}
+        added_ok = self.add_features_from_columns(
+            self.layer, columns,
+            lons=grouped_by_site['lon'], lats=grouped_by_site['lat'])
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def load_from_npz(self):
+        layers_kwargs = []
         for rlz_or_stat in self.rlzs_or_stats:
             if (self.load_selected_only_ckb.isChecked()
                     and rlz_or_stat != self.rlz_or_stat_cbx.currentData()):
@@ -181,29 +171,27 @@ class LoadAvgLossesRlzsAsLayerDialog(LoadOutputAsLayerDialog):
                     if (self.load_selected_only_ckb.isChecked()
                             and loss_type != self.loss_type_cbx.currentText()):
                         continue
-                    with WaitCursorManager(
-                            'Creating layer for "%s", '
-                            ' taxonomy "%s" and loss type "%s"...' % (
-                            rlz_or_stat, taxonomy, loss_type),
-                            self.iface.messageBar()):
-                        self.layer = self.build_layer(
-                            rlz_or_stat, taxonomy=taxonomy,
-                            loss_type=loss_type)
-                        self.style_maps(self.layer,
-                                        self.default_field_name,
-                                        self.iface, self.output_type)
+                    layers_kwargs.append(dict(
+                        rlz_or_stat=rlz_or_stat, taxonomy=taxonomy,
+                        loss_type=loss_type))
+        self.build_layers_in_task(
+            layers_kwargs, self.on_avg_losses_layer_built)
+
+    def on_avg_losses_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer)
+        self.style_maps(layer, self.default_field_name,
+                        self.iface, self.output_type)
 
     def group_by_site(self, npz, rlz_or_stat, loss_type, taxonomy='All'):
         # example:
         # npz = numpy.load(npzfname, allow_pickle=False)
         # print(group_by_site(npz, 'rlz-000', 'structural_ins', '"tax1"'))
         F32 = numpy.float32
-        loss_by_site = collections.defaultdict(float)  # lon, lat -> loss
-        for rec in npz[rlz_or_stat]:
-            if taxonomy == 'All' or taxonomy.encode('utf8') == rec['taxonomy']:
-                loss_by_site[rec['lon'], rec['lat']] += rec[loss_type]
-        data = numpy.zeros(len(loss_by_site),
+        # NOTE: all loss types are summed at once
+        sums_by_site = self.get_sums_by_site(npz, rlz_or_stat, taxonomy)
+        data = numpy.zeros(len(sums_by_site),
                            [('lon', F32), ('lat', F32), (loss_type, F32)])
-        for i, (lon, lat) in enumerate(sorted(loss_by_site)):
-            data[i] = (lon, lat, loss_by_site[lon, lat])
+        data['lon'] = sums_by_site['lon']
+        data['lat'] = sums_by_site['lat']
+        data[loss_type] = sums_by_site[loss_type]
         return data
@@ -37,6 +37,9 @@ class LoadCsvAsLayerDialog(LoadOutputAsLayerDialog):
     browsed through its attribute table
     """
 
+    # NOTE: layers are not built through create_layer
+    gpkg_supported = False
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock, session, hostname,
                  calc_id, output_type, path=None, mode=None,
                  engine_version=None, calculation_mode=None):
@@ -23,9 +23,8 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy
-import collections
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication)
+    QgsTask, QgsApplication)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
 from svir.utilities.utils import (WaitCursorManager,
                                   log_msg,
@@ -186,80 +185,64 @@ class LoadDamagesRlzsAsLayerDialog(LoadOutputAsLayerDialog):
         return self.layer
 
     def read_npz_into_layer_no_aggr(self, field_types, **kwargs):
-        field_names = list(field_types)
         rlz_or_stat = kwargs['rlz_or_stat']
         loss_type = kwargs['loss_type']
-        with edit(self.layer):
-            feats = []
-            data = self.npz_file[rlz_or_stat]
-            for row in data:
-                # add a feature
-                feat = QgsFeature(self.layer.fields())
-                for field_name in field_names:
-                    if field_name in ['lon', 'lat']:
-                        continue
-                    elif field_name in data.dtype.names:
-                        value = row[field_name].item()
-                        if isinstance(value, bytes):
-                            value = value.decode('utf8').strip('"')
-                    else:
-                        value = row[
-                            loss_type][field_name[len(loss_type)+1:]].item()
-                    feat.setAttribute(field_name, value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(row['lon'], row['lat'])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        data = self.npz_file[rlz_or_stat]
+        columns = {}
+        for field_name in field_types:
+            if field_name in ['lon', 'lat']:
+                continue
+            elif field_name in data.dtype.names:
+                column = data[field_name]
+                if column.dtype.kind == 'S':
+                    column = numpy.char.strip(
+                        numpy.char.decode(column, 'utf8'), '"')
+            else:
+                column = data[loss_type][field_name[len(loss_type)+1:]]
+            columns[field_name] = column
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, lons=data['lon'], lats=data['lat'])
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def read_npz_into_layer_aggr_by_site(self, field_types, **kwargs):
-        field_names = list(field_types)
         rlz_or_stat = kwargs['rlz_or_stat']
         loss_type = kwargs['loss_type']
         taxonomy = kwargs['taxonomy']
         dmg_state = kwargs['dmg_state']
-        with edit(self.layer):
-            feats = []
-            grouped_by_site = self.group_by_site(
-                self.npz_file, rlz_or_stat, loss_type, dmg_state, taxonomy)
-            for row in grouped_by_site:
-                # add a feature
-                feat = QgsFeature(self.layer.fields())
-                for field_name_idx, field_name in enumerate(field_names):
-                    if field_name in ['lon', 'lat']:
-                        continue
-                    value = row[field_name_idx].item()
-                    if isinstance(value, bytes):
-                        value = value.decode('utf8')
-                    feat.setAttribute(field_name, value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(row['lon'], row['lat'])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        grouped_by_site = self.group_by_site(
+            self.npz_file, rlz_or_stat, loss_type, dmg_state, taxonomy)
+        # NOTE: fields of grouped_by_site correspond positionally to
+        # field_types
+        columns = {
+            field_name: grouped_by_site[grouped_by_site.dtype.names[idx]]
+            for idx, field_name in enumerate(field_types)
+            if field_name not in ['lon', 'lat']}
+        added_ok = self.add_features_from_columns(
+            self.layer, columns,
+            lons=grouped_by_site['lon'], lats=grouped_by_site['lat'])
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def group_by_site(self, npz, rlz_or_stat, loss_type, dmg_state,
                       taxonomy='All'):
         F32 = numpy.float32
-        dmg_by_site = collections.defaultdict(float)  # lon, lat -> dmg
-        for rec in npz[rlz_or_stat]:
-            if taxonomy == 'All' or taxonomy.encode('utf8') == rec['taxonomy']:
-                value = rec[f'{loss_type}-{dmg_state}']
-                dmg_by_site[rec['lon'], rec['lat']] += value
+        # NOTE: all loss types and damage states are summed at once
+        sums_by_site = self.get_sums_by_site(npz, rlz_or_stat, taxonomy)
         data = numpy.zeros(
-            len(dmg_by_site),
+            len(sums_by_site),
             [('lon', F32), ('lat', F32), (loss_type, F32)])
-        for i, (lon, lat) in enumerate(sorted(dmg_by_site)):
-            data[i] = (lon, lat, dmg_by_site[lon, lat])
+        data['lon'] = sums_by_site['lon']
+        data['lat'] = sums_by_site['lat']
+        data[loss_type] = sums_by_site[f'{loss_type}-{dmg_state}']
         return data
 
     def load_from_npz(self):
+        layers_kwargs = []
         for rlz_or_stat in self.rlzs_or_stats:
             if (self.load_selected_only_ckb.isChecked()
                     and rlz_or_stat != self.rlz_or_stat_cbx.currentData()):
@@ -277,37 +260,28 @@ class LoadDamagesRlzsAsLayerDialog(LoadOutputAsLayerDialog):
                             if (self.load_selected_only_ckb.isChecked() and
                                     dmg_state != self.dmg_state_cbx.currentText()):  # NOQA
                                 continue
-                            with WaitCursorManager(
-                                    'Creating layer for "%s",'
-                                    ' taxonomy "%s", loss type "%s" and'
-                                    ' damage state "%s"...' % (
-                                    rlz_or_stat, taxonomy, loss_type,
-                                    dmg_state), self.iface.messageBar()):
-                                self.layer = self.build_layer(
-                                    rlz_or_stat, taxonomy=taxonomy,
-                                    loss_type=loss_type, dmg_state=dmg_state)
-                                self.style_maps(self.layer,
-                                                self.default_field_name,
-                                                self.iface, self.output_type)
+                            layers_kwargs.append(dict(
+                                rlz_or_stat=rlz_or_stat, taxonomy=taxonomy,
+                                loss_type=loss_type, dmg_state=dmg_state))
             elif self.zonal_layer_gbx.isChecked():
-                taxonomy = self.taxonomy_cbx.currentText()
-                loss_type = self.loss_type_cbx.currentText()
-                dmg_state = self.dmg_state_cbx.currentText()
-                with WaitCursorManager(
-                    'Creating layer for "%s", taxonomy "%s", loss type "%s"'
-                    ' and damage state "%s"...' % (
-                        rlz_or_stat, taxonomy, loss_type, dmg_state)):
-                    self.layer = self.build_layer(
-                        rlz_or_stat, taxonomy=taxonomy, loss_type=loss_type,
-                        dmg_state=dmg_state)
+                layers_kwargs.append(dict(
+                    rlz_or_stat=rlz_or_stat,
+                    taxonomy=self.taxonomy_cbx.currentText(),
+                    loss_type=self.loss_type_cbx.currentText(),
+                    dmg_state=self.dmg_state_cbx.currentText()))
             else:  # also needed for recovery modeling
                 for loss_type in self.loss_types:
                     if (self.load_selected_only_ckb.isChecked()
                             and loss_type != self.loss_type_cbx.currentText()):
                         continue
-                    with WaitCursorManager(
-                        'Creating layer for "%s" and loss_type "%s"' % (
-                            rlz_or_stat, loss_type), self.iface.messageBar()):
-                        self.layer = self.build_layer(
-                            rlz_or_stat, loss_type=loss_type)
-                        self.style_curves()
+                    layers_kwargs.append(dict(
+                        rlz_or_stat=rlz_or_stat, loss_type=loss_type))
+        self.build_layers_in_task(layers_kwargs, self.on_damages_layer_built)
+
+    def on_damages_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer)
+        if self.aggregate_by_site_ckb.isChecked():
+            self.style_maps(layer, self.default_field_name,
+                            self.iface, self.output_type)
+        elif not self.zonal_layer_gbx.isChecked():
+            self.style_curves()
@@ -22,12 +22,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import copy
 import json
 import numpy as np
 from qgis.core import (
-    QgsFeature, QgsGeometry, edit, QgsProject, QgsVectorLayer, QgsPointXY,
-    QgsTask, QgsApplication)
+    QgsProject, QgsVectorLayer, QgsTask, QgsApplication)
 from svir.utilities.utils import (
     log_msg, WaitCursorManager, extract_npz, get_irmt_version,
     write_metadata_to_layer)
@@ -42,6 +40,9 @@ class LoadDisaggRlzsAsLayerDialog(LoadOutputAsLayerDialog):
     as layer
     """
 
+    # NOTE: layers are not built through create_layer
+    gpkg_supported = False
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock, session, hostname,
                  calc_id, output_type='disagg-rlzs', path=None, mode=None,
                  engine_version=None, calculation_mode=None):
@@ -143,19 +144,12 @@ class LoadDisaggRlzsAsLayerDialog(LoadOutputAsLayerDialog):
 
     def read_custom_site_ids_into_layer(
             self, custom_site_id_layer, lons, lats, custom_site_ids):
-        with edit(custom_site_id_layer):
-            feats = []
-            for row_idx, row in enumerate(custom_site_ids):
-                feat = QgsFeature(custom_site_id_layer.fields())
-                value = int(custom_site_ids[row_idx])
-                feat.setAttribute('custom_site_id', value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(lons[row_idx], lats[row_idx])))
-                feats.append(feat)
-            added_ok = custom_site_id_layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        columns = {'custom_site_id': np.asarray(custom_site_ids, dtype=int)}
+        added_ok = self.add_features_from_columns(
+            custom_site_id_layer, columns, lons=lons, lats=lats)
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return custom_site_id_layer
 
     def build_layer(self, disagg, disagg_array, lons, lats, custom_site_ids):
@@ -170,19 +164,14 @@ class LoadDisaggRlzsAsLayerDialog(LoadOutputAsLayerDialog):
             field_types['custom_site_id'] = 'I'
         self.layer = QgsVectorLayer(
             "%s?crs=epsg:4326" % 'point', layer_name, "memory")
-        modified_field_types = copy.copy(field_types)
-        for field_name, field_type in field_types.items():
-            if field_name in ['lon', 'lat']:
-                continue
-            # log_msg('Adding field %s of type %s' % (field_name, field_type),
-            #         level='I', print_to_stdout=True)
-            added_field_name = self.add_field_to_layer(field_name, field_type)
-            # log_msg('\tDone adding field', level='I', print_to_stdout=True)
-            if field_name != added_field_name:
-                # replace field_name with the actual added_field_name
-                del modified_field_types[field_name]
-                modified_field_types[added_field_name] = field_type
-        field_types = copy.copy(modified_field_types)
+        added_field_names = self.add_fields_to_layer({
+            field_name: field_type
+            for field_name, field_type in field_types.items()
+            if field_name not in ['lon', 'lat']})
+        # replace field names with the actual added field names
+        field_types = {
+            added_field_names.get(field_name, field_name): field_type
+            for field_name, field_type in field_types.items()}
 
         self.layer = self.read_npz_into_layer(
             field_types, disagg_array, lons, lats, custom_site_ids)
@@ -222,49 +211,28 @@ class LoadDisaggRlzsAsLayerDialog(LoadOutputAsLayerDialog):
 
     def read_npz_into_layer(
             self, field_types, disagg_array, lons, lats, custom_site_ids):
-        with edit(self.layer):
-            feats = []
-            # tot_feats = len(disagg_array)
-            for row_idx, row in enumerate(disagg_array):
-                # log_msg('Site %s of %s' % (row_idx, tot_feats), level='I',
-                #         print_to_stdout=True)
-                feat = QgsFeature(self.layer.fields())
-                for field_name_idx, field_name in enumerate(field_types):
-                    if field_name in ('lon', 'lat'):
-                        continue
-                    if field_name == 'custom_site_id':
-                        value = int(custom_site_ids[row_idx])
-                    elif isinstance(disagg_array[field_name][row_idx],
-                                    np.ndarray):
-                        value = disagg_array[field_name][row_idx]
-                        # log_msg('\t\tDumping json', level='I',
-                        #         print_to_stdout=True)
-                        if (field_name.startswith('Dist-') and
-                                np.any(value < 0)):
-                            log_msg('Negative values were found for field %s:'
-                                    ' %s' % (field_name, value),
-                                    level='I', print_to_stdout=True)
-                        value = json.dumps(value.tolist())
-                        # log_msg('\t\tDone dumping json', level='I',
-                        #         print_to_stdout=True)
-                    else:  # scalar
-                        value = disagg_array[field_name][row_idx].item()
-                    feat.setAttribute(field_name, value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(lons[row_idx], lats[row_idx])))
-                feats.append(feat)
-                # log_msg('\tAdding feature', level='I',
-                #         print_to_stdout=True)
-                # added_ok = self.layer.addFeature(feat)
-                # log_msg('\t\tDone adding feature', level='I',
-                #         print_to_stdout=True)
-                # if not added_ok:
-                #     msg = 'There was a problem adding features to the layer.'
-                #     log_msg(msg, level='C',
-                #             message_bar=self.iface.messageBar(),
-                #             print_to_stderr=True)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        columns = {}
+        for field_name in field_types:
+            if field_name in ('lon', 'lat'):
+                continue
+            if field_name == 'custom_site_id':
+                column = np.asarray(custom_site_ids, dtype=int)
+            else:
+                column = disagg_array[field_name]
+            if column.ndim > 1:
+                # each value is an array, that we store as a json string
+                if field_name.startswith('Dist-'):
+                    has_negatives = (column < 0).reshape(
+                        len(column), -1).any(axis=1)
+                    for value in column[has_negatives]:
+                        log_msg('Negative values were found for field %s:'
+                                ' %s' % (field_name, value),
+                                level='I', print_to_stdout=True)
+                column = [json.dumps(value) for value in column.tolist()]
+            columns[field_name] = column
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, lons=lons, lats=lats)
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
@@ -26,9 +26,8 @@ import os
 import numpy as np
 from qgis.PyQt.QtWidgets import QInputDialog, QDialog
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication)
+    QgsTask, QgsApplication)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
-from svir.calculations.calculate_utils import add_attribute
 from svir.utilities.utils import WaitCursorManager, log_msg, extract_npz
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
@@ -227,11 +226,13 @@ class LoadGmfDataAsLayerDialog(LoadOutputAsLayerDialog):
         # NOTE: selecting only 1 event, we have only 1 gsim
         rlz = self.rlz_or_stat_cbx.currentData()
         gsim = self.rlz_or_stat_cbx.currentText()
-        with WaitCursorManager('Creating layer for "%s"...'
-                               % gsim, self.iface.messageBar()):
-            self.layer = self.build_layer(rlz_or_stat=rlz, gsim=gsim)
-            self.style_maps(self.layer, self.default_field_name,
-                            self.iface, self.output_type)
+        self.build_layers_in_task([dict(rlz_or_stat=rlz, gsim=gsim)],
+                                  self.on_gmf_layer_built)
+
+    def on_gmf_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer)
+        self.style_maps(layer, self.default_field_name,
+                        self.iface, self.output_type)
 
     def build_layer_name(self, gsim=None, **kwargs):
         self.imt = self.imt_cbx.currentText()
@@ -245,40 +246,29 @@ class LoadGmfDataAsLayerDialog(LoadOutputAsLayerDialog):
                        for name in self.gmf_data.dtype.names}
         return field_types
 
-    def add_field_to_layer(self, field_name, field_type):
+    def propose_field_name(self, field_name):
         # TODO: assuming all attributes are numeric (to be checked!)
-        field_name = "%s-%s" % (field_name, self.eid)
-        added_field_name = add_attribute(field_name, field_type, self.layer)
-        return added_field_name
+        return "%s-%s" % (field_name, self.eid)
 
     def read_npz_into_layer(self, field_types, rlz_or_stat, **kwargs):
-        with edit(self.layer):
-            feats = []
-            fields = self.layer.fields()
-            layer_field_names = [field.name() for field in fields]
-            dataset_field_names = list(self.get_field_types())
-            dataset_field_names_to_layer = [
-                field_name for field_name in dataset_field_names
-                if field_name not in ('lon', 'lat')]
-            d2l_field_names = dict(
-                list(zip(dataset_field_names_to_layer, layer_field_names)))
-            rlz_name = 'rlz-%03d' % rlz_or_stat
-            for row in self.npz_file[rlz_name]:
-                # add a feature
-                feat = QgsFeature(fields)
-                for field_name in dataset_field_names:
-                    if field_name in ['lon', 'lat']:
-                        continue
-                    layer_field_name = d2l_field_names[field_name]
-                    value = row[field_name].item()
-                    if isinstance(value, bytes):
-                        value = value.decode('utf8')
-                    feat.setAttribute(layer_field_name, value)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(row['lon'], row['lat'])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        # NOTE: skipping the fid of layers written into GeoPackages
+        pk_idxs = self.layer.dataProvider().pkAttributeIndexes()
+        layer_field_names = [
+            field.name() for field_idx, field in enumerate(self.layer.fields())
+            if field_idx not in pk_idxs]
+        dataset_field_names = list(self.get_field_types())
+        dataset_field_names_to_layer = [
+            field_name for field_name in dataset_field_names
+            if field_name not in ('lon', 'lat')]
+        d2l_field_names = dict(
+            list(zip(dataset_field_names_to_layer, layer_field_names)))
+        rlz_name = 'rlz-%03d' % rlz_or_stat
+        data = self.npz_file[rlz_name]
+        columns = {d2l_field_names[field_name]: data[field_name]
+                   for field_name in dataset_field_names_to_layer}
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, lons=data['lon'], lats=data['lat'])
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
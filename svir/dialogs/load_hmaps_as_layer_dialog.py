@@ -23,11 +23,11 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication,
-    QgsProject)
+    QgsTask, QgsApplication, QgsProject)
 from qgis.PyQt.QtCore import Qt
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
-from svir.utilities.utils import WaitCursorManager, log_msg
+from svir.utilities.utils import log_msg
+from svir.utilities.lazy_styles import add_lazy_styles
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
 
@@ -35,6 +35,9 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
     """
     Dialog to load hazard maps from an oq-engine output, as layer
     """
+
+    use_npz_provider = True
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock, session, hostname,
                  calc_id, output_type='hmaps', path=None, mode=None,
                  engine_version=None, calculation_mode=None):
@@ -147,25 +150,38 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
             self.poe_cbx.addItems(self.imts[self.imt])
         self.set_ok_button()
 
+    def get_layer_options(self):
+        """
+        Read the options of the layers to be built from the widgets, so that
+        they can be passed to create_layer, that runs in a background task
+        """
+        return dict(
+            single_layer=self.load_single_layer_ckb.isChecked(),
+            one_layer_per_stat=self.load_one_layer_per_stat_ckb.isChecked(),
+            show_return_period=self.show_return_period_chk.isChecked(),
+            selected_rlz_or_stat=self.rlz_or_stat_cbx.currentData(),
+            selected_imt=self.imt_cbx.currentText(),
+            selected_poe=self.poe_cbx.currentText())
+
     def build_layer_name(self, rlz_or_stat=None, **kwargs):
         investigation_time = self.get_investigation_time()
-        if self.load_single_layer_ckb.isChecked():
-            rlz_or_stat = self.rlz_or_stat_cbx.currentData()
-            imt = self.imt_cbx.currentText()
-            poe = self.poe_cbx.currentText()
+        if kwargs['single_layer']:
+            rlz_or_stat = kwargs['selected_rlz_or_stat']
+            imt = kwargs['selected_imt']
+            poe = kwargs['selected_poe']
             self.default_field_name = '%s-%s-%s' % (rlz_or_stat, imt, poe)
             return "hmap_%sy" % investigation_time
-        elif self.load_one_layer_per_stat_ckb.isChecked():
-            imt = self.imt_cbx.currentText()
-            poe = self.poe_cbx.currentText()
+        elif kwargs['one_layer_per_stat']:
+            imt = kwargs['selected_imt']
+            poe = kwargs['selected_poe']
         else:
             imt = kwargs['imt']
             poe = kwargs['poe']
         self.default_field_name = '%s-%s' % (imt, poe)
-        if self.load_one_layer_per_stat_ckb.isChecked():
+        if kwargs['one_layer_per_stat']:
             layer_name = "hmap_%s_%sy" % (
                 rlz_or_stat, investigation_time)
-        elif self.show_return_period_chk.isChecked():
+        elif kwargs['show_return_period']:
             return_period = int(float(investigation_time) / float(poe))
             layer_name = "hmap_%s_%s_%syr" % (
                 rlz_or_stat, imt, return_period)
@@ -176,13 +192,13 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
 
     def get_field_types(self, **kwargs):
         field_types = {}
-        if self.load_single_layer_ckb.isChecked():
+        if kwargs['single_layer']:
             for rlz_or_stat in self.rlzs_or_stats:
                 for imt in self.imts:
                     for poe in self.imts[imt]:
                         field_name = "%s-%s-%s" % (rlz_or_stat, imt, poe)
                         field_types[field_name] = 'F'
-        elif self.load_one_layer_per_stat_ckb.isChecked():
+        elif kwargs['one_layer_per_stat']:
             for imt in self.imts:
                 for poe in self.imts[imt]:
                     field_name = "%s-%s" % (imt, poe)
@@ -195,43 +211,26 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
         return field_types
 
     def read_npz_into_layer(self, field_types, **kwargs):
-        with edit(self.layer):
-            lons = self.npz_file['all']['lon']
-            lats = self.npz_file['all']['lat']
-            feats = []
-            if self.load_single_layer_ckb.isChecked():
-                all_data = self.npz_file['all']
-                for row_idx, row in enumerate(all_data):
-                    # add a feature
-                    feat = QgsFeature(self.layer.fields())
-                    feat.setGeometry(QgsGeometry.fromPointXY(
-                        QgsPointXY(lons[row_idx], lats[row_idx])))
-                    for field_name in field_types:
-                        # NOTE: example field_name == 'quantile-0.15-PGA-0.01'
-                        rlz_or_stat, imt, poe = field_name.rsplit('-', 2)
-                        value = row[rlz_or_stat][imt][poe].item()
-                        if isinstance(value, bytes):
-                            value = value.decode('utf8')
-                        feat.setAttribute(field_name, value)
-                    feats.append(feat)
-            else:
-                for row_idx, row in enumerate(self.dataset):
-                    # add a feature
-                    feat = QgsFeature(self.layer.fields())
-                    for field_name in field_types:
-                        # NOTE: example field_name == 'PGA-0.01'
-                        imt, poe = field_name.split('-')
-                        value = row[imt][poe].item()
-                        if isinstance(value, bytes):
-                            value = value.decode('utf8')
-                        feat.setAttribute(field_name, value)
-                    feat.setGeometry(QgsGeometry.fromPointXY(
-                        QgsPointXY(lons[row_idx], lats[row_idx])))
-                    feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        lons = self.npz_file['all']['lon']
+        lats = self.npz_file['all']['lat']
+        columns = {}
+        if kwargs['single_layer']:
+            all_data = self.npz_file['all']
+            for field_name in field_types:
+                # NOTE: example field_name == 'quantile-0.15-PGA-0.01'
+                rlz_or_stat, imt, poe = field_name.rsplit('-', 2)
+                columns[field_name] = all_data[rlz_or_stat][imt][poe]
+        else:
+            for field_name in field_types:
+                # NOTE: example field_name == 'PGA-0.01'
+                imt, poe = field_name.split('-')
+                columns[field_name] = self.dataset[imt][poe]
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, lons=lons, lats=lats,
+            is_canceled=kwargs.get('is_canceled'))
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def load_from_npz(self):
@@ -248,50 +247,19 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
                     continue
                 root = QgsProject.instance().layerTreeRoot()
                 ret_per_groups[poe] = root.insertGroup(0, 'POE_%s' % poe)
+        # NOTE: widgets can not be read from the background task
+        options = self.get_layer_options()
+        layers_kwargs = []
         if self.load_single_layer_ckb.isChecked():
-            with WaitCursorManager(
-                    'Creating layer...', self.iface.messageBar()):
-                self.layer = self.build_layer()
-                style_manager = self.layer.styleManager()
-                for field_name in [field.name()
-                                   for field in self.layer.fields()]:
-                    style_manager.addStyleFromLayer(field_name)
-                    style_manager.setCurrentStyle(field_name)
-                    self.style_maps(self.layer, field_name,
-                                    self.iface, self.output_type,
-                                    repaint=False)
-                style_manager.setCurrentStyle(self.default_field_name)
-                self.layer.triggerRepaint()
-                self.iface.setActiveLayer(self.layer)
-                self.iface.zoomToActiveLayer()
-                # NOTE QGIS3: probably not needed
-                # iface.layerTreeView().refreshLayerSymbology(layer.id())
-                self.iface.mapCanvas().refresh()
+            layers_kwargs.append(dict(options))
         else:
             for rlz_or_stat in self.rlzs_or_stats:
                 if (not self.load_all_rlzs_or_stats_chk.isChecked()
                         and rlz_or_stat != self.rlz_or_stat_cbx.currentData()):
                     continue
                 elif self.load_one_layer_per_stat_ckb.isChecked():
-                    with WaitCursorManager(
-                            'Creating layer for "%s"...' % rlz_or_stat,
-                            self.iface.messageBar()):
-                        self.layer = self.build_layer(rlz_or_stat)
-                        style_manager = self.layer.styleManager()
-                        for field_name in [field.name()
-                                           for field in self.layer.fields()]:
-                            style_manager.addStyleFromLayer(field_name)
-                            style_manager.setCurrentStyle(field_name)
-                            self.style_maps(self.layer, field_name,
-                                            self.iface, self.output_type,
-                                            repaint=False)
-                        style_manager.setCurrentStyle(self.default_field_name)
-                        self.layer.triggerRepaint()
-                        self.iface.setActiveLayer(self.layer)
-                        self.iface.zoomToActiveLayer()
-                        # NOTE QGIS3: probably not needed
-                        # iface.layerTreeView().refreshLayerSymbology(layer.id())
-                        self.iface.mapCanvas().refresh()
+                    layers_kwargs.append(dict(
+                        options, rlz_or_stat=rlz_or_stat))
                 else:
                     for imt in self.imts:
                         if (not self.load_all_imts_chk.isChecked()
@@ -301,18 +269,29 @@ class LoadHazardMapsAsLayerDialog(LoadOutputAsLayerDialog):
                             if (not self.load_all_poes_chk.isChecked()
                                     and poe != self.poe_cbx.currentText()):
                                 continue
-                            with WaitCursorManager(
-                                    'Creating layer for "%s, %s, %s"...' % (
-                                        rlz_or_stat, imt, poe),
-                                    self.iface.messageBar()):
-                                self.layer = self.build_layer(
-                                    rlz_or_stat, imt=imt, poe=poe,
-                                    add_to_group=ret_per_groups[poe])
-                                # NOTE: set sgc_style=True to use SGC settings
-                                # for hazard maps styling
-                                self.style_maps(self.layer,
-                                                self.default_field_name,
-                                                self.iface,
-                                                self.output_type,
-                                                use_sgc_style=False)
-        return self.layer
+                            layers_kwargs.append(dict(
+                                options, rlz_or_stat=rlz_or_stat, imt=imt,
+                                poe=poe, add_to_group=ret_per_groups[poe]))
+        self.build_layers_in_task(layers_kwargs, self.on_hmaps_layer_built)
+
+    def on_hmaps_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer, kwargs.get('add_to_group'))
+        if kwargs['single_layer'] or kwargs['one_layer_per_stat']:
+            # NOTE: a style is added for each field, but its renderer is
+            #       built only when the style becomes current
+            add_lazy_styles(
+                layer, layer.fields().names(),
+                self.make_field_style_function(self.iface, self.output_type),
+                current_style=self.default_field_name)
+            layer.triggerRepaint()
+            self.iface.setActiveLayer(layer)
+            self.iface.zoomToActiveLayer()
+            # NOTE QGIS3: probably not needed
+            # iface.layerTreeView().refreshLayerSymbology(layer.id())
+            self.iface.mapCanvas().refresh()
+        else:
+            # NOTE: set sgc_style=True to use SGC settings
+            # for hazard maps styling
+            self.style_maps(layer, self.default_field_name,
+                            self.iface, self.output_type,
+                            use_sgc_style=False)
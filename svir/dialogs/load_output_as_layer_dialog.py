@@ -23,10 +23,11 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import copy
+import numpy
 from random import randrange
-from osgeo import ogr
+from osgeo import ogr, osr
 from qgis.core import (QgsVectorLayer,
+                       QgsProviderRegistry,
                        QgsProject,
                        QgsStyle,
                        QgsSymbol,
@@ -41,6 +42,7 @@ from qgis.core import (QgsVectorLayer,
                        QgsMarkerSymbol,
                        QgsSimpleFillSymbolLayer,
                        QgsRendererCategory,
+                       QgsRendererRange,
                        QgsCategorizedSymbolRenderer,
                        QgsApplication,
                        QgsExpression,
@@ -48,8 +50,12 @@ from qgis.core import (QgsVectorLayer,
                        QgsSimpleMarkerSymbolLayerBase,
                        Qgis,
                        QgsRectangle,
+                       QgsFeature,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsTask,
                        )
-from qgis.gui import QgsSublayersDialog
+from qgis.gui import QgsSublayersDialog, QgsFileWidget
 from qgis.PyQt.QtCore import pyqtSignal, QDir, QSettings, QFileInfo, Qt
 from qgis.PyQt.QtWidgets import (
                                  QDialogButtonBox,
@@ -66,14 +72,22 @@ from qgis.PyQt.QtWidgets import (
                                  QGroupBox,
                                  )
 from qgis.PyQt.QtGui import QColor
-from svir.calculations.calculate_utils import add_attribute
+from svir.calculations.calculate_utils import add_attributes
 from svir.calculations.process_layer import ProcessLayer
+from svir.calculations.classification import (
+    CLASSIFICATION_METHODS, classify_layer_fields)
 from svir.calculations.aggregate_loss_by_zone import (
     calculate_zonal_stats)
 from svir.utilities.shared import (OQ_CSV_TO_LAYER_TYPES,
                                    OQ_TO_LAYER_TYPES,
                                    OQ_EXTRACT_TO_LAYER_TYPES,
                                    RAMP_EXTREME_COLORS,
+                                   DEFAULT_SETTINGS,
+                                   STRING_FIELD_TYPE,
+                                   INT_FIELD_TYPE,
+                                   DOUBLE_FIELD_TYPE,
+                                   LONGLONG_FIELD_TYPE,
+                                   ULONGLONG_FIELD_TYPE,
                                    )
 from svir.utilities.utils import (get_ui_class,
                                   get_style,
@@ -83,10 +97,29 @@ from svir.utilities.utils import (get_ui_class,
                                   get_irmt_version,
                                   write_metadata_to_layer,
                                   )
+from svir.utilities.npz_provider import (NPZ_PROVIDER_KEY,
+                                         create_npz_layer,
+                                         is_npz_provider_registered,
+                                         set_npz_layer_columns,
+                                         )
 from svir.tasks.extract_npz_task import TaskCanceled
+from svir.tasks.build_layers_task import BuildLayersTask
 
 FORM_CLASS = get_ui_class('ui_load_output_as_layer.ui')
 
+# number of features that are built and added to the provider at once
+FEATURES_CHUNK_SIZE = 50000
+
+# OGR types of the fields of layers written into GeoPackages (other types are
+# written as strings)
+OGR_FIELD_TYPES = {
+    STRING_FIELD_TYPE: ogr.OFTString,
+    INT_FIELD_TYPE: ogr.OFTInteger,
+    DOUBLE_FIELD_TYPE: ogr.OFTReal,
+    LONGLONG_FIELD_TYPE: ogr.OFTInteger64,
+    ULONGLONG_FIELD_TYPE: ogr.OFTInteger64,
+}
+
 
 class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
     """
@@ -96,6 +129,13 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
     loading_completed = pyqtSignal(QDialog)
     loading_exception = pyqtSignal(QDialog, Exception)
 
+    # if True, point layers are served directly from the extracted arrays by
+    # the NPZ provider, instead of copying the data into memory layers
+    use_npz_provider = False
+    # if True, layers can be written directly into a GeoPackage (it requires
+    # layers to be built by create_layer)
+    gpkg_supported = True
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock,
                  session, hostname, calc_id, output_type=None,
                  path=None, mode=None, zonal_layer_path=None,
@@ -122,6 +162,14 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         self.ok_button = self.buttonBox.button(QDialogButtonBox.Ok)
         self.ok_button.setDisabled(True)
         self.oqparam = self.drive_engine_dlg.get_oqparam()
+        # path of the GeoPackage where layers are written (None to build
+        # layers in memory)
+        self.gpkg_path = None
+        if self.gpkg_supported:
+            self.create_save_to_gpkg_selector()
+        # memoized by get_sums_by_site while building layers
+        self.site_indices = {}
+        self.sums_by_site = {}
 
     def on_extract_error(self, exception):
         if isinstance(exception, TaskCanceled):
@@ -140,6 +188,47 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         self.show()
         self.init_done.emit(self)
 
+    def create_save_to_gpkg_selector(self):
+        self.save_to_gpkg_ckb = QCheckBox(
+            'Write layers into a GeoPackage')
+        self.save_to_gpkg_ckb.setToolTip(
+            'Layers are stored on disk instead of being kept in memory, and'
+            ' they are available when the project is reopened')
+        self.gpkg_path_fw = QgsFileWidget()
+        self.gpkg_path_fw.setStorageMode(QgsFileWidget.SaveFile)
+        self.gpkg_path_fw.setFilter('GeoPackage (*.gpkg)')
+        # NOTE: layers are added to the GeoPackage if it already exists
+        self.gpkg_path_fw.setConfirmOverwrite(False)
+        gpkg_dir = QSettings().value('irmt/gpkg_outputs_dir', QDir.homePath())
+        self.gpkg_path_fw.setFilePath(
+            os.path.join(gpkg_dir, 'calc_%s.gpkg' % self.calc_id))
+        self.save_to_gpkg_ckb.toggled[bool].connect(
+            self.gpkg_path_fw.setEnabled)
+        self.save_to_gpkg_ckb.setChecked(QSettings().value(
+            'irmt/save_outputs_to_gpkg',
+            DEFAULT_SETTINGS['save_outputs_to_gpkg'], type=bool))
+        self.gpkg_path_fw.setEnabled(self.save_to_gpkg_ckb.isChecked())
+        self.verticalLayout_5.addWidget(self.save_to_gpkg_ckb)
+        self.verticalLayout_5.addWidget(self.gpkg_path_fw)
+
+    def get_gpkg_path(self):
+        """
+        Return the path of the GeoPackage where layers have to be written,
+        or None if layers have to be built in memory
+        """
+        if not self.gpkg_supported:
+            return None
+        save_to_gpkg = self.save_to_gpkg_ckb.isChecked()
+        QSettings().setValue('irmt/save_outputs_to_gpkg', save_to_gpkg)
+        gpkg_path = self.gpkg_path_fw.filePath()
+        if not save_to_gpkg or not gpkg_path:
+            return None
+        if not gpkg_path.lower().endswith('.gpkg'):
+            gpkg_path += '.gpkg'
+        QSettings().setValue('irmt/gpkg_outputs_dir',
+                             os.path.dirname(gpkg_path))
+        return gpkg_path
+
     def create_num_sites_indicator(self):
         self.num_sites_msg = 'Number of sites: %s'
         self.num_sites_lbl = QLabel(self.num_sites_msg % '')
@@ -445,11 +534,340 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
     def load_from_npz(self):
         raise NotImplementedError()
 
-    def add_field_to_layer(self, field_name, field_type):
-        # NOTE: add_attribute use the native qgis editing manager
-        added_field_name = add_attribute(
-            field_name, field_type, self.layer)
-        return added_field_name
+    @staticmethod
+    def column_to_list(values):
+        """
+        Convert a column of values (e.g. a field of a structured array) into
+        a list of python objects that can be used as feature attributes
+
+        :param values: a numpy array or a list
+        :returns: a list, with bytes decoded as utf8 strings
+        """
+        if not isinstance(values, numpy.ndarray):
+            return [value.decode('utf8') if isinstance(value, bytes)
+                    else value for value in values]
+        if values.dtype.kind == 'S':
+            # decoding the whole column at once
+            values = numpy.char.decode(values, 'utf8')
+        elif values.dtype.kind == 'O':
+            return LoadOutputAsLayerDialog.column_to_list(values.tolist())
+        return values.tolist()
+
+    @staticmethod
+    def add_features_from_columns(layer, columns, lons=None, lats=None,
+                                  geometries=None,
+                                  chunk_size=FEATURES_CHUNK_SIZE,
+                                  is_canceled=None):
+        """
+        Populate a layer building its features column by column, instead
+        of reading the data row by row. Each column is converted to a list of
+        python objects only once, and features are added to the data provider
+        in chunks.
+
+        :param layer: the layer to be populated (its fields must already
+            exist)
+        :param columns: dict {field_name: values}, where values are numpy
+            arrays or lists containing one item per feature
+        :param lons: longitudes of point features
+        :param lats: latitudes of point features
+        :param geometries: alternatively to lons and lats, a list of
+            QgsGeometry (one per feature)
+        :param chunk_size: number of features added to the provider at once
+        :param is_canceled: an optional function returning True if the
+            operation has to be interrupted (checked before each chunk)
+        :raises TaskCanceled: if the operation was interrupted
+        :returns: True if all features were added successfully
+        """
+        if layer.providerType() == NPZ_PROVIDER_KEY and geometries is None:
+            # NOTE: the provider serves features straight from the columns
+            return set_npz_layer_columns(layer, columns, lons=lons, lats=lats)
+        if (layer.providerType() == 'ogr'
+                and layer.dataProvider().storageType() == 'GPKG'):
+            return LoadOutputAsLayerDialog.write_columns_to_gpkg(
+                layer, columns, lons=lons, lats=lats, geometries=geometries,
+                chunk_size=chunk_size, is_canceled=is_canceled)
+        fields = layer.fields()
+        num_fields = fields.count()
+        field_idxs = []
+        for field_name in columns:
+            field_idx = fields.indexFromName(field_name)
+            if field_idx == -1:
+                raise KeyError('Field %s not found in layer %s' % (
+                    field_name, layer.name()))
+            field_idxs.append(field_idx)
+        values = [LoadOutputAsLayerDialog.column_to_list(column)
+                  for column in columns.values()]
+        if geometries is None and lons is not None:
+            lons = LoadOutputAsLayerDialog.column_to_list(lons)
+            lats = LoadOutputAsLayerDialog.column_to_list(lats)
+        if values:
+            num_feats = len(values[0])
+        elif geometries is not None:
+            num_feats = len(geometries)
+        else:
+            num_feats = len(lons)
+        all_fields_in_order = field_idxs == list(range(num_fields))
+        provider = layer.dataProvider()
+        added_ok = True
+        for start in range(0, num_feats, chunk_size):
+            if is_canceled is not None and is_canceled():
+                raise TaskCanceled
+            stop = min(start + chunk_size, num_feats)
+            feats = []
+            if values:
+                rows = zip(*[column[start:stop] for column in values])
+            else:
+                rows = [()] * (stop - start)
+            for feat_idx, row in zip(range(start, stop), rows):
+                feat = QgsFeature(fields)
+                if all_fields_in_order:
+                    feat.setAttributes(list(row))
+                else:
+                    attrs = [None] * num_fields
+                    for field_idx, value in zip(field_idxs, row):
+                        attrs[field_idx] = value
+                    feat.setAttributes(attrs)
+                if geometries is not None:
+                    feat.setGeometry(geometries[feat_idx])
+                elif lons is not None:
+                    feat.setGeometry(QgsGeometry.fromPointXY(
+                        QgsPointXY(lons[feat_idx], lats[feat_idx])))
+                feats.append(feat)
+            chunk_ok, _ = provider.addFeatures(feats)
+            added_ok = added_ok and chunk_ok
+        layer.updateExtents()
+        return added_ok
+
+    @staticmethod
+    def create_gpkg_layer(gpkg_path, schema_layer):
+        """
+        Create a table in a GeoPackage (creating also the GeoPackage, if
+        needed), with the same name, fields, geometry type and crs as the
+        given layer, replacing any table with the same name
+
+        :param gpkg_path: path of the GeoPackage
+        :param schema_layer: an empty layer, providing the schema
+        :returns: the layer corresponding to the new table (still empty)
+        """
+        if os.path.isfile(gpkg_path):
+            datasource = ogr.Open(gpkg_path, update=1)
+        else:
+            os.makedirs(os.path.dirname(gpkg_path) or '.', exist_ok=True)
+            datasource = ogr.GetDriverByName('GPKG').CreateDataSource(
+                gpkg_path)
+        if datasource is None:
+            raise IOError('Unable to open %s for writing' % gpkg_path)
+        table_name = schema_layer.name()
+        wkb_type = schema_layer.wkbType()
+        if wkb_type == QgsWkbTypes.NoGeometry:
+            ogr_geom_type = ogr.wkbNone
+            srs = None
+        else:
+            # NOTE: codes of flat geometry types are the same in QGIS and OGR
+            ogr_geom_type = int(QgsWkbTypes.flatType(wkb_type))
+            if QgsWkbTypes.hasZ(wkb_type):
+                ogr_geom_type = ogr.GT_SetZ(ogr_geom_type)
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(schema_layer.crs().toWkt())
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        ogr_layer = datasource.CreateLayer(
+            table_name, srs, ogr_geom_type,
+            options=['OVERWRITE=YES', 'SPATIAL_INDEX=YES', 'FID=fid'])
+        if ogr_layer is None:
+            raise IOError('Unable to create the table %s in %s' % (
+                table_name, gpkg_path))
+        for field in schema_layer.fields():
+            ogr_layer.CreateField(ogr.FieldDefn(
+                field.name(), OGR_FIELD_TYPES.get(
+                    field.type(), ogr.OFTString)))
+        # NOTE: closing the datasource, so the table is written
+        datasource = None
+        return QgsVectorLayer('%s|layername=%s' % (gpkg_path, table_name),
+                              table_name, 'ogr')
+
+    @staticmethod
+    def write_columns_to_gpkg(layer, columns, lons=None, lats=None,
+                              geometries=None,
+                              chunk_size=FEATURES_CHUNK_SIZE,
+                              is_canceled=None):
+        """
+        Populate a layer stored in a GeoPackage, writing features directly
+        through OGR in a single transaction. Columns are converted to python
+        objects one chunk at a time, so the whole output is never copied in
+        memory. See add_features_from_columns for the parameters.
+        """
+        uri = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+        datasource = ogr.Open(uri['path'], update=1)
+        if datasource is None:
+            return False
+        ogr_layer = datasource.GetLayerByName(uri['layerName'])
+        layer_defn = ogr_layer.GetLayerDefn()
+        field_idxs = []
+        for field_name in columns:
+            field_idx = layer_defn.GetFieldIndex(field_name)
+            if field_idx == -1:
+                raise KeyError('Field %s not found in layer %s' % (
+                    field_name, layer.name()))
+            field_idxs.append(field_idx)
+        if columns:
+            num_feats = len(next(iter(columns.values())))
+        elif geometries is not None:
+            num_feats = len(geometries)
+        else:
+            num_feats = len(lons)
+        column_to_list = LoadOutputAsLayerDialog.column_to_list
+        datasource.StartTransaction()
+        try:
+            for start in range(0, num_feats, chunk_size):
+                if is_canceled is not None and is_canceled():
+                    raise TaskCanceled
+                stop = min(start + chunk_size, num_feats)
+                values = [column_to_list(column[start:stop])
+                          for column in columns.values()]
+                if geometries is None and lons is not None:
+                    chunk_lons = column_to_list(lons[start:stop])
+                    chunk_lats = column_to_list(lats[start:stop])
+                for chunk_idx in range(stop - start):
+                    feat = ogr.Feature(layer_defn)
+                    for field_idx, column in zip(field_idxs, values):
+                        value = column[chunk_idx]
+                        if value is None:
+                            feat.SetFieldNull(field_idx)
+                        else:
+                            feat.SetField(field_idx, value)
+                    if geometries is not None:
+                        feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(
+                            bytes(geometries[start + chunk_idx].asWkb())))
+                    elif lons is not None:
+                        point = ogr.Geometry(ogr.wkbPoint)
+                        point.AddPoint_2D(
+                            chunk_lons[chunk_idx], chunk_lats[chunk_idx])
+                        feat.SetGeometryDirectly(point)
+                    if ogr_layer.CreateFeature(feat) != ogr.OGRERR_NONE:
+                        raise IOError('Unable to write features into %s' %
+                                      uri['path'])
+            datasource.CommitTransaction()
+        except Exception:
+            datasource.RollbackTransaction()
+            raise
+        finally:
+            datasource = None
+        layer.dataProvider().reloadData()
+        layer.updateExtents()
+        return True
+
+    @staticmethod
+    def get_site_index(lons, lats):
+        """
+        Find the distinct sites of a set of records
+
+        :param lons: longitudes of the records
+        :param lats: latitudes of the records
+        :returns: (site_lons, site_lats, site_idxs), where site_lons and
+            site_lats are the coordinates of the distinct sites, sorted by
+            longitude and latitude, and site_idxs gives the index of the site
+            of each record
+        """
+        lons = numpy.asarray(lons)
+        lats = numpy.asarray(lats)
+        order = numpy.lexsort((lats, lons))
+        sorted_lons = lons[order]
+        sorted_lats = lats[order]
+        is_new_site = numpy.ones(len(order), dtype=bool)
+        is_new_site[1:] = ((sorted_lons[1:] != sorted_lons[:-1])
+                           | (sorted_lats[1:] != sorted_lats[:-1]))
+        site_idxs = numpy.empty(len(order), dtype=numpy.intp)
+        site_idxs[order] = numpy.cumsum(is_new_site) - 1
+        return sorted_lons[is_new_site], sorted_lats[is_new_site], site_idxs
+
+    @staticmethod
+    def sum_by_site(data, value_fields, taxonomy='All', site_index=None):
+        """
+        Sum the values of the records located in the same site
+
+        :param data: a structured array with fields 'lon', 'lat', 'taxonomy'
+            and value_fields
+        :param value_fields: names of the fields to be summed
+        :param taxonomy: if different from 'All', only the records with this
+            taxonomy are taken into account
+        :param site_index: the result of get_site_index for data (it is
+            computed if not given)
+        :returns: a structured array with fields 'lon', 'lat' and
+            value_fields (all float32), with one record for each site
+            containing at least one of the selected records, sorted by
+            longitude and latitude
+        """
+        F32 = numpy.float32
+        if site_index is None:
+            site_index = LoadOutputAsLayerDialog.get_site_index(
+                data['lon'], data['lat'])
+        site_lons, site_lats, site_idxs = site_index
+        num_sites = len(site_lons)
+        mask = None
+        if taxonomy != 'All':
+            mask = data['taxonomy'] == taxonomy.encode('utf8')
+            site_idxs = site_idxs[mask]
+        is_selected = numpy.bincount(site_idxs, minlength=num_sites) > 0
+        sums = numpy.zeros(
+            numpy.count_nonzero(is_selected),
+            [('lon', F32), ('lat', F32)] + [
+                (field, F32) for field in value_fields])
+        sums['lon'] = site_lons[is_selected]
+        sums['lat'] = site_lats[is_selected]
+        for field in value_fields:
+            values = data[field] if mask is None else data[field][mask]
+            # NOTE: values are accumulated in double precision, in the
+            #       order of the records
+            sums[field] = numpy.bincount(
+                site_idxs, weights=values, minlength=num_sites)[is_selected]
+        return sums
+
+    def get_sums_by_site(self, npz, rlz_or_stat, taxonomy='All'):
+        """
+        Sum by site all the float fields (e.g. all loss types) of the records
+        of the given realization or statistic. Results are memoized while
+        building a set of layers, so the records are scanned only once for
+        each realization and taxonomy, instead of once for each layer.
+        """
+        key = (rlz_or_stat, taxonomy)
+        if key not in self.sums_by_site:
+            data = npz[rlz_or_stat]
+            if rlz_or_stat not in self.site_indices:
+                self.site_indices[rlz_or_stat] = self.get_site_index(
+                    data['lon'], data['lat'])
+            value_fields = [
+                field for field in data.dtype.names
+                if field not in ('lon', 'lat')
+                and data.dtype[field].kind == 'f']
+            self.sums_by_site[key] = self.sum_by_site(
+                data, value_fields, taxonomy,
+                site_index=self.site_indices[rlz_or_stat])
+        return self.sums_by_site[key]
+
+    def propose_field_name(self, field_name):
+        """
+        Return the name to be given to the layer field corresponding to the
+        given field of the extracted data (before laundering)
+        """
+        return field_name
+
+    def add_fields_to_layer(self, field_types):
+        """
+        Add all the given fields to the layer at once
+
+        :param field_types: dict {field_name: field_type}
+        :returns: dict {field_name: added_field_name}
+        """
+        proposed_field_names = {
+            field_name: self.propose_field_name(field_name)
+            for field_name in field_types}
+        added_field_names = add_attributes(
+            {proposed_field_names[field_name]: field_type
+             for field_name, field_type in field_types.items()},
+            self.layer)
+        return {field_name: added_field_names[proposed_field_name]
+                for field_name, proposed_field_name
+                in proposed_field_names.items()}
 
     def get_investigation_time(self):
         if self.output_type in ('hcurves', 'uhs', 'hmaps', 'ruptures'):
@@ -475,36 +893,67 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                     boundaries=None, geometry_type='point', wkt_geom_type=None,
                     row_wkt_geom_types=None, add_to_group=None,
                     add_to_map=True):
+        self.layer = self.create_layer(
+            rlz_or_stat=rlz_or_stat, taxonomy=taxonomy, poe=poe,
+            loss_type=loss_type, dmg_state=dmg_state, gsim=gsim, imt=imt,
+            boundaries=boundaries, geometry_type=geometry_type,
+            wkt_geom_type=wkt_geom_type,
+            row_wkt_geom_types=row_wkt_geom_types)
+        if add_to_map:
+            self.add_layer_to_project(self.layer, add_to_group)
+        return self.layer
+
+    def create_layer(self, rlz_or_stat=None, taxonomy=None, poe=None,
+                     loss_type=None, dmg_state=None, gsim=None, imt=None,
+                     boundaries=None, geometry_type='point',
+                     wkt_geom_type=None, row_wkt_geom_types=None, **kwargs):
+        """
+        Create a layer (in memory, or served by the NPZ provider if
+        use_npz_provider is True) and populate it with the extracted data,
+        without adding it to the project. It does not interact with the GUI,
+        so it can be called from a background task.
+        Additional kwargs (e.g. add_to_group, options read from the widgets
+        in the main thread, or the is_canceled function of the task) are
+        passed through to build_layer_name, get_field_types and
+        read_npz_into_layer.
+        """
         layer_name = self.build_layer_name(
             rlz_or_stat=rlz_or_stat, taxonomy=taxonomy, poe=poe,
             loss_type=loss_type, dmg_state=dmg_state, gsim=gsim, imt=imt,
-            geometry_type=geometry_type)
+            geometry_type=geometry_type, **kwargs)
         field_types = self.get_field_types(
             rlz_or_stat=rlz_or_stat, taxonomy=taxonomy, poe=poe,
-            loss_type=loss_type, dmg_state=dmg_state, imt=imt)
+            loss_type=loss_type, dmg_state=dmg_state, imt=imt, **kwargs)
 
         # create layer
-        self.layer = QgsVectorLayer(
-            "%s?crs=epsg:4326" % geometry_type, layer_name, "memory")
-        modified_field_types = copy.copy(field_types)
-        for field_name, field_type in field_types.items():
-            if field_name in ['lon', 'lat', 'boundary']:
-                continue
-            added_field_name = self.add_field_to_layer(field_name, field_type)
-            if field_name != added_field_name:
-                if field_name == self.default_field_name:
-                    self.default_field_name = added_field_name
-                # replace field_name with the actual added_field_name
-                del modified_field_types[field_name]
-                modified_field_types[added_field_name] = field_type
-        field_types = copy.copy(modified_field_types)
+        if (self.use_npz_provider and geometry_type == 'point'
+                and not self.gpkg_path and is_npz_provider_registered()):
+            self.layer = create_npz_layer(
+                layer_name, geometry_type, 'EPSG:4326')
+        else:
+            self.layer = QgsVectorLayer(
+                "%s?crs=epsg:4326" % geometry_type, layer_name, "memory")
+        added_field_names = self.add_fields_to_layer({
+            field_name: field_type
+            for field_name, field_type in field_types.items()
+            if field_name not in ['lon', 'lat', 'boundary']})
+        if getattr(self, 'default_field_name', None) in added_field_names:
+            self.default_field_name = added_field_names[
+                self.default_field_name]
+        # replace field names with the actual added field names
+        field_types = {
+            added_field_names.get(field_name, field_name): field_type
+            for field_name, field_type in field_types.items()}
+        if self.gpkg_path:
+            # NOTE: features will be written directly into the GeoPackage
+            self.layer = self.create_gpkg_layer(self.gpkg_path, self.layer)
 
         self.layer = self.read_npz_into_layer(
             field_types, rlz_or_stat=rlz_or_stat, taxonomy=taxonomy, poe=poe,
             loss_type=loss_type, dmg_state=dmg_state, imt=imt,
             boundaries=boundaries, geometry_type=geometry_type,
             wkt_geom_type=wkt_geom_type,
-            row_wkt_geom_types=row_wkt_geom_types)
+            row_wkt_geom_types=row_wkt_geom_types, **kwargs)
         # if we are creating a layer with empty extent, increase the
         # extent by a small delta in order to allow zooming to layer
         if (self.layer.featureCount() > 0
@@ -547,33 +996,98 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         # except AttributeError:
         #     # the aggregation stuff might not exist for some loaders
         #     pass
-        if add_to_map:
-            if add_to_group:
-                tree_node = add_to_group
-            else:
-                tree_node = QgsProject.instance().layerTreeRoot()
-            if self.mode != 'testing':
-                # NOTE: the following commented line would cause (unexpectedly)
-                #       "QGIS died on signal 11" and double creation of some
-                #       layers during integration tests
-                QgsProject.instance().addMapLayer(self.layer, False)
-            tree_node.insertLayer(0, self.layer)
-            self.iface.setActiveLayer(self.layer)
-            if add_to_group:
-                # NOTE: zooming to group from caller function, to avoid
-                #       repeating it once per layer
-                pass
-            else:
-                self.iface.zoomToActiveLayer()
-            log_msg('Layer %s was created successfully' % layer_name,
-                    level='S', message_bar=self.iface.messageBar())
         return self.layer
 
+    def add_layer_to_project(self, layer, add_to_group=None):
+        if add_to_group:
+            tree_node = add_to_group
+        else:
+            tree_node = QgsProject.instance().layerTreeRoot()
+        if self.mode != 'testing':
+            # NOTE: the following commented line would cause (unexpectedly)
+            #       "QGIS died on signal 11" and double creation of some
+            #       layers during integration tests
+            QgsProject.instance().addMapLayer(layer, False)
+        tree_node.insertLayer(0, layer)
+        self.iface.setActiveLayer(layer)
+        if add_to_group:
+            # NOTE: zooming to group from caller function, to avoid
+            #       repeating it once per layer
+            pass
+        else:
+            self.iface.zoomToActiveLayer()
+        log_msg('Layer %s was created successfully' % layer.name(),
+                level='S', message_bar=self.iface.messageBar())
+
+    def build_layers_in_task(self, layers_kwargs, on_layer_built,
+                             on_success=None):
+        """
+        Build layers in a background task, so the GUI remains responsive.
+        Only adding layers to the project and styling them is done in the
+        main thread, by the on_layer_built callback.
+
+        :param layers_kwargs: list of dicts, each containing the keyword
+            arguments of create_layer for one of the layers to be built
+        :param on_layer_built: callback called in the main thread for each
+            layer, with the layer and the corresponding kwargs. When it is
+            called, self.layer and self.default_field_name refer to that
+            layer.
+        :param on_success: callback called in the main thread after all
+            layers have been built (by default, on_loading_from_npz_completed)
+        """
+        if on_success is None:
+            on_success = self.on_loading_from_npz_completed
+        # NOTE: the npz might have changed since the previous loading
+        self.site_indices = {}
+        self.sums_by_site = {}
+        # NOTE: widgets can not be read from the background task
+        self.gpkg_path = self.get_gpkg_path()
+        if self.mode == 'testing':
+            # NOTE: integration tests expect layers to be loaded as soon as
+            #       the dialog is accepted
+            for kwargs in layers_kwargs:
+                self.layer = self.create_layer(**kwargs)
+                on_layer_built(self.layer, kwargs)
+            on_success()
+            return
+        self.build_layers_task = BuildLayersTask(
+            'Create layers from %s' % self.output_type, QgsTask.CanCancel,
+            self, layers_kwargs, on_layer_built, on_success,
+            self.on_build_layers_error)
+        QgsApplication.taskManager().addTask(self.build_layers_task)
+
+    def on_build_layers_error(self, exception):
+        if isinstance(exception, TaskCanceled):
+            msg = 'Layer creation canceled'
+            log_msg(msg, level='W', message_bar=self.iface.messageBar())
+        else:
+            log_msg('Unable to create layers', level='C',
+                    message_bar=self.iface.messageBar(), exception=exception)
+        self.loading_exception.emit(self, exception)
+        self.reject()
+
+    @staticmethod
+    def make_field_style_function(iface, output_type):
+        """
+        Return a function styling a layer by one of its fields, to be used to
+        build lazy styles (see svir.utilities.lazy_styles)
+        """
+        def style_by_field(layer, field_name):
+            # NOTE: only the classes of the styled field are computed, and
+            #       they are cached on the layer for the next time
+            LoadOutputAsLayerDialog.style_maps(
+                layer, field_name, iface, output_type, repaint=False)
+        return style_by_field
+
     @staticmethod
     def style_maps(layer, style_by, iface, output_type='damages-rlzs',
                    perils=None, add_null_class=False,
                    render_higher_on_top=False, repaint=True,
                    use_sgc_style=False):
+        """
+        Style the layer by the values of the field style_by, choosing the
+        classification method and the color ramp depending on the output type
+        """
         symbol = QgsSymbol.defaultSymbol(layer.geometryType())
         # see properties at:
         # https://qgis.org/api/qgsmarkersymbollayerv2_8cpp_source.html#l01073
@@ -694,10 +1208,22 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                 default_color_ramp_names[ramp_type_idx])
             if inverted:
                 ramp.invert()
-        # get unique values
         fni = layer.fields().indexOf(style_by)
-        unique_values = layer.dataProvider().uniqueValues(fni)
-        num_unique_values = len(unique_values - {NULL})
+        classification = None
+        unique_values = None
+        if (Qgis.QGIS_VERSION_INT >= 31000
+                and style_mode in CLASSIFICATION_METHODS
+                and layer.fields().at(fni).isNumeric()):
+            # NOTE: classes are computed with numpy and cached on the layer
+            classification = classify_layer_fields(
+                layer, [style_by], style_mode, style['classes'])[style_by]
+            num_unique_values = classification['num_unique']
+            has_null = classification['has_null']
+        else:
+            # get unique values
+            unique_values = layer.dataProvider().uniqueValues(fni)
+            num_unique_values = len(unique_values - {NULL})
+            has_null = NULL in unique_values
         if num_unique_values > 2:
             if Qgis.QGIS_VERSION_INT < 31000:
                 renderer = QgsGraduatedSymbolRenderer.createRenderer(
@@ -716,10 +1242,20 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                     QgsApplication.classificationMethodRegistry().method(
                         style_mode)
                 renderer.setClassificationMethod(classification_method)
-                renderer.updateColorRamp(ramp)
-                renderer.updateSymbols(symbol.clone())
-                renderer.updateClasses(
-                    layer, min(num_unique_values, style['classes']))
+                if classification is not None:
+                    lower = classification['minimum']
+                    for upper in classification['breaks']:
+                        renderer.addClassRange(QgsRendererRange(
+                            lower, upper, symbol.clone(), ''))
+                        lower = upper
+                    renderer.updateColorRamp(ramp)
+                    renderer.updateSymbols(symbol.clone())
+                    renderer.updateRangeLabels()
+                else:
+                    renderer.updateColorRamp(ramp)
+                    renderer.updateSymbols(symbol.clone())
+                    renderer.updateClasses(
+                        layer, min(num_unique_values, style['classes']))
             if not use_sgc_style:
                 if Qgis.QGIS_VERSION_INT < 31000:
                     label_format = renderer.labelFormat()
@@ -731,6 +1267,8 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                     renderer.classificationMethod().setLabelPrecision(2)
                     renderer.calculateLabelPrecision()
         elif num_unique_values == 2:
+            if unique_values is None:
+                unique_values = layer.dataProvider().uniqueValues(fni)
             categories = []
             for unique_value in unique_values:
                 symbol = symbol.clone()
@@ -750,7 +1288,7 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
             renderer = QgsCategorizedSymbolRenderer(style_by, categories)
         else:
             renderer = QgsSingleSymbolRenderer(symbol.clone())
-        if add_null_class and NULL in unique_values:
+        if add_null_class and has_null:
             # add a class for NULL values
             rule_renderer = QgsRuleBasedRenderer(symbol.clone())
             root_rule = rule_renderer.rootRule()
@@ -990,22 +1528,26 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
             pass
         self.hide()
         if self.output_type in OQ_EXTRACT_TO_LAYER_TYPES:
+            # NOTE: layers are built in a background task, that calls
+            #       on_loading_from_npz_completed when finished
             self.load_from_npz()
-            if self.output_type in ('avg_losses-rlzs',
-                                    'damages-rlzs',
-                                    'avg_losses-stats'):
-                # check if also aggregating by zone or not
-                if (not self.zonal_layer_cbx.currentText() or
-                        not self.zonal_layer_gbx.isChecked()):
-                    super().accept()
-                    return
-                self.aggregate_by_zone()
-            else:
-                super().accept()
         elif self.output_type in OQ_CSV_TO_LAYER_TYPES:
             self.load_from_csv()
             super().accept()
 
+    def on_loading_from_npz_completed(self):
+        if self.output_type in ('avg_losses-rlzs',
+                                'damages-rlzs',
+                                'avg_losses-stats'):
+            # check if also aggregating by zone or not
+            if (not self.zonal_layer_cbx.currentText() or
+                    not self.zonal_layer_gbx.isChecked()):
+                super().accept()
+                return
+            self.aggregate_by_zone()
+        else:
+            super().accept()
+
     def aggregate_by_zone(self):
         loss_layer = self.layer
         zonal_layer_id = self.zonal_layer_cbx.itemData(
@@ -1030,7 +1572,9 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
             zonal_layer.name(), self.loss_attr_name)
         discard_nonmatching = self.discard_nonmatching_chk.isChecked()
         try:
-            calculate_zonal_stats(
+            # NOTE: keeping a reference to the task, that calls
+            #       on_calculate_zonal_stats_completed when it is complete
+            self.aggregate_by_zone_task = calculate_zonal_stats(
                 self.on_calculate_zonal_stats_completed,
                 zonal_layer, loss_layer, [self.loss_attr_name],
                 zonal_layer_plus_sum_name,
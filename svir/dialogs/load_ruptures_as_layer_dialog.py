@@ -26,9 +26,8 @@ import gzip
 from collections import OrderedDict
 from qgis.PyQt.QtWidgets import QDialog
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsWkbTypes, edit, QgsTask, QgsApplication,
-    QgsProject)
-from svir.utilities.utils import log_msg, WaitCursorManager, zoom_to_group
+    QgsGeometry, QgsWkbTypes, QgsTask, QgsApplication, QgsProject)
+from svir.utilities.utils import log_msg, zoom_to_group
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
@@ -78,6 +77,8 @@ class LoadRupturesAsLayerDialog(LoadOutputAsLayerDialog):
                     message_bar=self.iface.messageBar())
             return
         self.load_from_npz()
+
+    def on_ruptures_loaded(self):
         QDialog.accept(self)
         self.loading_completed.emit(self)
 
@@ -116,6 +117,7 @@ class LoadRupturesAsLayerDialog(LoadOutputAsLayerDialog):
             rup_group = root.insertGroup(0, "Earthquake Ruptures")
         else:
             rup_group = None
+        layers_kwargs = []
         for wkt_geom_type in wkt_geom_types:
             if wkt_geom_type == QgsWkbTypes.Point:
                 layer_geom_type = "point"
@@ -132,33 +134,35 @@ class LoadRupturesAsLayerDialog(LoadOutputAsLayerDialog):
             else:
                 raise ValueError(
                     'Unexpected geometry type: %s' % wkt_geom_type)
-            with WaitCursorManager(
-                    'Creating layer for "%s" ruptures...' % layer_geom_type,
-                    self.iface.messageBar()):
-                # NOTE: adding to map in this method
-                self.layer = self.build_layer(
-                    boundaries=boundaries,
-                    geometry_type=layer_geom_type,
-                    wkt_geom_type=wkt_geom_type,
-                    row_wkt_geom_types=row_wkt_geom_types,
-                    add_to_group=rup_group,
-                    add_to_map=False)
-            style_by = self.style_by_cbx.itemData(
-                self.style_by_cbx.currentIndex())
-            if style_by == 'mag':
-                self.style_maps(self.layer, style_by,
-                                self.iface, self.output_type)
-            else:  # 'trt'
-                self.style_categorized(layer=self.layer, style_by=style_by)
-            if rup_group:
-                tree_node = rup_group
-            else:
-                tree_node = QgsProject.instance().layerTreeRoot()
-            QgsProject.instance().addMapLayer(self.layer, False)
-            tree_node.insertLayer(0, self.layer)
-            self.iface.setActiveLayer(self.layer)
-            log_msg('Layer %s was loaded successfully' % self.layer.name(),
-                    level='S', message_bar=self.iface.messageBar())
+            layers_kwargs.append(dict(
+                boundaries=boundaries,
+                geometry_type=layer_geom_type,
+                wkt_geom_type=wkt_geom_type,
+                row_wkt_geom_types=row_wkt_geom_types,
+                add_to_group=rup_group))
+        self.build_layers_in_task(
+            layers_kwargs, self.on_ruptures_layer_built,
+            self.on_ruptures_loaded)
+
+    def on_ruptures_layer_built(self, layer, kwargs):
+        style_by = self.style_by_cbx.itemData(
+            self.style_by_cbx.currentIndex())
+        if style_by == 'mag':
+            self.style_maps(layer, style_by,
+                            self.iface, self.output_type)
+        else:  # 'trt'
+            self.style_categorized(layer=layer, style_by=style_by)
+        # NOTE: adding to map after styling
+        rup_group = kwargs['add_to_group']
+        if rup_group:
+            tree_node = rup_group
+        else:
+            tree_node = QgsProject.instance().layerTreeRoot()
+        QgsProject.instance().addMapLayer(layer, False)
+        tree_node.insertLayer(0, layer)
+        self.iface.setActiveLayer(layer)
+        log_msg('Layer %s was loaded successfully' % layer.name(),
+                level='S', message_bar=self.iface.messageBar())
         if rup_group:
             zoom_to_group(rup_group)
         else:
@@ -167,25 +171,19 @@ class LoadRupturesAsLayerDialog(LoadOutputAsLayerDialog):
     def read_npz_into_layer(
             self, field_types, rlz_or_stat, boundaries,
             wkt_geom_type, row_wkt_geom_types, **kwargs):
-        with edit(self.layer):
-            feats = []
-            fields = self.layer.fields()
-            field_names = [field.name() for field in fields]
-            for row_idx, row in enumerate(self.npz_file['array']):
-                if row_wkt_geom_types[row_idx] != wkt_geom_type:
-                    continue
-                # add a feature
-                feat = QgsFeature(fields)
-                for field_name in field_names:
-                    value = row[field_name].item()
-                    if isinstance(value, bytes):
-                        value = value.decode('utf8')
-                    feat.setAttribute(field_name, value)
-                feat.setGeometry(QgsGeometry.fromWkt(
-                    boundaries[row_idx].decode('utf8')))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        data = self.npz_file['array']
+        row_idxs = [row_idx for row_idx in range(len(data))
+                    if row_wkt_geom_types[row_idx] == wkt_geom_type]
+        # NOTE: skipping the fid of layers written into GeoPackages
+        pk_idxs = self.layer.dataProvider().pkAttributeIndexes()
+        columns = {field.name(): data[field.name()][row_idxs]
+                   for field_idx, field in enumerate(self.layer.fields())
+                   if field_idx not in pk_idxs}
+        geometries = [QgsGeometry.fromWkt(boundaries[row_idx].decode('utf8'))
+                      for row_idx in row_idxs]
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, geometries=geometries)
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
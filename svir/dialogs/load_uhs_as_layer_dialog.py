@@ -23,9 +23,9 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 from qgis.core import (
-    QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication)
+    QgsTask, QgsApplication)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
-from svir.utilities.utils import log_msg, WaitCursorManager
+from svir.utilities.utils import log_msg
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
 
@@ -35,6 +35,8 @@ class LoadUhsAsLayerDialog(LoadOutputAsLayerDialog):
     as layer
     """
 
+    use_npz_provider = True
+
     def __init__(self, drive_engine_dlg, iface, viewer_dock, session, hostname,
                  calc_id, output_type='uhs', path=None, mode=None,
                  engine_version=None, calculation_mode=None):
@@ -108,34 +110,28 @@ class LoadUhsAsLayerDialog(LoadOutputAsLayerDialog):
 
     def read_npz_into_layer(self, field_names, **kwargs):
         poe = kwargs['poe']
-        with edit(self.layer):
-            lons = self.npz_file['all']['lon']
-            lats = self.npz_file['all']['lat']
-            feats = []
-            for row_idx, row in enumerate(self.dataset):
-                # add a feature
-                feat = QgsFeature(self.layer.fields())
-                for field_name_idx, field_name in enumerate(field_names):
-                    rlz_or_stat, imt = field_name.split('_')
-                    iml = row[rlz_or_stat][poe][imt].item()
-                    feat.setAttribute(field_name, iml)
-                feat.setGeometry(QgsGeometry.fromPointXY(
-                    QgsPointXY(lons[row_idx], lats[row_idx])))
-                feats.append(feat)
-            added_ok = self.layer.addFeatures(feats)
-            if not added_ok:
-                msg = 'There was a problem adding features to the layer.'
-                log_msg(msg, level='C', message_bar=self.iface.messageBar())
+        lons = self.npz_file['all']['lon']
+        lats = self.npz_file['all']['lat']
+        columns = {}
+        for field_name in field_names:
+            rlz_or_stat, imt = field_name.split('_')
+            columns[field_name] = self.dataset[rlz_or_stat][poe][imt]
+        added_ok = self.add_features_from_columns(
+            self.layer, columns, lons=lons, lats=lats)
+        if not added_ok:
+            msg = 'There was a problem adding features to the layer.'
+            log_msg(msg, level='C', message_bar=self.iface.messageBar())
         return self.layer
 
     def load_from_npz(self):
+        layers_kwargs = []
         for poe in self.poes:
             if (self.load_selected_only_ckb.isChecked()
                     and poe != self.poe_cbx.currentText()):
                 continue
-            with WaitCursorManager(
-                    'Creating layer for poe "%s"...'
-                    % poe, self.iface.messageBar()):
-                self.layer = self.build_layer(poe=poe)
-                self.style_curves()
-        return self.layer
+            layers_kwargs.append(dict(poe=poe))
+        self.build_layers_in_task(layers_kwargs, self.on_uhs_layer_built)
+
+    def on_uhs_layer_built(self, layer, kwargs):
+        self.add_layer_to_project(layer)
+        self.style_curves()
@@ -24,15 +24,17 @@
 
 
 import json
+from datetime import datetime
 from qgis.PyQt.QtCore import pyqtSlot, QSettings, Qt
-from qgis.PyQt.QtWidgets import QDialog, QColorDialog, QMessageBox
+from qgis.PyQt.QtWidgets import (
+    QDialog, QColorDialog, QMessageBox, QTableWidget, QTableWidgetItem,
+    QVBoxLayout, QDialogButtonBox, QAbstractItemView)
 from qgis.PyQt.QtGui import QPalette
 
 from qgis.core import (
     QgsGraduatedSymbolRenderer, QgsProject, Qgis, QgsApplication)
 from qgis.gui import QgsMessageBar
 
-from requests import Session
 from svir.dialogs.connection_profile_dialog import ConnectionProfileDialog
 from svir.utilities.utils import (
                                   get_irmt_version,
@@ -42,7 +44,10 @@ from svir.utilities.utils import (
                                   log_msg,
                                   WaitCursorManager,
                                   check_is_lockdown,
+                                  convert_bytes,
                                   )
+from svir.utilities.extract_cache import get_extract_cache
+from svir.utilities.engine_client import EngineSession
 from svir.utilities.shared import (
                                    DEFAULT_SETTINGS,
                                    DEFAULT_ENGINE_PROFILES,
@@ -104,6 +109,20 @@ class SettingsDialog(QDialog, FORM_CLASS):
                          DEFAULT_SETTINGS['log_level']))
         self.log_level_cbx.setCurrentIndex(
             self.log_level_cbx.findData(log_level))
+        max_plotted_curves = (
+            DEFAULT_SETTINGS['max_plotted_curves']
+            if restore_defaults
+            else mySettings.value(
+                'irmt/max_plotted_curves',
+                DEFAULT_SETTINGS['max_plotted_curves'], type=int))
+        self.max_plotted_curves_sbx.setValue(max_plotted_curves)
+        local_tag_aggregation = (
+            DEFAULT_SETTINGS['local_tag_aggregation']
+            if restore_defaults
+            else mySettings.value(
+                'irmt/local_tag_aggregation',
+                DEFAULT_SETTINGS['local_tag_aggregation'], type=bool))
+        self.local_tag_aggregation_ckb.setChecked(local_tag_aggregation)
 
         style = get_style(
             self.iface.activeLayer(),
@@ -113,6 +132,31 @@ class SettingsDialog(QDialog, FORM_CLASS):
         self.developer_mode_ckb.setChecked(developer_mode)
         self.enable_experimental_ckb.setChecked(experimental_enabled)
 
+        extract_cache_enabled = (
+            DEFAULT_SETTINGS['extract_cache_enabled']
+            if restore_defaults
+            else mySettings.value(
+                'irmt/extract_cache_enabled',
+                DEFAULT_SETTINGS['extract_cache_enabled'], type=bool))
+        extract_cache_max_size_mb = (
+            DEFAULT_SETTINGS['extract_cache_max_size_mb']
+            if restore_defaults
+            else mySettings.value(
+                'irmt/extract_cache_max_size_mb',
+                DEFAULT_SETTINGS['extract_cache_max_size_mb'], type=int))
+        self.extract_cache_enabled_ckb.setChecked(extract_cache_enabled)
+        self.extract_cache_max_size_sbx.setValue(extract_cache_max_size_mb)
+        self.update_extract_cache_usage()
+
+    def update_extract_cache_usage(self):
+        cache = get_extract_cache()
+        num_entries = len(cache.entries())
+        self.extract_cache_usage_lbl.setText('%s in %s extract%s' % (
+            convert_bytes(cache.total_size()), num_entries,
+            '' if num_entries == 1 else 's'))
+        self.extract_cache_inspect_btn.setEnabled(num_entries > 0)
+        self.extract_cache_purge_btn.setEnabled(num_entries > 0)
+
     def refresh_profile_cbxs(self, restore_defaults=False):
         self.engine_profile_cbx.blockSignals(True)
         self.engine_profile_cbx.clear()
@@ -156,6 +200,16 @@ class SettingsDialog(QDialog, FORM_CLASS):
         mySettings.setValue(
             'irmt/log_level',
             self.log_level_cbx.itemData(self.log_level_cbx.currentIndex()))
+        mySettings.setValue('irmt/max_plotted_curves',
+                            self.max_plotted_curves_sbx.value())
+        mySettings.setValue('irmt/local_tag_aggregation',
+                            self.local_tag_aggregation_ckb.isChecked())
+        mySettings.setValue('irmt/extract_cache_enabled',
+                            self.extract_cache_enabled_ckb.isChecked())
+        mySettings.setValue('irmt/extract_cache_max_size_mb',
+                            self.extract_cache_max_size_sbx.value())
+        # the limit might have been reduced
+        get_extract_cache().shrink()
 
         cur_eng_profile = self.engine_profile_cbx.currentText()
 
@@ -204,7 +258,7 @@ class SettingsDialog(QDialog, FORM_CLASS):
         profiles = json.loads(mySettings.value(
             'irmt/engine_profiles', default_profiles))
         profile = profiles[profile_name]
-        session = Session()
+        session = EngineSession()
         hostname, username, password = (profile['hostname'],
                                         profile['username'],
                                         profile['password'])
@@ -260,6 +314,48 @@ class SettingsDialog(QDialog, FORM_CLASS):
     def save_profiles(self, profiles):
         QSettings().setValue('irmt/engine_profiles', json.dumps(profiles))
 
+    @pyqtSlot()
+    def on_extract_cache_inspect_btn_clicked(self):
+        entries = get_extract_cache().entries()
+        col_names = ['Host', 'Calc ID', 'Output type', 'Parameters', 'Size',
+                     'Last access']
+        dlg = QDialog(self)
+        dlg.setWindowTitle('Cached extracts')
+        vbox = QVBoxLayout()
+        table = QTableWidget(len(entries), len(col_names))
+        table.setHorizontalHeaderLabels(col_names)
+        table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for row, entry in enumerate(entries):
+            last_access = datetime.fromtimestamp(
+                entry['last_access']).strftime('%Y/%m/%d %H:%M:%S')
+            values = [entry['hostname'], entry['calc_id'],
+                      entry['output_type'],
+                      json.dumps(entry['params']) if entry['params'] else '',
+                      convert_bytes(entry['size']), last_access]
+            for col, value in enumerate(values):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, value)
+                table.setItem(row, col, item)
+        table.resizeColumnsToContents()
+        vbox.addWidget(table)
+        button_box = QDialogButtonBox(QDialogButtonBox.Close)
+        button_box.rejected.connect(dlg.reject)
+        vbox.addWidget(button_box)
+        dlg.setLayout(vbox)
+        dlg.setMinimumSize(700, 400)
+        dlg.exec_()
+
+    @pyqtSlot()
+    def on_extract_cache_purge_btn_clicked(self):
+        msg = ("All the cached extracts will be deleted and they will be"
+               " downloaded again from the OpenQuake Engine server when"
+               " needed. Are you sure?")
+        reply = QMessageBox.question(
+            self, 'Warning', msg, QMessageBox.Yes, QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            get_extract_cache().purge()
+            self.update_extract_cache_usage()
+
     def select_color(self, button):
         initial = button.palette().color(QPalette.Button)
         color = QColorDialog.getColor(initial)
@@ -22,8 +22,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-from qgis.PyQt.QtCore import pyqtSlot
-from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox, QLabel, QHBoxLayout
+from qgis.PyQt.QtCore import pyqtSlot, Qt
+from qgis.PyQt.QtWidgets import (
+    QDialog, QDialogButtonBox, QLabel, QHBoxLayout, QProgressDialog)
 
 from svir.calculations.transformation_algs import (RANK_VARIANTS,
                                                    QUADRATIC_VARIANTS,
@@ -81,6 +82,25 @@ class TransformationDialog(QDialog, FORM_CLASS):
         self.set_ok_button()
         self.set_new_field_editable()
 
+    def create_progress_dialog(self, msg):
+        """
+        Create a modal progress dialog, displayed while the chosen
+        transformation is applied, through which the user can also cancel it.
+        Its setValue and wasCanceled methods can be passed to
+        ProcessLayer.transform_attribute as set_progress and is_canceled
+
+        :param msg: message describing the transformation being applied
+        :returns: a QProgressDialog
+        """
+        progress_dlg = QProgressDialog(
+            msg, 'Cancel', 0, 100, self.iface.mainWindow())
+        progress_dlg.setWindowTitle(self.windowTitle())
+        progress_dlg.setWindowModality(Qt.WindowModal)
+        # NOTE: it is displayed only if the transformation takes more than
+        #       the minimum duration (by default, 4 seconds)
+        progress_dlg.setValue(0)
+        return progress_dlg
+
     def set_ok_button(self):
         self.ok_button.setEnabled(
             self.fields_multiselect.selected_count() > 0)
@@ -24,6 +24,7 @@
 
 import sys
 import traceback
+import warnings
 import os
 import csv
 import numpy
@@ -31,7 +32,7 @@ import urllib
 from datetime import datetime
 from collections import OrderedDict
 
-from qgis.PyQt.QtCore import pyqtSlot, QSettings  # , Qt
+from qgis.PyQt.QtCore import pyqtSlot, QSettings, QTimer  # , Qt
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtWidgets import (
                                  QLabel,
@@ -46,20 +47,23 @@ from qgis.PyQt.QtWidgets import (
                                  QTableWidgetItem,
                                  )
 from qgis.gui import QgsVertexMarker
-from qgis.core import QgsMapLayer, QgsFeatureRequest, QgsWkbTypes
+from qgis.core import (
+    QgsMapLayer, QgsFeatureRequest, QgsWkbTypes, QgsPointXY)
 
 from svir.utilities.shared import (
+                                   DEFAULT_SETTINGS,
                                    OQ_TO_LAYER_TYPES,
                                    OQ_EXTRACT_TO_VIEW_TYPES,
                                    )
 from svir.utilities.utils import (get_ui_class,
                                   log_msg,
                                   clear_widgets_from_layout,
-                                  extract_npz,
-                                  get_loss_types,
                                   get_irmt_version,
-                                  WaitCursorManager,
                                   )
+from svir.utilities.curve_field_layout import CurveFieldLayout
+from svir.utilities.kd_tree import KDTree, densify_polyline
+from svir.utilities.extract_pool import ExtractPool
+from svir.calculations.tag_aggregation import TagAggregator
 from svir.ui.multi_select_combo_box import MultiSelectComboBox
 
 from svir import IS_MATPLOTLIB_INSTALLED
@@ -73,10 +77,39 @@ if IS_MATPLOTLIB_INSTALLED:
         NavigationToolbar2QT as NavigationToolbar)
     from matplotlib.figure import Figure
     from matplotlib.lines import Line2D
+    from matplotlib.collections import LineCollection
 
 
 FORM_CLASS = get_ui_class('ui_viewer_dock.ui')
 
+# curves are labeled in a legend only if they are at most this number
+MAX_LEGEND_CURVES = 20
+# percentiles delimiting the band drawn when many curves are summarized
+SUMMARY_PERCENTILES = (5, 95)
+# mouse motion events over the plot are handled at most once per this number
+# of milliseconds (about the frame rate)
+HOVER_INTERVAL_MS = 16
+# curves are highlighted when the mouse is closer than this number of points
+HOVER_TOLERANCE_POINTS = 5
+# tag filters are applied when the selection did not change for this number
+# of milliseconds
+FILTER_DEBOUNCE_MS = 300
+# extracts needed to load each type of output in the dock, that do not depend
+# on each other and are therefore requested concurrently as soon as the
+# output is loaded
+# returned by ViewerDock.aggregate_locally while the outputs by asset are
+# still being downloaded
+LOCAL_AGGREGATION_PENDING = object()
+PREFETCHED_EXTRACTS = {
+    'aggcurves': ('composite_risk_model.attrs', 'exposure_metadata'),
+    'aggcurves-stats': ('composite_risk_model.attrs', 'exposure_metadata'),
+    'damages-rlzs_aggr': (
+        'composite_risk_model.attrs', 'asset_tags', 'realizations'),
+    'avg_losses-rlzs_aggr': (
+        'composite_risk_model.attrs', 'asset_tags', 'realizations'),
+    'avg_losses-stats_aggr': ('composite_risk_model.attrs', 'asset_tags'),
+}
+
 
 class ViewerDock(QDockWidget, FORM_CLASS):
 
@@ -131,6 +164,38 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         self.was_loss_type_switched = False
         self.was_poe_switched = False
         self.current_abscissa = []
+        # index of the attributes of the curves of the current layer
+        self.field_layout = None
+        # extracts of the calculation whose output is loaded in the dock
+        self.extract_pool = None
+        # (hostname, calc_id) -> ExtractPool, so extracts are reused for the
+        # lifetime of the dock
+        self.extract_pools = {}
+        # (hostname, calc_id, output_type) -> TagAggregator of the outputs by
+        # asset (or None if they can not be aggregated locally)
+        self.tag_aggregators = {}
+        # (output_type, params) of the filtered extract being waited for
+        self.pending_filter = None
+        self.filter_request_id = 0
+        # incremented whenever an output is loaded, so the extracts of the
+        # previous one are ignored when they arrive
+        self.load_request_id = 0
+        # True while the extracts needed to display an output are downloaded
+        self.is_loading = False
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DEBOUNCE_MS)
+        self.filter_timer.timeout.connect(self.apply_filters)
+        # (vertices, site) of the curves currently plotted, in data
+        # coordinates
+        self.hover_curves = []
+        # k-d tree of the vertices of the plotted curves, in display
+        # coordinates, and the sites they belong to
+        self.hover_index = None
+        self.hover_index_key = None
+        self.hover_sites = None
+        # site -> (x, y), for the features of the active layer
+        self.site_coords = {}
         self.color_names = [
             name for name in QColor.colorNames() if name != 'white']
         self.line_styles = ["-", "--", "-.", ":"]
@@ -177,6 +242,11 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         self.toolbar_layout.insertWidget(0, self.plot_toolbar)
 
         self.plot_canvas.mpl_connect('motion_notify_event', self.on_plot_hover)
+        self.pending_hover_event = None
+        self.hover_timer = QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(HOVER_INTERVAL_MS)
+        self.hover_timer.timeout.connect(self.process_hover)
 
         self.table = QTableWidget()
         self.table.setSizePolicy(
@@ -454,6 +524,154 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         cbx.setEnabled(
             tag_name in self.tag_names_multiselect.get_selected_items())
 
+    def schedule_filters(self):
+        """
+        Apply the tag filters once the selection stops changing, so that
+        rapid changes cause a single extraction
+        """
+        self.filter_timer.start()
+
+    def apply_filters(self):
+        if self.output_type == 'damages-rlzs_aggr':
+            self.filter_damages_rlzs_aggr()
+        elif self.output_type in ('avg_losses-rlzs_aggr',
+                                  'avg_losses-stats_aggr'):
+            self.filter_avg_losses_rlzs_aggr()
+        elif self.output_type in ('aggcurves', 'aggcurves-stats'):
+            self.filter_agg_curves()
+
+    def extract_filtered(self, output_type, params, on_extracted,
+                         aggregate_locally=None):
+        """
+        Extract output_type with the given parameters and pass the result to
+        on_extracted. Results are reused when the same selection is made
+        again. If the extract is not available yet, it is downloaded in the
+        background. Requests made stale by a newer selection are canceled if
+        they did not start yet, otherwise their results are kept but not
+        displayed.
+
+        :param aggregate_locally: an optional callable returning the result
+            computed locally, None if the engine has to be asked, or
+            LOCAL_AGGREGATION_PENDING if the filters will be applied again
+            once the outputs by asset are available
+        """
+        self.filter_timer.stop()
+        self.filter_request_id += 1
+        request_id = self.filter_request_id
+        if (self.pending_filter is not None
+                and self.pending_filter != (output_type, params)):
+            self.extract_pool.cancel(*self.pending_filter)
+        self.pending_filter = None
+        if aggregate_locally is not None:
+            extracted = aggregate_locally()
+            if extracted is LOCAL_AGGREGATION_PENDING:
+                return
+            if extracted is not None:
+                self.is_loading = False
+                on_extracted(extracted)
+                return
+        if self.extract_pool.is_done(output_type, params):
+            # NOTE: it does not block, since the result is available
+            self.is_loading = False
+            on_extracted(self.extract_pool.result(output_type, params))
+            return
+        self.pending_filter = (output_type, params)
+        extract_pool = self.extract_pool
+
+        def on_done():
+            if (request_id != self.filter_request_id
+                    or extract_pool is not self.extract_pool):
+                return
+            self.pending_filter = None
+            self.is_loading = False
+            on_extracted(extract_pool.result(output_type, params))
+
+        self.extract_pool.fetch(output_type, params, callback=on_done)
+
+    def when_extracted(self, requests, on_extracted):
+        """
+        Call on_extracted with the results of the given extracts (see
+        ExtractPool.collect) as soon as all of them are available, unless
+        another output was loaded in the meantime
+        """
+        load_request_id = self.load_request_id
+        extract_pool = self.extract_pool
+
+        def on_collected(results):
+            if (load_request_id != self.load_request_id
+                    or extract_pool is not self.extract_pool):
+                return
+            on_extracted(*results)
+
+        extract_pool.collect(requests, on_collected)
+
+    def aggregate_locally(self, extract_name, field_names, params, num_rlzs,
+                          by_tag=None):
+        """
+        Sum the given fields of the assets selected by params, using the
+        outputs by asset (that are extracted only once) instead of asking
+        the engine to aggregate them
+
+        :param extract_name: name of the extract of the outputs by asset
+        :param num_rlzs: expected number of realizations or statistics
+        :param by_tag: if given, the sums are computed separately for each
+            value of this tag
+        :returns: a dict like the one extracted from the engine, None if
+            local aggregation is disabled or not possible, or
+            LOCAL_AGGREGATION_PENDING if the outputs by asset are being
+            downloaded (the filters are applied again when they arrive)
+        """
+        if not QSettings().value(
+                'irmt/local_tag_aggregation',
+                DEFAULT_SETTINGS['local_tag_aggregation'], type=bool):
+            return None
+        key = (self.extract_pool.hostname, self.extract_pool.calc_id,
+               extract_name)
+        if key not in self.tag_aggregators:
+            if not self.extract_pool.is_done(extract_name):
+
+                def on_outputs_by_asset_extracted(npz):
+                    if npz is None:
+                        # NOTE: the engine aggregates them instead, without
+                        #       requesting the outputs by asset again
+                        self.tag_aggregators[key] = None
+                    self.apply_filters()
+
+                self.when_extracted(
+                    [extract_name], on_outputs_by_asset_extracted)
+                return LOCAL_AGGREGATION_PENDING
+            # NOTE: it does not block, since the result is available
+            npz = self.extract_pool.result(extract_name)
+            try:
+                self.tag_aggregators[key] = (
+                    None if npz is None
+                    else TagAggregator.from_npz(npz, list(self.tags)))
+            except (IndexError, KeyError, ValueError) as exc:
+                log_msg('Unable to index the tags of %s' % extract_name,
+                        level='W', exception=exc)
+                self.tag_aggregators[key] = None
+        aggregator = self.tag_aggregators[key]
+        if (aggregator is None
+                or len(aggregator.rlzs_or_stats) != num_rlzs):
+            return None
+        try:
+            if by_tag is None:
+                sums = aggregator.aggregate(field_names, params)
+                return {} if sums is None else {'array': sums}
+            tag_values, sums = aggregator.aggregate_by_tag(
+                field_names, params, by_tag)
+        except KeyError as exc:
+            log_msg('Unable to aggregate %s locally (%s is missing): it will'
+                    ' be aggregated by the OpenQuake Engine' % (
+                        extract_name, exc), level='I')
+            return None
+        if not tag_values:
+            return {}
+        return {'array': sums,
+                'tags': numpy.array([
+                    ('%s=%s' % (by_tag, tag_value)).encode('utf8')
+                    for tag_value in tag_values])}
+
     def filter_damages_rlzs_aggr(self):
         # NOTE: self.tags is structured like:
         # {'taxonomy': {
@@ -486,12 +704,22 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                             params[tag_name].append(value)
                         else:
                             params[tag_name] = [value]
-        output_type = 'agg_damages/%s' % self.loss_type_cbx.currentText()
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            self.damages_rlzs_aggr = extract_npz(
-                self.session, self.hostname, self.calc_id, output_type,
-                message_bar=self.iface.messageBar(), params=params)
+        loss_type = self.loss_type_cbx.currentText()
+        output_type = 'agg_damages/%s' % loss_type
+        # NOTE: the columns of the aggregated damages are the damage states
+        #       followed by the consequences
+        field_names = [
+            '%s-%s' % (loss_type, name)
+            for name in ['no_damage'] + list(self.dmg_states[1:])
+            + list(self.consequences if self.consequences is not None
+                   else [])]
+        self.extract_filtered(
+            output_type, params, self.on_damages_rlzs_aggr_extracted,
+            aggregate_locally=lambda: self.aggregate_locally(
+                'damages-rlzs', field_names, params, self.rlz_cbx.count()))
+
+    def on_damages_rlzs_aggr_extracted(self, damages_rlzs_aggr):
+        self.damages_rlzs_aggr = damages_rlzs_aggr
         if (self.damages_rlzs_aggr is None
                 or 'array' not in self.damages_rlzs_aggr):
             msg = 'No data corresponds to the current selection'
@@ -518,11 +746,14 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                              if self.tags[tag_name]['values'][val]][0]
                 # NOTE: the oq-engine makes a urlencode on tag values
                 params[tag_name] = urllib.parse.quote_plus(tag_value)
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            self.agg_curves = extract_npz(
-                self.session, self.hostname, self.calc_id, 'agg_curves',
-                message_bar=self.iface.messageBar(), params=params)
+        self.extract_filtered(
+            'agg_curves', params, self.on_agg_curves_extracted)
+
+    def on_agg_curves_extracted(self, agg_curves):
+        if agg_curves is None:
+            self.clear_plot()
+            return
+        self.agg_curves = agg_curves
         self.draw_agg_curves(self.output_type)
 
     def filter_avg_losses_rlzs_aggr(self):
@@ -542,17 +773,35 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                             self.table.clear()
                             self.table.setRowCount(0)
                             self.table.setColumnCount(0)
+                            self.is_loading = False
                             return
                         if tag_name in params:
                             params[tag_name].append(value)
                         else:
                             params[tag_name] = [value]
-        to_extract = 'agg_losses/%s' % self.loss_type_cbx.currentText()
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            self.avg_losses_rlzs_aggr = extract_npz(
-                self.session, self.hostname, self.calc_id, to_extract,
-                message_bar=self.iface.messageBar(), params=params)
+        loss_type = self.loss_type_cbx.currentText()
+        to_extract = 'agg_losses/%s' % loss_type
+        star_tags = [tag_name for tag_name in params
+                     if '*' in params[tag_name]]
+
+        def aggregate_losses_locally():
+            aggregated = self.aggregate_locally(
+                'losses_by_asset', [loss_type], params, len(self.rlzs),
+                by_tag=star_tags[0] if star_tags else None)
+            if aggregated and aggregated is not LOCAL_AGGREGATION_PENDING:
+                # a single loss type is aggregated
+                aggregated['array'] = aggregated['array'][..., 0]
+            return aggregated
+
+        # NOTE: statistics by asset are not aggregated locally
+        self.extract_filtered(
+            to_extract, params, self.on_avg_losses_rlzs_aggr_extracted,
+            aggregate_locally=(
+                aggregate_losses_locally
+                if self.output_type == 'avg_losses-rlzs_aggr' else None))
+
+    def on_avg_losses_rlzs_aggr_extracted(self, avg_losses_rlzs_aggr):
+        self.avg_losses_rlzs_aggr = avg_losses_rlzs_aggr
         if (self.avg_losses_rlzs_aggr is None
                 or 'array' not in self.avg_losses_rlzs_aggr):
             msg = 'No data corresponds to the current selection'
@@ -575,13 +824,7 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                     self.tags[tag_name]['values'][value] = False
                     if self.tag_with_all_values == tag_name:
                         self.tag_with_all_values = None
-        if self.output_type == 'damages-rlzs_aggr':
-            self.filter_damages_rlzs_aggr()
-        elif self.output_type in ('avg_losses-rlzs_aggr',
-                                  'avg_losses-stats_aggr'):
-            self.filter_avg_losses_rlzs_aggr()
-        elif self.output_type in ('aggcurves', 'aggcurves-stats'):
-            self.filter_agg_curves()
+        self.schedule_filters()
 
     def update_selected_tag_values(self, tag_name):
         cbx = getattr(self, "%s_values_multiselect" % tag_name)
@@ -589,21 +832,15 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             self.tags[tag_name]['values'][tag_value] = True
         for tag_value in cbx.get_unselected_items():
             self.tags[tag_name]['values'][tag_value] = False
-        if self.output_type == 'damages-rlzs_aggr':
-            self.filter_damages_rlzs_aggr()
-        elif self.output_type in ('avg_losses-rlzs_aggr',
-                                  'avg_losses-stats_aggr',
-                                  'aggcurves', 'aggcurves-stats'):
+        if self.output_type in ('avg_losses-rlzs_aggr',
+                                'avg_losses-stats_aggr',
+                                'aggcurves', 'aggcurves-stats'):
             if "*" in cbx.get_selected_items():
                 self.tag_with_all_values = tag_name
             elif (self.tag_with_all_values == tag_name and
                     "*" in cbx.get_unselected_items()):
                 self.tag_with_all_values = None
-            if self.output_type in ('avg_losses-rlzs_aggr',
-                                    'avg_losses-stats_aggr'):
-                self.filter_avg_losses_rlzs_aggr()
-            elif self.output_type in ('aggcurves', 'aggcurves-stats'):
-                self.filter_agg_curves()
+        self.schedule_filters()
 
     def get_list_selected_tags_str(self):
         selected_tags = {tag_name: self.tags[tag_name]['values']
@@ -721,42 +958,60 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         self.engine_version = engine_version
         self.setVisible(True)
         self.raise_()
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            oqparam = extract_npz(
-                session, hostname, calc_id, 'oqparam',
+        self.filter_timer.stop()
+        self.pending_filter = None
+        self.load_request_id += 1
+        self.is_loading = True
+        if (hostname, calc_id) not in self.extract_pools:
+            self.extract_pools[(hostname, calc_id)] = ExtractPool(
+                session, hostname, calc_id,
                 message_bar=self.iface.messageBar())
+        self.extract_pool = self.extract_pools[(hostname, calc_id)]
+        self.extract_pool.session = session
         if output_type in ('aggcurves', 'aggcurves-stats'):
-            self.load_agg_curves(
-                calc_id, session, hostname, output_type, oqparam)
+            load_output = self.load_agg_curves
         elif output_type == 'damages-rlzs_aggr':
-            self.load_damages_rlzs_aggr(
-                calc_id, session, hostname, output_type, oqparam)
+            load_output = self.load_damages_rlzs_aggr
         elif output_type in ('avg_losses-rlzs_aggr',
                              'avg_losses-stats_aggr'):
-            self.load_avg_losses_rlzs_aggr(
-                calc_id, session, hostname, output_type, oqparam)
+            load_output = self.load_avg_losses_rlzs_aggr
         else:
             raise NotImplementedError(output_type)
+        # NOTE: the cost of loading the output is about the one of the
+        #       slowest extract, instead of the sum of all of them, and the
+        #       widgets are filled as the extracts arrive, without blocking
+        #       the GUI
+        self.extract_pool.prefetch(
+            ('oqparam',) + PREFETCHED_EXTRACTS.get(output_type, ()))
+
+        def on_oqparam_extracted(oqparam):
+            if oqparam is None:
+                self.is_loading = False
+                return
+            load_output(calc_id, session, hostname, output_type, oqparam)
+
+        self.when_extracted(['oqparam'], on_oqparam_extracted)
 
     def load_damages_rlzs_aggr(
             self, calc_id, session, hostname, output_type, oqparam):
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            composite_risk_model_attrs = extract_npz(
-                session, hostname, calc_id, 'composite_risk_model.attrs',
-                message_bar=self.iface.messageBar())
-        if composite_risk_model_attrs is None:
+        self.when_extracted(
+            ['composite_risk_model.attrs', 'asset_tags', 'realizations'],
+            lambda composite_risk_model_attrs, tags_npz, rlzs_npz:
+                self.on_damages_rlzs_aggr_metadata_extracted(
+                    oqparam, composite_risk_model_attrs, tags_npz, rlzs_npz))
+
+    def on_damages_rlzs_aggr_metadata_extracted(
+            self, oqparam, composite_risk_model_attrs, tags_npz, rlzs_npz):
+        if (composite_risk_model_attrs is None or tags_npz is None
+                or rlzs_npz is None):
+            self.is_loading = False
             return
         limit_states = composite_risk_model_attrs['limit_states']
         self.consequences = composite_risk_model_attrs['consequences']
         self.dmg_states = numpy.append(['no damage'], limit_states)
-        self._get_tags(session, hostname, calc_id, self.iface.messageBar(),
-                       with_star=False)
+        self._get_tags(tags_npz, with_star=False)
 
-        rlzs = self.get_rlzs(calc_id, session, hostname, oqparam)
-        if rlzs is None:
-            return
+        rlzs = self.get_rlzs(rlzs_npz, oqparam)
         self.rlz_cbx.blockSignals(True)
         self.rlz_cbx.clear()
         if len(rlzs) == 1:
@@ -810,14 +1065,7 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             if cbx is not None:
                 delattr(self, cbx_name)
 
-    def _get_tags(self, session, hostname, calc_id, message_bar, with_star):
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            tags_npz = extract_npz(
-                session, hostname, calc_id, 'asset_tags',
-                message_bar=message_bar)
-        if tags_npz is None:
-            return
+    def _get_tags(self, tags_npz, with_star):
         tags_list = []
         for tag_name in tags_npz:
             if tag_name in ['id', 'array', 'extra']:
@@ -840,31 +1088,36 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             if with_star:
                 self.tags[tag_name]['values']['*'] = False
 
-    def get_rlzs(self, calc_id, session, hostname, oqparam):
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            rlzs_npz = extract_npz(
-                session, hostname, calc_id, 'realizations',
-                message_bar=self.iface.messageBar())
-            if rlzs_npz is None:
-                return None
-            rlzs = [rlz[1].decode('utf-8')  # branch_path
-                    for rlz in rlzs_npz['array']]
-            if oqparam['collect_rlzs']:
-                rlzs = [rlzs[0]]
-            return rlzs
+    def get_rlzs(self, rlzs_npz, oqparam):
+        rlzs = [rlz[1].decode('utf-8')  # branch_path
+                for rlz in rlzs_npz['array']]
+        if oqparam['collect_rlzs']:
+            rlzs = [rlzs[0]]
+        return rlzs
 
     def load_avg_losses_rlzs_aggr(
             self, calc_id, session, hostname, output_type, oqparam):
+        requests = ['composite_risk_model.attrs', 'asset_tags']
         if self.output_type == 'avg_losses-rlzs_aggr':
-            self.rlzs = self.get_rlzs(calc_id, session, hostname, oqparam)
-            if self.rlzs is None:
-                return
-        self._get_tags(session, hostname, calc_id, self.iface.messageBar(),
-                       with_star=True)
+            requests.append('realizations')
+        self.when_extracted(
+            requests, lambda *extracted:
+                self.on_avg_losses_rlzs_aggr_metadata_extracted(
+                    oqparam, *extracted))
+
+    def on_avg_losses_rlzs_aggr_metadata_extracted(
+            self, oqparam, composite_risk_model_attrs, tags_npz,
+            rlzs_npz=None):
+        if (composite_risk_model_attrs is None or tags_npz is None
+                or (self.output_type == 'avg_losses-rlzs_aggr'
+                    and rlzs_npz is None)):
+            self.is_loading = False
+            return
+        if self.output_type == 'avg_losses-rlzs_aggr':
+            self.rlzs = self.get_rlzs(rlzs_npz, oqparam)
+        self._get_tags(tags_npz, with_star=True)
 
-        self.single_loss_types = get_loss_types(
-            session, hostname, calc_id, self.iface.messageBar())
+        self.single_loss_types = composite_risk_model_attrs['loss_types']
         loss_types = self.single_loss_types[:]
         # NOTE: we may want to add total_losses also in this case
         # if 'total_losses' in oqparam:
@@ -874,24 +1127,27 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         self.loss_type_cbx.addItems(loss_types)
         self.loss_type_cbx.blockSignals(False)
 
-        if self.output_type == 'avg_losses-stats_aggr':
-            to_extract = 'agg_losses/%s' % loss_types[0]
-            with WaitCursorManager(
-                    'Extracting...', message_bar=self.iface.messageBar()):
-                npz = extract_npz(session, hostname, calc_id, to_extract,
-                                  message_bar=self.iface.messageBar())
-            # stats might be unavailable in case of a single realization
-            if len(npz['stats']) == 0:
-                # NOTE: writing 'mean' instead of 'rlz-0' would be equivalent
-                self.stats = ['rlz-0']
-            else:
-                self.stats = npz['stats']
-
         self.tag_names_multiselect.clear()
         tag_names = sorted(self.tags.keys())
         self.tag_names_multiselect.add_unselected_items(tag_names)
         self.clear_tag_values_multiselects(tag_names)
 
+        if self.output_type == 'avg_losses-stats_aggr':
+            self.when_extracted(
+                ['agg_losses/%s' % loss_types[0]], self.on_stats_extracted)
+        else:
+            self.filter_avg_losses_rlzs_aggr()
+
+    def on_stats_extracted(self, npz):
+        if npz is None:
+            self.is_loading = False
+            return
+        # stats might be unavailable in case of a single realization
+        if len(npz['stats']) == 0:
+            # NOTE: writing 'mean' instead of 'rlz-0' would be equivalent
+            self.stats = ['rlz-0']
+        else:
+            self.stats = npz['stats']
         self.filter_avg_losses_rlzs_aggr()
 
     def get_total_loss_unit(self, total_losses):
@@ -911,20 +1167,20 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             params['kind'] = 'stats'
         else:
             raise NotImplementedError(output_type)
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            composite_risk_model_attrs = extract_npz(
-                session, hostname, calc_id, 'composite_risk_model.attrs',
-                message_bar=self.iface.messageBar())
-        if composite_risk_model_attrs is None:
-            return
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            self.exposure_metadata = extract_npz(
-                session, hostname, calc_id, 'exposure_metadata',
-                message_bar=self.iface.messageBar())
-        if self.exposure_metadata is None:
+        self.when_extracted(
+            ['composite_risk_model.attrs', 'exposure_metadata'],
+            lambda composite_risk_model_attrs, exposure_metadata:
+                self.on_agg_curves_metadata_extracted(
+                    output_type, oqparam, params, composite_risk_model_attrs,
+                    exposure_metadata))
+
+    def on_agg_curves_metadata_extracted(
+            self, output_type, oqparam, params, composite_risk_model_attrs,
+            exposure_metadata):
+        if composite_risk_model_attrs is None or exposure_metadata is None:
+            self.is_loading = False
             return
+        self.exposure_metadata = exposure_metadata
         self.aggregate_by = None
         if 'aggregate_by' in oqparam and len(oqparam['aggregate_by']):
             self._build_tags()
@@ -949,11 +1205,16 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         params['loss_type'] = self.loss_type_cbx.currentText()
         params['absolute'] = (
             True if self.abs_rel_cbx.currentText() == 'Absolute' else False)
-        with WaitCursorManager(
-                'Extracting...', message_bar=self.iface.messageBar()):
-            self.agg_curves = extract_npz(
-                session, hostname, calc_id, 'agg_curves',
-                message_bar=self.iface.messageBar(), params=params)
+        self.when_extracted(
+            [('agg_curves', params)],
+            lambda agg_curves: self.on_first_agg_curves_extracted(
+                output_type, oqparam, agg_curves))
+
+    def on_first_agg_curves_extracted(self, output_type, oqparam, agg_curves):
+        if agg_curves is None:
+            self.is_loading = False
+            return
+        self.agg_curves = agg_curves
         self.ep_cbx.blockSignals(True)
         self.ep_cbx.clear()
         self.ep_cbx.addItems(self.agg_curves['ep_field'])
@@ -1279,6 +1540,9 @@ class ViewerDock(QDockWidget, FORM_CLASS):
 
     def draw(self):
         self.plot.clear()
+        self.legend = None
+        self.hover_curves = []
+        self.hover_index = None
         gids = dict()
         if (hasattr(self, 'stats_multiselect')
                 and self.stats_multiselect is not None):
@@ -1296,24 +1560,44 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             self.clear_plot()
             return
 
-        num_plottable_curves = 0
+        curves = []  # (rlz_or_stat, site, curve)
+        num_flat_curves = 0
         for rlz_or_stat in selected_rlzs_or_stats:
-            for i, (site, curve) in enumerate(
-                    self.current_selection[rlz_or_stat].items()):
+            for site, curve in self.current_selection[rlz_or_stat].items():
                 # NOTE: it is needed if we need the y-axis to be log scale
                 if self.output_type == 'hcurves':
-                    if not any(curve['ordinates']):
-                        log_msg(
-                            'A flat hazard curve with all zero values was'
-                            ' found. It will not be displayed in the plot.',
-                            level='W', message_bar=self.iface.messageBar())
+                    if not numpy.nan_to_num(curve['ordinates']).any():
+                        num_flat_curves += 1
                         continue
-                feature = next(self.iface.activeLayer().getFeatures(
-                    QgsFeatureRequest().setFilterFid(site)))
-
-                lon = feature.geometry().asPoint().x()
-                lat = feature.geometry().asPoint().y()
+                curves.append((rlz_or_stat, site, curve))
+        if num_flat_curves:
+            log_msg(
+                '%s flat hazard curve(s) with all zero values were found.'
+                ' They will not be displayed in the plot.' % num_flat_curves,
+                level='W', message_bar=self.iface.messageBar())
+        if not curves:
+            self.clear_plot()
+            log_msg(
+                'No curves could be plotted.',
+                level='W', message_bar=self.iface.messageBar())
+            return
 
+        max_plotted_curves = QSettings().value(
+            'irmt/max_plotted_curves',
+            DEFAULT_SETTINGS['max_plotted_curves'], type=int)
+        numeric_abscissae = (self.field_layout is not None
+                             and not self.field_layout.non_numeric_abscissae)
+        is_summary = numeric_abscissae and len(curves) > max_plotted_curves
+        if is_summary:
+            self.draw_curves_summary(curves, selected_rlzs_or_stats)
+        elif numeric_abscissae and len(curves) > MAX_LEGEND_CURVES:
+            self.draw_curves_collection(curves)
+        else:
+            # NOTE: the coordinates of all the sites are read at once
+            coords = self.get_coordinates(
+                set(site for _, site, _ in curves))
+            for rlz_or_stat, site, curve in curves:
+                lon, lat = coords[site]
                 self.line, = self.plot.plot(
                     curve['abscissa'],
                     curve['ordinates'],
@@ -1325,13 +1609,8 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                     gid=str(site),
                     picker=5  # 5 points tolerance
                 )
-                num_plottable_curves += 1
-        if num_plottable_curves == 0:
-            self.clear_plot()
-            log_msg(
-                'No curves could be plotted.',
-                level='W', message_bar=self.iface.messageBar())
-            return
+                # NOTE: non-numeric abscissae are converted by matplotlib
+                self.hover_curves.append((self.line.get_xydata(), site))
 
         if self.output_type == 'hcurves':
             self.plot.set_xscale('log')
@@ -1379,9 +1658,14 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                                                              return_period)
             else:
                 title += ' (%s years)' % investigation_time
+        if is_summary:
+            title += '\nSummary of %s curves' % len(curves)
         self.plot.set_title(title)
         self.plot.grid(which='both')
-        if 1 <= count_lines <= 20:
+        if is_summary:
+            self.legend = self.plot.legend(
+                loc='best', fancybox=True, shadow=True, fontsize='small')
+        elif 1 <= count_lines <= MAX_LEGEND_CURVES:
             if self.output_type == 'uhs':
                 location = 'upper right'
             else:
@@ -1405,6 +1689,82 @@ class ViewerDock(QDockWidget, FORM_CLASS):
 
         self.plot_canvas.draw()
 
+    def get_coordinates(self, fids):
+        """
+        Get the coordinates of the given features of the active layer,
+        reading the ones that are not cached yet with a single request
+
+        :returns: a dict fid -> (x, y)
+        """
+        missing_fids = [fid for fid in fids if fid not in self.site_coords]
+        if missing_fids:
+            request = QgsFeatureRequest().setFilterFids(
+                missing_fids).setNoAttributes()
+            for feature in self.iface.activeLayer().getFeatures(request):
+                point = feature.geometry().asPoint()
+                self.site_coords[feature.id()] = (point.x(), point.y())
+        return {fid: self.site_coords[fid] for fid in fids
+                if fid in self.site_coords}
+
+    def draw_curves_collection(self, curves):
+        """
+        Draw many curves at once, as a single LineCollection (without
+        markers)
+
+        :param curves: list of (rlz_or_stat, site, curve)
+        """
+        segments = [numpy.column_stack(
+                        [curve['abscissa'], curve['ordinates']])
+                    for _, _, curve in curves]
+        self.hover_curves.extend(
+            (segment, site) for segment, (_, site, _) in zip(
+                segments, curves))
+        collection = LineCollection(
+            segments,
+            colors=[curve['color'] for _, _, curve in curves],
+            linestyles=[curve['line_style'] for _, _, curve in curves],
+            picker=5)  # 5 points tolerance
+        self.plot.add_collection(collection)
+        self.plot.autoscale_view()
+
+    def draw_curves_summary(self, curves, rlzs_or_stats):
+        """
+        Instead of drawing each curve, draw for each realization or
+        statistic the mean of the curves, a band between two percentiles and
+        the envelope of the curves
+
+        :param curves: list of (rlz_or_stat, site, curve)
+        :param rlzs_or_stats: the selected realizations or statistics
+        """
+        low_perc, high_perc = SUMMARY_PERCENTILES
+        for rlz_or_stat_idx, rlz_or_stat in enumerate(rlzs_or_stats):
+            stat_curves = [curve for curve_rlz_or_stat, _, curve in curves
+                           if curve_rlz_or_stat == rlz_or_stat]
+            if not stat_curves:
+                continue
+            abscissa = stat_curves[0]['abscissa']
+            ordinates = numpy.vstack(
+                [curve['ordinates'] for curve in stat_curves])
+            color = QColor(self.color_names[
+                rlz_or_stat_idx % len(self.color_names)]).darker(120).name()
+            with warnings.catch_warnings():
+                # NOTE: columns containing only missing values are nan
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                mean = numpy.nanmean(ordinates, axis=0)
+                low, high = numpy.nanpercentile(
+                    ordinates, SUMMARY_PERCENTILES, axis=0)
+                minimum = numpy.nanmin(ordinates, axis=0)
+                maximum = numpy.nanmax(ordinates, axis=0)
+            self.plot.fill_between(
+                abscissa, low, high, color=color, alpha=0.3,
+                label='%s (%s-%s percentiles)' % (
+                    rlz_or_stat, low_perc, high_perc))
+            self.plot.plot(abscissa, minimum, color=color, linestyle=':',
+                           label='%s (min-max)' % rlz_or_stat)
+            self.plot.plot(abscissa, maximum, color=color, linestyle=':')
+            self.plot.plot(abscissa, mean, color=color, linestyle='-',
+                           label='%s (mean)' % rlz_or_stat)
+
     def redraw(self, selected, deselected, _):
         """
         Accepting parameters from QgsVectorLayer selectionChanged signal
@@ -1442,125 +1802,68 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                     self.current_selection[rlz_or_stat] = {}
         if not selected_rlzs_or_stats or not self.current_selection:
             return
-        self.current_abscissa = []
-        request = QgsFeatureRequest().setFlags(
-            QgsFeatureRequest.NoGeometry).setFilterFids(selected)
-        for feature in self.iface.activeLayer().getFeatures(request):
-            if self.output_type == 'hcurves':
-                imt = self.imt_cbx.currentText()
-                imls = [field_name.split('_')[2]
-                        for field_name in self.field_names
-                        if (field_name.split('_')[0]
-                            == selected_rlzs_or_stats[0])
-                        and field_name.split('_')[1] == imt]
-                try:
-                    imls = [float(iml) for iml in imls]
-                except ValueError:
-                    log_msg('Intensity measure levels are not numeric',
-                            level='W', message_bar=self.iface.messageBar())
-                self.current_abscissa = imls
-            elif self.output_type == 'uhs':
-                err_msg = ("The selected layer does not contain uniform"
-                           " hazard spectra in the expected format.")
-                self.field_names = [field.name() for field in feature.fields()]
-                # reading from something like
-                # [u'rlz-000_PGA', u'rlz-000_SA(0.025)', ...]
-                # the first item can be PGA (but PGA can also be missing)
-                # and the length of the array of periods must be consistent
-                # with the length of or ordinates to plot
-                if self.field_names[0].endswith("PGA"):
-                    unique_periods = [0.0]  # Use 0.0 for PGA
+        if self.output_type == 'hcurves':
+            imt = self.imt_cbx.currentText()
+        elif self.output_type == 'uhs':
+            imt = None
+        else:
+            raise NotImplementedError(self.output_type)
+        if self.field_layout is None:
+            return
+        if self.field_layout.non_numeric_abscissae:
+            log_msg('Intensity measure levels are not numeric',
+                    level='W', message_bar=self.iface.messageBar())
+        keys = [(rlz_or_stat, imt) for rlz_or_stat in selected_rlzs_or_stats]
+        self.current_abscissa = self.field_layout.abscissae.get(keys[0], [])
+        # NOTE: the curves of all the selected features are read at once
+        feat_ids, ordinates = self.field_layout.fetch(
+            self.iface.activeLayer(), selected, keys)
+        for i, feat_id in enumerate(feat_ids):
+            for rlz_or_stat_idx, rlz_or_stat in enumerate(
+                    selected_rlzs_or_stats):
+                key = (rlz_or_stat, imt)
+                if key not in ordinates:
+                    continue
+                marker = self.markers[
+                    (i + rlz_or_stat_idx) % len(self.markers)]
+                if self.bw_chk.isChecked():
+                    line_styles_whole_cycles = (
+                        (i + rlz_or_stat_idx) // len(self.line_styles))
+                    # NOTE: 85 is approximately 256 / 3
+                    r = g = b = format(
+                        (85 * line_styles_whole_cycles) % 256, '02x')
+                    color_hex_str = "#%s%s%s" % (r, g, b)
+                    color = QColor(color_hex_str)
+                    color_hex = color.darker(120).name()
+                    # here I am using i in order to cycle through all the
+                    # line styles, regardless from the feature id
+                    # (otherwise I might easily repeat styles, that are a
+                    # small set of 4 items)
+                    line_style = self.line_styles[
+                        (i + rlz_or_stat_idx) % len(self.line_styles)]
                 else:
-                    unique_periods = []  # PGA is not there
-                # get the number between parenthesis
-                try:
-                    periods = [
-                        float(name[name.find("(") + 1: name.find(")")])
-                        for name in self.field_names
-                        if "(" in name]
-                    for period in periods:
-                        if period not in unique_periods:
-                            unique_periods.append(period)
-                except ValueError as exc:
-                    log_msg(err_msg, level='C',
-                            message_bar=self.iface.messageBar(),
-                            exception=exc)
-                    self.output_type_cbx.setCurrentIndex(-1)
-                    return
-                self.current_abscissa = unique_periods
-                break
-            else:
-                raise NotImplementedError(self.output_type)
-
-        for i, feature in enumerate(
-                self.iface.activeLayer().getFeatures(request)):
-            if (self.was_imt_switched
-                    or self.was_loss_type_switched
-                    or (feature.id() not in
-                        self.current_selection[selected_rlzs_or_stats[0]])
-                    or self.output_type == 'uhs'):
-                self.field_names = [
-                    field.name()
-                    for field in self.iface.activeLayer().fields()
-                    if field.name() != 'fid']
-                ordinates = dict()
-                marker = dict()
-                line_style = dict()
-                color_hex = dict()
-                for rlz_or_stat_idx, rlz_or_stat in enumerate(
-                        selected_rlzs_or_stats):
-                    if self.output_type == 'hcurves':
-                        imt = self.imt_cbx.currentText()
-                        ordinates[rlz_or_stat] = [
-                            feature[field_name]
-                            for field_name in self.field_names
-                            if field_name.split('_')[0] == rlz_or_stat
-                            and field_name.split('_')[1] == imt]
-                    elif self.output_type == 'uhs':
-                        ordinates[rlz_or_stat] = [
-                            feature[field_name]
-                            for field_name in self.field_names
-                            if field_name.split('_')[0] == rlz_or_stat]
-                    marker[rlz_or_stat] = self.markers[
-                        (i + rlz_or_stat_idx) % len(self.markers)]
-                    if self.bw_chk.isChecked():
-                        line_styles_whole_cycles = (
-                            (i + rlz_or_stat_idx) // len(self.line_styles))
-                        # NOTE: 85 is approximately 256 / 3
-                        r = g = b = format(
-                            (85 * line_styles_whole_cycles) % 256, '02x')
-                        color_hex_str = "#%s%s%s" % (r, g, b)
-                        color = QColor(color_hex_str)
-                        color_hex[rlz_or_stat] = color.darker(120).name()
-                        # here I am using i in order to cycle through all the
-                        # line styles, regardless from the feature id
-                        # (otherwise I might easily repeat styles, that are a
-                        # small set of 4 items)
-                        line_style[rlz_or_stat] = self.line_styles[
-                            (i + rlz_or_stat_idx) % len(self.line_styles)]
-                    else:
-                        # here I am using the feature id in order to keep a
-                        # matching between a curve and the corresponding point
-                        # in the map
-                        color_name = self.color_names[
-                            (feature.id() + rlz_or_stat_idx)
-                            % len(self.color_names)]
-                        color = QColor(color_name)
-                        color_hex[rlz_or_stat] = color.darker(120).name()
-                        line_style[rlz_or_stat] = "-"  # solid
-                    self.current_selection[rlz_or_stat][feature.id()] = {
-                        'abscissa': self.current_abscissa,
-                        'ordinates': ordinates[rlz_or_stat],
-                        'color': color_hex[rlz_or_stat],
-                        'line_style': line_style[rlz_or_stat],
-                        'marker': marker[rlz_or_stat],
-                    }
+                    # here I am using the feature id in order to keep a
+                    # matching between a curve and the corresponding point
+                    # in the map
+                    color_name = self.color_names[
+                        (feat_id + rlz_or_stat_idx) % len(self.color_names)]
+                    color = QColor(color_name)
+                    color_hex = color.darker(120).name()
+                    line_style = "-"  # solid
+                self.current_selection[rlz_or_stat][feat_id] = {
+                    'abscissa': self.current_abscissa,
+                    'ordinates': ordinates[key][i],
+                    'color': color_hex,
+                    'line_style': line_style,
+                    'marker': marker,
+                }
         self.was_imt_switched = False
         self.was_loss_type_switched = False
         self.draw()
 
     def layer_changed(self):
         self.calc_id = None
+        self.site_coords = {}
         self.clear_plot()
 
         self.remove_connects()
@@ -1580,19 +1883,23 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                 for rlz_or_stat in self.stats_multiselect.get_selected_items():
                     self.current_selection[rlz_or_stat] = {}
                 self.stats_multiselect.clear()
-                self.field_names = [
-                    field.name()
-                    for field in self.iface.activeLayer().fields()
-                    if field.name() != 'fid']
-                if self.output_type == 'hcurves':
-                    # fields names are like 'max_PGA_0.005'
-                    imts = sorted(set(
-                        [field_name.split('_')[1]
-                         for field_name in self.field_names]))
-                    self.imt_cbx.addItems(imts)
-                self.rlzs_or_stats = sorted(set(
-                    [field_name.split('_')[0]
-                     for field_name in self.field_names]))
+                # NOTE: the attributes containing each curve are found once,
+                #       instead of parsing field names at each selection
+                try:
+                    self.field_layout = CurveFieldLayout(
+                        self.iface.activeLayer().fields(), self.output_type)
+                except ValueError as exc:
+                    err_msg = ("The selected layer does not contain uniform"
+                               " hazard spectra in the expected format.")
+                    log_msg(err_msg, level='C',
+                            message_bar=self.iface.messageBar(),
+                            exception=exc)
+                    self.field_layout = None
+                    self.rlzs_or_stats = []
+                else:
+                    if self.output_type == 'hcurves':
+                        self.imt_cbx.addItems(self.field_layout.imts)
+                    self.rlzs_or_stats = self.field_layout.rlzs_or_stats
                 # Select all stats by default
                 self.stats_multiselect.add_selected_items(self.rlzs_or_stats)
                 self.stats_multiselect.setEnabled(len(self.rlzs_or_stats) > 1)
@@ -1640,6 +1947,8 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             self.plot.clear()
             self.plot_canvas.draw()
             self.vertex_marker.hide()
+            self.hover_curves = []
+            self.hover_index = None
 
     def clear_imt_cbx(self):
         if hasattr(self, 'imt_cbx') and self.imt_cbx is not None:
@@ -1672,25 +1981,77 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                 log_msg(msg, level='W')
 
     def on_plot_hover(self, event):
-        if not self.on_container_hover(event, self.plot):
-            if hasattr(self.legend, 'get_lines'):
-                self.on_container_hover(event, self.legend)
-
-    def on_container_hover(self, event, container):
-        if self.output_type in OQ_EXTRACT_TO_VIEW_TYPES:
-            return False
-        for line in container.get_lines():
-            if line.contains(event)[0]:
-                # matplotlib needs a string when exporting to svg, so here we
-                # must cast back to long
-                fid = int(line.get_gid())
-                feature = self.iface.activeLayer().getFeature(fid)
-                self.vertex_marker.setCenter(feature.geometry().asPoint())
-                self.vertex_marker.show()
-                return True
-            else:
-                self.vertex_marker.hide()
-        return False
+        # NOTE: only the latest event is handled when the timer expires, so
+        #       the plot is searched at most once per frame
+        self.pending_hover_event = event
+        if not self.hover_timer.isActive():
+            self.hover_timer.start()
+
+    def process_hover(self):
+        event = self.pending_hover_event
+        self.pending_hover_event = None
+        if event is None or self.output_type in OQ_EXTRACT_TO_VIEW_TYPES:
+            return
+        site = None
+        if event.inaxes is self.plot and self.hover_curves:
+            tolerance = (HOVER_TOLERANCE_POINTS
+                         * self.plot_figure.dpi / 72.0)
+            idx, _ = self.get_hover_index().query(
+                (event.x, event.y), max_distance=tolerance)
+            if idx is not None:
+                site = int(self.hover_sites[idx])
+        if site is None and hasattr(self.legend, 'get_lines'):
+            for line in self.legend.get_lines():
+                if line.get_gid() is None:
+                    # e.g. lines summarizing many curves
+                    continue
+                if line.contains(event)[0]:
+                    # matplotlib needs a string when exporting to svg, so
+                    # here we must cast back to long
+                    site = int(line.get_gid())
+                    break
+        if site is None or site not in self.get_coordinates([site]):
+            self.vertex_marker.hide()
+            return
+        self.vertex_marker.setCenter(QgsPointXY(*self.site_coords[site]))
+        self.vertex_marker.show()
+
+    def get_hover_index(self):
+        """
+        Get the k-d tree of the plotted curves, in display coordinates,
+        building it again only if the data or the limits, scales or size of
+        the axes changed since it was built. Curves are sampled at half the
+        hover tolerance, so the mouse is close to a sample whenever it is
+        close to a segment between two vertices.
+        """
+        key = (self.plot.get_xlim(), self.plot.get_ylim(),
+               self.plot.get_xscale(), self.plot.get_yscale(),
+               tuple(self.plot.bbox.bounds), self.plot_figure.dpi)
+        if self.hover_index is not None and key == self.hover_index_key:
+            return self.hover_index
+        tolerance = HOVER_TOLERANCE_POINTS * self.plot_figure.dpi / 72.0
+        xmin, ymin, width, height = self.plot.bbox.bounds
+        bounds = (xmin - tolerance, ymin - tolerance,
+                  xmin + width + tolerance, ymin + height + tolerance)
+        points = []
+        sites = []
+        for vertices, site in self.hover_curves:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                vertices = self.plot.transData.transform(
+                    numpy.asarray(vertices, dtype=numpy.float64))
+            # e.g. zeros in log scale
+            vertices = vertices[numpy.isfinite(vertices).all(axis=1)]
+            vertices = densify_polyline(vertices, tolerance / 2, bounds)
+            points.append(vertices)
+            sites.append(numpy.full(len(vertices), site))
+        if points:
+            self.hover_index = KDTree(numpy.concatenate(points))
+            self.hover_sites = numpy.concatenate(sites)
+        else:
+            self.hover_index = KDTree(numpy.empty((0, 2)))
+            self.hover_sites = numpy.empty(0, dtype=int)
+        self.hover_index_key = key
+        return self.hover_index
 
     def on_multivalue_tag_name_changed(self):
         selected_tag_name = self.multivalue_tag_cbx.currentText()
@@ -1699,7 +2060,7 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             cbx = getattr(self, "%s_values_multiselect" % tag_name)
             if tag_name != selected_tag_name:
                 cbx.set_idxs_selection([0], checked=True)
-        self.filter_agg_curves()
+        self.schedule_filters()
 
     def on_imt_changed(self):
         self.was_imt_switched = True
@@ -2004,6 +2365,7 @@ class ViewerDock(QDockWidget, FORM_CLASS):
 
     def closeEvent(self, event):
         self.action.setChecked(False)
+        self.filter_timer.stop()
         event.accept()
 
     def change_output_type(self, output_type):
@@ -59,14 +59,16 @@ from svir.dialogs.drive_oq_engine_server_dialog import (
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
 
 from svir.calculations.process_layer import ProcessLayer
+from svir.calculations.classification import watch_classification_cache
 from svir.utilities.utils import (
-                                  WaitCursorManager,
                                   clear_progress_message_bar,
                                   log_msg,
                                   get_checksum,
                                   warn_missing_packages,
                                   )
 from svir.utilities.shared import DEBUG, OQ_XMARKER_TYPES
+from svir.utilities.npz_provider import register_npz_provider
+from svir.utilities.lazy_styles import restore_lazy_styles
 from svir.ui.tool_button_with_help_link import QToolButtonWithHelpLink
 from svir.processing_provider.provider import Provider
 
@@ -161,6 +163,11 @@ class Irmt(object):
             # the warning should have already been displayed by the __init__
             return
         self.initProcessing()
+        # NOTE: the provider can not be unregistered, so it is registered
+        #       only the first time the plugin is loaded
+        if not register_npz_provider():
+            log_msg('Unable to register the NPZ data provider. Outputs will'
+                    ' be loaded as memory layers.', level='W')
         # create our own toolbar
         self.toolbar = self.iface.addToolBar('OpenQuake IRMT')
         self.toolbar.setObjectName('IRMTToolBar')
@@ -382,7 +389,18 @@ class Irmt(object):
         url = QUrl.fromLocalFile(base_url)
         QDesktopServices.openUrl(url)
 
-    def layers_added(self):
+    def layers_added(self, layers=()):
+        for layer in layers:
+            if layer.type() == QgsMapLayer.VectorLayer:
+                # e.g. hazard maps with a style per field, loaded from a
+                # project
+                restore_lazy_styles(
+                    layer, LoadOutputAsLayerDialog.make_field_style_function(
+                        self.iface, layer.customProperty('output_type')))
+                if layer.customProperty('calc_id') is not None:
+                    # classifications cached on the layer become stale if
+                    # its values are edited
+                    watch_classification_cache(layer)
         self.update_actions_status()
 
     def layers_removed(self, layer_ids):
@@ -593,14 +611,24 @@ class Irmt(object):
                 try:
                     msg = "Applying '%s' transformation to field '%s'" % (
                         algorithm_name, input_attr_name)
-                    with WaitCursorManager(msg, self.iface.messageBar()):
-                        res_attr_name, invalid_input_values = ProcessLayer(
-                            layer).transform_attribute(input_attr_name,
-                                                       algorithm_name,
-                                                       variant,
-                                                       inverse,
-                                                       target_attr_name,
-                                                       target_attr_alias)
+                    progress_dlg = dlg.create_progress_dialog(msg)
+                    try:
+                        result = ProcessLayer(layer).transform_attribute(
+                            input_attr_name, algorithm_name, variant, inverse,
+                            target_attr_name, target_attr_alias,
+                            set_progress=lambda percentage: (
+                                progress_dlg.setValue(int(percentage))),
+                            is_canceled=progress_dlg.wasCanceled)
+                    finally:
+                        progress_dlg.close()
+                    if result is None:
+                        msg = ('Transformation of attribute %s of layer %s'
+                               ' has been canceled.') % (input_attr_name,
+                                                         layer.name())
+                        log_msg(msg, level='W',
+                                message_bar=self.iface.messageBar())
+                        break
+                    res_attr_name, invalid_input_values = result
                     msg = ('Transformation %s has been applied to attribute %s'
                            ' of layer %s.') % (algorithm_name,
                                                input_attr_name,
@@ -620,7 +648,8 @@ class Irmt(object):
                     level = 'S' if not invalid_input_values else 'W'
                     log_msg(msg, level=level,
                             message_bar=self.iface.messageBar())
-                except (ValueError, NotImplementedError, TypeError) as e:
+                except (ValueError, NotImplementedError, TypeError,
+                        RuntimeError) as e:
                     log_msg(str(e), level='C',
                             message_bar=self.iface.messageBar(),
                             exception=e)
@@ -24,11 +24,9 @@
 
 from numpy import nan
 from qgis.core import (
-                       NULL,
                        QgsProcessingParameterEnum,
                        )
 from svir.processing_provider.transform_fields import TransformFieldsAlgorithm
-from svir.calculations.transformation_algs import log10_
 
 
 class Log10Algorithm(TransformFieldsAlgorithm):
@@ -73,18 +71,5 @@ class Log10Algorithm(TransformFieldsAlgorithm):
         variant = [self.variants[i][0]
                    for i in self.parameterAsEnums(
                        parameters, self.VARIANT, context)][0]
-        # TODO: to avoid this, slightly change the called function
-        original_non_missing = [value for value in original_values
-                                if value is not None]
-        transformed_non_missing, _ = log10_(
-            original_non_missing, variant_name=variant)
-        transformed_values = [None] * len(original_values)
-        j = 0
-        for i in range(len(original_values)):
-            if original_values[i] is None:
-                continue
-            transformed_values[i] = transformed_non_missing[j]
-            if transformed_values[i] == NULL:
-                transformed_values[i] = nan
-            j += 1
-        return transformed_values
+        return self.transform_column_values(
+            original_values, 'LOG10', variant, invalid_value=nan)
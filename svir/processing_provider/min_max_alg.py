@@ -24,7 +24,6 @@
 
 from qgis.core import QgsProcessingParameterBoolean
 from svir.processing_provider.transform_fields import TransformFieldsAlgorithm
-from svir.calculations.transformation_algs import min_max
 
 
 class MinMaxAlgorithm(TransformFieldsAlgorithm):
@@ -62,5 +61,5 @@ class MinMaxAlgorithm(TransformFieldsAlgorithm):
 
     def transform_values(self, original_values, parameters, context):
         inverse = self.parameterAsBool(parameters, self.INVERSE, context)
-        transformed_values, _ = min_max(original_values, inverse=inverse)
-        return transformed_values
+        return self.transform_column_values(
+            original_values, 'MIN_MAX', inverse=inverse)
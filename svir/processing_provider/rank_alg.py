@@ -27,7 +27,6 @@ from qgis.core import (
                        QgsProcessingParameterEnum,
                        )
 from svir.processing_provider.transform_fields import TransformFieldsAlgorithm
-from svir.calculations.transformation_algs import rank
 
 
 class RankAlgorithm(TransformFieldsAlgorithm):
@@ -79,15 +78,5 @@ class RankAlgorithm(TransformFieldsAlgorithm):
         variant = [self.variants[i][0]
                    for i in self.parameterAsEnums(
                        parameters, self.VARIANT, context)][0]
-        original_non_missing = [value for value in original_values
-                                if value is not None]
-        transformed_non_missing, _ = rank(
-            original_non_missing, inverse=inverse, variant_name=variant)
-        transformed_values = [None] * len(original_values)
-        j = 0
-        for i in range(len(original_values)):
-            if original_values[i] is None:
-                continue
-            transformed_values[i] = transformed_non_missing[j]
-            j += 1
-        return transformed_values
+        return self.transform_column_values(
+            original_values, 'RANK', variant, inverse)
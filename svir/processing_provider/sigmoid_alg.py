@@ -22,9 +22,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterBoolean, NULL
 from svir.processing_provider.transform_fields import TransformFieldsAlgorithm
-from svir.calculations.transformation_algs import sigmoid
 
 
 class SigmoidAlgorithm(TransformFieldsAlgorithm):
@@ -71,5 +70,5 @@ class SigmoidAlgorithm(TransformFieldsAlgorithm):
 
     def transform_values(self, original_values, parameters, context):
         inverse = self.parameterAsBool(parameters, self.INVERSE, context)
-        transformed_values, _ = sigmoid(original_values, inverse=inverse)
-        return transformed_values
+        return self.transform_column_values(
+            original_values, 'SIGMOID', inverse=inverse, invalid_value=NULL)
@@ -31,13 +31,15 @@ from qgis.core import (
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField,
                        QgsFeatureSink,
+                       QgsFeatureRequest,
                        QgsFeature,
                        QgsField,
                        QgsFields,
                        QgsProcessingException,
                        QgsProcessingParameterFeatureSink)
-from processing.tools import vector
 from svir.utilities.shared import DOUBLE_FIELD_TYPE
+from svir.calculations.transformation_algs import (
+    to_column, from_column, transform_column)
 
 
 class TransformFieldsAlgorithm(QgsProcessingAlgorithm):
@@ -53,6 +55,11 @@ class TransformFieldsAlgorithm(QgsProcessingAlgorithm):
     FIELDS_TO_TRANSFORM = 'FIELDS_TO_TRANSFORM'
     OUTPUT = 'OUTPUT'
 
+    # number of features added to the sink at once
+    BATCH_SIZE = 10000
+    # number of features processed between two updates of the progress bar
+    PROGRESS_STEP = 1000
+
     def tr(self, string):
         """
         Returns a translatable string with the self.tr() function.
@@ -117,6 +124,27 @@ class TransformFieldsAlgorithm(QgsProcessingAlgorithm):
     def svgIconPath(self):
         return QIcon(":/plugins/irmt/transform.svg")
 
+    def transform_column_values(self, original_values, algorithm_name,
+                                variant_name="", inverse=False,
+                                invalid_value=None):
+        """
+        Transform a list of values, that can contain missing values (None),
+        using the columnar transformation engine
+
+        :param original_values: list of values of a field
+        :param algorithm_name: name of the transformation algorithm
+        :param variant_name: name of the algorithm variant
+        :param inverse: whether to perform the inverse transformation
+        :param invalid_value: value to be used for inputs that can not be
+                              transformed
+        :returns: list of transformed values (None for missing values)
+        """
+        values, valid = to_column(original_values)
+        output, output_valid, _ = transform_column(
+            values, valid, algorithm_name, variant_name, inverse)
+        return from_column(output, output_valid, valid,
+                           missing_value=None, invalid_value=invalid_value)
+
     def initAlgorithm(self, config=None):
         """
         Here we define the inputs and output of the algorithm, along
@@ -191,13 +219,14 @@ class TransformFieldsAlgorithm(QgsProcessingAlgorithm):
 
         transformation_name = self.name()
 
+        # indices of the fields that will actually be transformed
         fields_to_transform_idxs = []
         for f in fields_to_transform:
-            idx = source.fields().lookupField(f)
+            idx = source_fields.lookupField(f)
             if idx >= 0:
-                fields_to_transform_idxs.append(idx)
-                field_to_transform = source.fields().at(idx)
+                field_to_transform = source_fields.at(idx)
                 if field_to_transform.isNumeric():
+                    fields_to_transform_idxs.append(idx)
                     transformed_field = QgsField(field_to_transform)
                     transformed_field.setName(
                         "%s_%s" % (field_to_transform.name(),
@@ -230,44 +259,64 @@ class TransformFieldsAlgorithm(QgsProcessingAlgorithm):
             raise QgsProcessingException(
                 self.invalidSinkError(parameters, self.OUTPUT))
 
-        total = 100.0 / len(fields_to_transform)
-        transformed_values = {}
-
-        for current, fieldname_to_transform in enumerate(fields_to_transform):
-            original_values = vector.values(
-                source, fieldname_to_transform)[fieldname_to_transform]
-            transformed_values[fieldname_to_transform] = self.transform_values(
-                original_values, parameters, context)
-            feedback.setProgress(int(current * total))
-
-        feedback.setProgress(0)
-
-        # Compute the number of steps to display within the progress bar and
-        # get features from source
-        total = 100.0 / source.featureCount() if source.featureCount() else 0
-
+        # Compute the number of steps to display within the progress bar
+        # (half of them for reading and transforming, half for writing)
+        feature_count = source.featureCount()
+        total = 50.0 / feature_count if feature_count else 0
+
+        # Read the values of all the fields to transform in a single pass,
+        # without retrieving geometries, keeping track of the feature ids
+        request = QgsFeatureRequest().setFlags(
+            QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(
+                fields_to_transform_idxs)
+        row_by_fid = {}
+        original_values = [[] for _ in fields_to_transform_idxs]
+        for current, source_feature in enumerate(
+                source.getFeatures(request)):
+            if feedback.isCanceled():
+                return {self.OUTPUT: self.dest_id}
+            row_by_fid[source_feature.id()] = current
+            attributes = source_feature.attributes()
+            for field_values, idx in zip(
+                    original_values, fields_to_transform_idxs):
+                field_values.append(attributes[idx])
+            if current % self.PROGRESS_STEP == 0:
+                feedback.setProgress(int(current * total))
+
+        transformed_values = [
+            self.transform_values(field_values, parameters, context)
+            for field_values in original_values]
+        del original_values
+
+        # Copy the original features, adding the transformed values (looked
+        # up by feature id, since the order of the features is not
+        # guaranteed to be the same), and write them in batches
+        batch = []
         for current, source_feature in enumerate(source.getFeatures()):
             # Stop the algorithm if cancel button has been clicked
             if feedback.isCanceled():
                 break
 
             sink_feature = QgsFeature(out_fields)
-
-            # copy original fields
-            for field in source.fields():
-                sink_feature[field.name()] = source_feature[field.name()]
-
-            for original_fieldname, transformed_field in zip(
-                    fields_to_transform, self.transformed_fields):
-                sink_feature[transformed_field.name()] = \
-                    transformed_values[original_fieldname][current]
+            attributes = source_feature.attributes()
+            row = row_by_fid[source_feature.id()]
+            attributes.extend(
+                field_values[row] for field_values in transformed_values)
+            sink_feature.setAttributes(attributes)
             sink_feature.setGeometry(source_feature.geometry())
+            batch.append(sink_feature)
 
-            # Add a feature in the sink
-            sink.addFeature(sink_feature, QgsFeatureSink.FastInsert)
+            if len(batch) == self.BATCH_SIZE:
+                # Add features in the sink
+                sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                batch = []
 
             # Update the progress bar
-            feedback.setProgress(int(current * total))
+            if current % self.PROGRESS_STEP == 0:
+                feedback.setProgress(50 + int(current * total))
+        if batch:
+            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+        feedback.setProgress(100)
 
         # Return the results of the algorithm. In this case our only result is
         # the feature sink which contains the processed features, but some
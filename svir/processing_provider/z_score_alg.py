@@ -24,7 +24,6 @@
 
 from qgis.core import QgsProcessingParameterBoolean
 from svir.processing_provider.transform_fields import TransformFieldsAlgorithm
-from svir.calculations.transformation_algs import z_score
 
 
 class ZScoreAlgorithm(TransformFieldsAlgorithm):
@@ -67,5 +66,5 @@ class ZScoreAlgorithm(TransformFieldsAlgorithm):
 
     def transform_values(self, original_values, parameters, context):
         inverse = self.parameterAsBool(parameters, self.INVERSE, context)
-        transformed_values, _ = z_score(original_values, inverse=inverse)
-        return transformed_values
+        return self.transform_column_values(
+            original_values, 'Z_SCORE', inverse=inverse)
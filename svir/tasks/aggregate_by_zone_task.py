@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-06-17
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.core import QgsTask, QgsApplication, QgsProject
+from qgis.PyQt.QtCore import pyqtSignal
+from svir.calculations.aggregate_loss_by_zone import (
+    aggregate_by_zone, snapshot_layer)
+from svir.utilities.utils import log_msg
+
+
+class AggregateByZoneTask(QgsTask):
+    """
+    Task aggregating the values of the points of a layer by the zones of
+    another layer (see calculate_zonal_stats). When the task is complete
+    (or terminated), zonal_stats_completed is emitted, passing the output
+    layer, or None in case of failure.
+
+    :param zones_key: the key of the zonal layer in the cache of the zones
+        matching each site (see ZoneAssignmentCache), or None to avoid
+        caching them
+    """
+
+    zonal_stats_completed = pyqtSignal(object)
+
+    def __init__(self, description, zonal_layer, points_layer, join_fields,
+                 output_layer_name, discard_nonmatching=False,
+                 predicates=('intersects',), summaries=('sum',),
+                 zones_key=None):
+        super().__init__(description, QgsTask.CanCancel)
+        # NOTE: layers can not be used outside the main thread, so their
+        #       features are read from snapshots
+        self.zones = snapshot_layer(zonal_layer)
+        self.zones_key = zones_key
+        self.points = snapshot_layer(points_layer)
+        self.transform_context = QgsProject.instance().transformContext()
+        self.join_fields = join_fields
+        self.output_layer_name = output_layer_name
+        self.discard_nonmatching = discard_nonmatching
+        self.predicates = predicates
+        self.summaries = summaries
+        self.output_layer = None
+        self.exception = None
+
+    def run(self):
+        try:
+            self.output_layer = aggregate_by_zone(
+                self.zones, self.points, self.join_fields,
+                self.output_layer_name,
+                discard_nonmatching=self.discard_nonmatching,
+                predicates=self.predicates, summaries=self.summaries,
+                transform_context=self.transform_context,
+                is_canceled=self.isCanceled, set_progress=self.setProgress,
+                zones_key=self.zones_key)
+        except Exception as exc:
+            self.exception = exc
+            return False
+        if self.output_layer is None:  # canceled
+            return False
+        # NOTE: the layer was created in this thread, but it will be used by
+        #       the main thread from now on
+        self.output_layer.moveToThread(QgsApplication.instance().thread())
+        return True
+
+    def finished(self, success):
+        if not success:
+            if self.exception is not None:
+                log_msg('Unable to aggregate points by zone', level='W',
+                        exception=self.exception)
+            self.output_layer = None
+        self.zonal_stats_completed.emit(self.output_layer)
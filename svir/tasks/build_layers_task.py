@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-06-10
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.core import QgsTask, QgsApplication
+from svir.tasks.extract_npz_task import TaskCanceled
+
+
+class BuildLayersTask(QgsTask):
+    """
+    Task building one or more memory layers from the data extracted by a
+    loader dialog, without blocking the main thread.
+
+    Layers are created and populated in the background by the dialog's
+    create_layer method, then they are handed back to the main thread,
+    where on_layer_built is called for each of them (e.g. to add it to the
+    project and to style it), followed by on_success.
+
+    :param description: description of the task
+    :param flags: task flags (e.g. QgsTask.CanCancel)
+    :param dlg: the loader dialog (a LoadOutputAsLayerDialog)
+    :param layers_kwargs: list of dicts, each containing the keyword
+        arguments to be passed to dlg.create_layer to build one layer
+    :param on_layer_built: callback called in the main thread for each
+        layer, with the layer and the corresponding kwargs
+    :param on_success: callback called after all layers were handled
+    :param on_error: callback called with the exception, in case of failure
+        or cancellation
+    """
+
+    def __init__(self, description, flags, dlg, layers_kwargs,
+                 on_layer_built, on_success, on_error):
+        super().__init__(description, flags)
+        self.dlg = dlg
+        self.layers_kwargs = layers_kwargs
+        self.on_layer_built = on_layer_built
+        self.on_success = on_success
+        self.on_error = on_error
+        self.built_layers = []
+        self.exception = None
+
+    def run(self):
+        main_thread = QgsApplication.instance().thread()
+        tot_layers = len(self.layers_kwargs)
+        try:
+            for layer_idx, kwargs in enumerate(self.layers_kwargs):
+                if self.isCanceled():
+                    raise TaskCanceled
+                layer = self.dlg.create_layer(
+                    is_canceled=self.isCanceled, **kwargs)
+                # NOTE: the layer was created in this thread, but it will be
+                # used by the main thread from now on
+                layer.moveToThread(main_thread)
+                # NOTE: create_layer sets the default field name depending on
+                # the layer, so it has to be restored before handling it
+                self.built_layers.append(
+                    (layer, kwargs, self.dlg.default_field_name))
+                self.setProgress((layer_idx + 1) / tot_layers * 100)
+        except Exception as exc:
+            self.exception = exc
+            return False
+        return True
+
+    def finished(self, success):
+        if not success:
+            self.built_layers = []
+            self.on_error(self.exception or TaskCanceled())
+            return
+        for layer, kwargs, default_field_name in self.built_layers:
+            self.dlg.layer = layer
+            self.dlg.default_field_name = default_field_name
+            self.on_layer_built(layer, kwargs)
+        self.built_layers = []
+        self.on_success()
@@ -22,15 +22,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
-import numpy
+import os
 import tempfile
-import json
 from time import sleep
 from qgis.core import QgsTask
 from qgis.PyQt.QtCore import QThread, pyqtSignal, pyqtSlot
-from numpy.lib.npyio import NpzFile
-from svir.utilities.utils import log_msg
+from svir.utilities.utils import log_msg, LazyNpz
+from svir.utilities.extract_cache import get_extract_cache
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
 
 
 class TaskCanceled(Exception):
@@ -91,9 +92,10 @@ class ExtractNpzTask(QgsTask):
             self.is_canceled_sig.emit()
             raise TaskCanceled
         self.extract_thread = ExtractThread(
-            session, extract_url, extract_params, self.dest_folder)
+            session, extract_url, extract_params, self.dest_folder,
+            cache_key=(self.hostname, self.calc_id, self.output_type))
         self.extract_thread.progress_sig[float].connect(self.set_progress)
-        self.extract_thread.extracted_npz_sig[dict].connect(
+        self.extract_thread.extracted_npz_sig[object].connect(
             self.set_extracted_npz)
         self.extract_thread.exception_sig[Exception].connect(
             self.on_exception)
@@ -104,18 +106,18 @@ class ExtractNpzTask(QgsTask):
             if self.extract_thread.isFinished():
                 return True
             if self.isCanceled():
-                # NOTE: deleteLater would be a cleaner way, but it does not
-                # actually kill the get, so the machine remains busy until a
-                # response is produced
-                # self.extract_thread.deleteLater()
-                del self.extract_thread
+                # NOTE: the response is streamed, so the thread checks the
+                # cancellation flag after each downloaded chunk and it stops
+                # shortly after being notified
+                self.extract_thread.set_canceled()
+                self.extract_thread.wait()
                 raise TaskCanceled
 
     @pyqtSlot(float)
     def set_progress(self, progress):
         self.setProgress(progress)
 
-    @pyqtSlot(NpzFile)
+    @pyqtSlot(object)
     def set_extracted_npz(self, extracted_npz):
         self.extracted_npz = extracted_npz
 
@@ -127,84 +129,118 @@ class ExtractNpzTask(QgsTask):
 class ExtractThread(QThread):
 
     progress_sig = pyqtSignal(float)
-    extracted_npz_sig = pyqtSignal(dict)
+    # NOTE: using object instead of dict, otherwise the LazyNpz would be
+    # converted into a QVariantMap when it is sent across threads
+    extracted_npz_sig = pyqtSignal(object)
     exception_sig = pyqtSignal(Exception)
 
-    def __init__(self, session, url, params, dest_folder):
+    def __init__(self, session, url, params, dest_folder, cache_key=None):
         self.session = session
         self.url = url
         self.params = params
         self.dest_folder = dest_folder
+        # (hostname, calc_id, output_type), or None to bypass the cache
+        self.cache_key = cache_key
         self.is_canceled = False
         super().__init__()
 
     def run(self):
         # FIXME: enable the user to set verify=True
-        # FIXME: stream = True breaks things unexpectedly in some cases
-        #        (content-length differs from len(resp.content)
-        resp = self.session.get(self.url, params=self.params, verify=False)
-        # , stream=True)
         err_msg = "Unable to extract %s with parameters %s" % (
             self.url, self.params)
-
-        if not resp.ok:
-            self.exception_sig.emit(ExtractFailed(
-                "%s (%s):\n%s" % (err_msg, resp.reason,
-                                  resp.content.decode('utf8'))))
+        if self.cache_key is not None:
+            extracted_npz = self._load_from_cache()
+            if extracted_npz is not None:
+                self.progress_sig.emit(100)
+                self.extracted_npz_sig.emit(extracted_npz)
+                return
+        with self.session.get(self.url, params=self.params, verify=False,
+                              stream=True) as resp:
+            if not resp.ok:
+                self.exception_sig.emit(ExtractFailed(
+                    "%s (%s):\n%s" % (err_msg, resp.reason,
+                                      resp.content.decode('utf8'))))
+                return
+            fd, filepath = tempfile.mkstemp(
+                suffix='.npz', dir=self.dest_folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    completed = self._download_to(resp, f)
+            except Exception as exc:
+                self._remove(filepath)
+                self.exception_sig.emit(exc)
+                return
+        if not completed:
+            self._remove(filepath)
+            self.exception_sig.emit(TaskCanceled())
             return
-
-        # FIXME: use stream=True
-        # filename = resp.headers['content-disposition'].split(
-        #     'filename=')[1]
-        # filepath = os.path.join(self.dest_folder, filename)
-        # tot_len = resp.headers.get('content-length')
-        # with open(filepath, "wb") as f:
-        #     if tot_len is None:
-        #         f.write(resp.content)
-        #     else:
-        #         tot_len = int(tot_len)
-        #         dl = 0
-        #         chunk_size = max(tot_len // 10000, 10)  # avoid size 0
-        #         for data in resp.iter_content(chunk_size=chunk_size):
-        #             if self.is_canceled:
-        #                 raise TaskCanceled
-        #             dl += len(data)
-        #             f.write(data)
-        #             progress = dl / tot_len * 100
-        #             self.progress_sig.emit(progress)
-        # extracted_npz = numpy.load(filepath, allow_pickle=False)
-        if not resp.content:
+        if not os.path.getsize(filepath):
+            self._remove(filepath)
             self.exception_sig.emit(ExtractFailed(
                 "%s: returned an empty content" % err_msg))
             return
+        is_cached = False
+        if self.cache_key is not None:
+            cached_filepath = get_extract_cache().store(
+                self.session, *self.cache_key, self.params, filepath)
+            if cached_filepath is not None:
+                filepath = cached_filepath
+                is_cached = True
         try:
-            if numpy.__version__ >= '1.24.0':
-                extracted_npz = numpy.load(
-                    io.BytesIO(resp.content), allow_pickle=False,
-                    max_header_size=100000)
-            else:
-                extracted_npz = numpy.load(
-                    io.BytesIO(resp.content), allow_pickle=False)
+            # NOTE: arrays are read (or memory-mapped) only when accessed, and
+            # the temporary file is removed when the dict is garbage-collected
+            extracted_npz = LazyNpz(filepath, remove_on_close=not is_cached)
         except Exception as exc:
-            self.exception_sig.emit(exc)
-            return
-        if not isinstance(extracted_npz, NpzFile):
+            if is_cached:
+                get_extract_cache().discard(*self.cache_key, self.params)
+            else:
+                self._remove(filepath)
             self.exception_sig.emit(
-                ExtractFailed("%s: not a valid NPZ. Response: (%s) %s" % (
-                    err_msg, resp.reason, resp.content)))
+                ExtractFailed("%s: not a valid NPZ (%s): %s" % (
+                    err_msg, resp.reason, exc)))
             return
+        self.extracted_npz_sig.emit(extracted_npz)
+
+    def _load_from_cache(self):
+        cache = get_extract_cache()
+        cached_filepath = cache.lookup(
+            self.session, *self.cache_key, self.params)
+        if cached_filepath is None:
+            return None
+        try:
+            extracted_npz = LazyNpz(cached_filepath)
+        except Exception as exc:
+            log_msg('Discarding the corrupted cached extract %s: %s' % (
+                        cached_filepath, exc),
+                    level='W', print_to_stderr=True)
+            cache.discard(*self.cache_key, self.params)
+            return None
+        log_msg('Extract %s with parameters %s read from cache' % (
+                    self.url, self.params),
+                level='I', print_to_stderr=True)
+        return extracted_npz
+
+    def _download_to(self, resp, f):
+        # NOTE: content-length refers to the bytes transferred over the wire,
+        #       that can be compressed, so the progress is computed on the
+        #       number of raw bytes read so far, instead of using the length
+        #       of the decoded chunks
+        tot_len = resp.headers.get('content-length')
+        tot_len = int(tot_len) if tot_len else None
+        for data in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if self.is_canceled:
+                return False
+            f.write(data)
+            if tot_len:
+                progress = min(resp.raw.tell() / tot_len * 100, 100)
+                self.progress_sig.emit(progress)
+        return True
 
-        dic = {}
-        for k, v in extracted_npz.items():
-            if k == 'json':
-                dic.update(json.loads(bytes(v)))
-            else:
-                dic[k] = v
-
-        self.extracted_npz_sig.emit(dic)
-
-        # FIXME: use stream=True
-        # os.remove(filepath)
+    def _remove(self, filepath):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
 
     def set_canceled(self):
         self.is_canceled = True
@@ -605,6 +605,15 @@ class LoadOqEngineOutputsTestCase(unittest.TestCase):
                 calc_id, self.irmt.drive_oq_engine_server_dlg.session,
                 self.hostname, output_type,
                 self.irmt.drive_oq_engine_server_dlg.engine_version)
+            # the widgets are filled as the extracts arrive
+            timeout = 60
+            start_time = time.time()
+            while self.irmt.viewer_dock.is_loading:
+                if time.time() - start_time > timeout:
+                    raise TimeoutError(
+                        'Loading time exceeded %s seconds' % timeout)
+                QGIS_APP.processEvents()
+                time.sleep(0.1)
             tmpfile_handler, tmpfile_name = tempfile.mkstemp()
             self.irmt.viewer_dock.write_export_file(tmpfile_name)
             os.close(tmpfile_handler)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-09-09
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.testing import unittest, start_app
+from qgis.PyQt.QtCore import Qt
+
+from svir.ui.calc_list_model import CalcListModel, CALC_COLUMNS
+
+start_app()
+
+
+def make_calc(calc_id, status='executing', is_running=True):
+    return dict(id=calc_id, description='calc %s' % calc_id,
+                calculation_mode='event_based', owner='user',
+                status=status, is_running=is_running)
+
+
+class CalcListModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = CalcListModel()
+        self.model.update_calcs([make_calc(3), make_calc(2), make_calc(1)])
+        self.signals = []
+        self.model.rowsInserted.connect(
+            lambda parent, first, last: self.signals.append(
+                ('inserted', first, last)))
+        self.model.rowsRemoved.connect(
+            lambda parent, first, last: self.signals.append(
+                ('removed', first, last)))
+        self.model.dataChanged.connect(
+            lambda top_left, bottom_right, roles=None: self.signals.append(
+                ('changed', top_left.row(), bottom_right.row())))
+        self.model.modelReset.connect(
+            lambda: self.signals.append(('reset',)))
+
+    def test_unchanged_list_emits_nothing(self):
+        self.model.update_calcs([make_calc(3), make_calc(2), make_calc(1)])
+        self.assertEqual(self.signals, [])
+
+    def test_changed_status_updates_only_its_row(self):
+        self.model.update_calcs([
+            make_calc(3), make_calc(2, 'complete', False), make_calc(1)])
+        self.assertEqual(self.signals, [('changed', 1, 1)])
+        status_col = len(CALC_COLUMNS) - 1
+        self.assertEqual(
+            self.model.index(1, status_col).data(Qt.DisplayRole), 'complete')
+
+    def test_new_and_removed_calcs(self):
+        self.model.update_calcs([make_calc(4), make_calc(3), make_calc(1)])
+        self.assertEqual(
+            self.signals, [('removed', 1, 1), ('inserted', 0, 0)])
+        self.assertEqual(self.model.row_of(4), 0)
+        self.assertEqual(self.model.row_of(1), 2)
+        self.assertIsNone(self.model.row_of(2))
+
+    def test_reordered_list_resets_the_model(self):
+        self.model.update_calcs([make_calc(1), make_calc(2), make_calc(3)])
+        self.assertEqual(self.signals, [('reset',)])
+        self.assertEqual(self.model.calc_id(0), 1)
+
+    def test_actions_depend_on_status(self):
+        self.model.update_calcs([
+            make_calc(3), make_calc(2, 'complete', False),
+            make_calc(1, 'failed', False)])
+        labels = [
+            [self.model.index(row, col).data(Qt.DisplayRole)
+             for col in range(len(CALC_COLUMNS), self.model.columnCount())]
+            for row in range(self.model.rowCount())]
+        self.assertEqual(labels, [
+            ['Console', None, None, None, 'Abort'],
+            ['Console', 'Remove', 'Outputs', 'Continue', None],
+            ['Console', 'Remove', None, None, None]])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-08
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import numpy
+
+from qgis.core import QgsVectorLayer, QgsFeature, NULL
+from qgis.testing import unittest, start_app
+
+from svir.calculations.classification import (
+    jenks_breaks,
+    quantile_breaks,
+    equal_interval_breaks,
+    pretty_breaks,
+    classify_column,
+    classify_layer_fields)
+
+start_app()
+
+
+class BreaksTestCase(unittest.TestCase):
+
+    def test_jenks_breaks_are_optimal(self):
+        def ssd(values):
+            return ((values - values.mean()) ** 2).sum()
+        rng = numpy.random.default_rng(42)
+        for _ in range(10):
+            values = numpy.sort(rng.random(9) * 10)
+            n_classes = 3
+            best_cost, best_breaks = None, None
+            for cuts in itertools.combinations(range(1, 9), n_classes - 1):
+                parts = numpy.split(values, cuts)
+                cost = sum(ssd(part) for part in parts)
+                if best_cost is None or cost < best_cost:
+                    best_cost = cost
+                    best_breaks = [part[-1] for part in parts]
+            numpy.testing.assert_allclose(
+                jenks_breaks(values, n_classes), best_breaks)
+
+    def test_jenks_breaks_of_clustered_values(self):
+        values = numpy.array([1., 1.1, 1.2, 5., 5.1, 9., 9.2, 9.3])
+        self.assertEqual(jenks_breaks(values, 3), [1.2, 5.1, 9.3])
+
+    def test_quantile_and_equal_interval_breaks(self):
+        values = numpy.arange(11.)
+        self.assertEqual(list(quantile_breaks(values, 2)), [5., 10.])
+        self.assertEqual(equal_interval_breaks(values, 5),
+                         [2., 4., 6., 8., 10.])
+
+    def test_pretty_breaks(self):
+        numpy.testing.assert_allclose(
+            pretty_breaks(numpy.array([-3.2, 7.9]), 5),
+            [-2., 0., 2., 4., 6., 7.9])
+
+    def test_classify_column_with_missing_values(self):
+        column = numpy.array([1., numpy.nan, 1., 2., 3., 4.])
+        classification = classify_column(column, 'EqualInterval', 3)
+        self.assertTrue(classification['has_null'])
+        self.assertEqual(classification['num_unique'], 4)
+        self.assertEqual(classification['minimum'], 1.)
+        self.assertEqual(classification['breaks'], [2., 3., 4.])
+        # classes are not computed if there are less than 3 unique values
+        classification = classify_column(
+            numpy.array([1., 2., 1.]), 'Jenks', 3)
+        self.assertEqual(classification['breaks'], [])
+
+
+class ClassifyLayerFieldsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        uri = 'Point?crs=epsg:4326&field=a:double&field=b:double'
+        self.layer = QgsVectorLayer(uri, 'TestLayer', 'memory')
+        features = []
+        for a, b in ((1, 10), (2, 20), (3, NULL), (4, 40), (5, 50)):
+            feat = QgsFeature(self.layer.fields())
+            feat.setAttributes([a, b])
+            features.append(feat)
+        self.layer.dataProvider().addFeatures(features)
+
+    def test_classifications_are_cached_on_layers_of_calculations(self):
+        self.layer.setCustomProperty('calc_id', 7)
+        classifications = classify_layer_fields(
+            self.layer, ['a', 'b'], 'EqualInterval', 2)
+        self.assertEqual(classifications['a']['breaks'], [3., 5.])
+        self.assertTrue(classifications['b']['has_null'])
+        property_names = [
+            key for key in self.layer.customPropertyKeys()
+            if key.startswith('irmt/classification/7/')]
+        self.assertEqual(len(property_names), 2)
+        # the cached classification is returned
+        with_cache = classify_layer_fields(
+            self.layer, ['a'], 'EqualInterval', 2)
+        self.assertEqual(with_cache['a'], classifications['a'])
+
+    def test_cached_classifications_are_dropped_when_values_change(self):
+        self.layer.setCustomProperty('calc_id', 7)
+        classifications = classify_layer_fields(
+            self.layer, ['a'], 'EqualInterval', 2)
+        self.assertEqual(classifications['a']['breaks'], [3., 5.])
+        feat_id = next(self.layer.getFeatures()).id()
+        self.layer.startEditing()
+        self.layer.changeAttributeValue(
+            feat_id, self.layer.fields().indexOf('a'), 9.)
+        self.layer.commitChanges()
+        classifications = classify_layer_fields(
+            self.layer, ['a'], 'EqualInterval', 2)
+        # the first feature (a == 1) was changed
+        self.assertEqual(classifications['a']['breaks'], [5.5, 9.])
+
+    def test_classifications_are_not_cached_without_calc_id(self):
+        classify_layer_fields(self.layer, ['a'], 'Quantile', 2)
+        self.assertFalse([
+            key for key in self.layer.customPropertyKeys()
+            if key.startswith('irmt/classification')])
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-22
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+from qgis.core import QgsVectorLayer, QgsFeature, NULL
+from qgis.testing import unittest, start_app
+
+from svir.utilities.curve_field_layout import CurveFieldLayout
+
+start_app()
+
+
+def make_layer(field_names, rows):
+    uri = 'Point?crs=epsg:4326' + ''.join(
+        '&field=%s:double' % field_name for field_name in field_names)
+    layer = QgsVectorLayer(uri, 'TestLayer', 'memory')
+    features = []
+    for row in rows:
+        feat = QgsFeature(layer.fields())
+        feat.setAttributes(list(row))
+        features.append(feat)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+class CurveFieldLayoutTestCase(unittest.TestCase):
+
+    def test_hazard_curves(self):
+        field_names = ['mean_PGA_0.1', 'mean_PGA_0.2', 'mean_SA(0.1)_0.1',
+                       'max_PGA_0.1', 'max_PGA_0.2']
+        layer = make_layer(field_names, [(1, 2, 3, 4, 5),
+                                         (6, NULL, 8, 9, 10)])
+        layout = CurveFieldLayout(layer.fields(), 'hcurves')
+        self.assertEqual(layout.rlzs_or_stats, ['max', 'mean'])
+        self.assertEqual(layout.imts, ['PGA', 'SA(0.1)'])
+        self.assertEqual(layout.attr_idxs[('mean', 'PGA')], [0, 1])
+        numpy.testing.assert_equal(
+            layout.abscissae[('max', 'PGA')], [0.1, 0.2])
+        feat_ids, ordinates = layout.fetch(
+            layer, [feat.id() for feat in layer.getFeatures()],
+            [('mean', 'PGA'), ('max', 'PGA'), ('missing', 'PGA')])
+        self.assertEqual(len(feat_ids), 2)
+        self.assertNotIn(('missing', 'PGA'), ordinates)
+        numpy.testing.assert_equal(
+            ordinates[('mean', 'PGA')], [[1, 2], [6, numpy.nan]])
+        numpy.testing.assert_equal(
+            ordinates[('max', 'PGA')], [[4, 5], [9, 10]])
+
+    def test_uniform_hazard_spectra(self):
+        field_names = ['mean_PGA', 'mean_SA(0.025)', 'mean_SA(0.1)',
+                       'rlz-000_PGA', 'rlz-000_SA(0.025)', 'rlz-000_SA(0.1)']
+        layer = make_layer(field_names, [(1, 2, 3, 4, 5, 6)])
+        layout = CurveFieldLayout(layer.fields(), 'uhs')
+        self.assertEqual(layout.rlzs_or_stats, ['mean', 'rlz-000'])
+        self.assertEqual(layout.imts, [])
+        numpy.testing.assert_equal(
+            layout.abscissae[('rlz-000', None)], [0.0, 0.025, 0.1])
+        _, ordinates = layout.fetch(
+            layer, [feat.id() for feat in layer.getFeatures()],
+            [('rlz-000', None)])
+        numpy.testing.assert_equal(ordinates[('rlz-000', None)], [[4, 5, 6]])
+
+    def test_invalid_periods(self):
+        layer = make_layer(['mean_SA(x)'], [])
+        with self.assertRaises(ValueError):
+            CurveFieldLayout(layer.fields(), 'uhs')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-09-02
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from qgis.testing import unittest, start_app
+from requests.exceptions import ReadTimeout
+
+from svir.utilities import engine_client
+from svir.utilities.engine_client import (
+    EngineSession, RequestMetrics, get_endpoint)
+
+start_app()
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers 503 to the first request of each path, then a gzipped body.
+    Paths ending with /slow are answered late.
+    """
+    seen_paths = set()
+    slow_hits = []
+
+    def do_GET(self):
+        if self.path.endswith('/slow'):
+            self.slow_hits.append(self.path)
+            time.sleep(0.3)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path not in self.seen_paths:
+            self.seen_paths.add(self.path)
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = gzip.compress(b'ok' * 100)
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.seen_paths.add(self.path)
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class EngineClientTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('localhost', 0), FlakyHandler)
+        cls.hostname = 'http://localhost:%s' % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.backoff_factor = engine_client.BACKOFF_FACTOR
+        engine_client.BACKOFF_FACTOR = 0
+        self.session = EngineSession()
+
+    def tearDown(self):
+        engine_client.BACKOFF_FACTOR = self.backoff_factor
+        self.session.close()
+
+    def test_endpoints(self):
+        self.assertEqual(
+            get_endpoint('http://host/v1/calc/3/extract/oqparam'),
+            ('extract', None))
+        self.assertEqual(get_endpoint('http://host/v1/calc/3/datastore'),
+                         ('download', None))
+        self.assertEqual(get_endpoint('http://host/v1/calc/list')[0], 'calc')
+        self.assertEqual(get_endpoint('http://host/v1/engine_version')[0],
+                         'other')
+
+    def test_get_is_retried_and_decompressed(self):
+        resp = self.session.get(self.hostname + '/v1/calc/1/extract/a')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b'ok' * 100)
+        stats = self.session.metrics.summary()['extract']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['bytes'], 200)
+
+    def test_slow_extract_is_not_retried(self):
+        url = self.hostname + '/v1/calc/1/extract/slow'
+        with self.assertRaises(ReadTimeout):
+            self.session.get(url, timeout=(1, 0.1))
+        self.assertEqual(
+            FlakyHandler.slow_hits.count('/v1/calc/1/extract/slow'), 1)
+
+    def test_post_is_not_retried(self):
+        resp = self.session.post(self.hostname + '/v1/calc/run')
+        self.assertEqual(resp.status_code, 503)
+        stats = self.session.metrics.summary()['run']
+        self.assertEqual(stats['retries'], 0)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_metrics(self):
+        metrics = RequestMetrics()
+        metrics.record('calc', 0.1, num_bytes=10)
+        metrics.record('calc', 0.3, num_bytes=20, retries=2, error=True)
+        stats = metrics.summary()['calc']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['bytes'], 30)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertAlmostEqual(stats['mean_latency'], 0.2)
+        self.assertAlmostEqual(stats['max_latency'], 0.3)
+        metrics.reset()
+        self.assertEqual(metrics.summary(), {})
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-05-27
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+# import qgis libs so that we set the correct sip api version
+import os
+import json
+import shutil
+import tempfile
+
+from qgis.PyQt.QtCore import QSettings
+from qgis.testing import unittest, start_app
+
+from svir.utilities.extract_cache import ExtractCache
+
+QGIS_APP = start_app()
+
+HOST = 'http://localhost:8800'
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.text = json.dumps(content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Answers to /v1/calc/ID/status requests using the given dict
+    """
+    def __init__(self, calcs):
+        self.calcs = calcs
+
+    def get(self, url, **kwargs):
+        calc_id = int(url.split('/')[-2])
+        if calc_id not in self.calcs:
+            return FakeResponse(404, {})
+        return FakeResponse(200, self.calcs[calc_id])
+
+
+class ExtractCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ExtractCache(self.cache_dir)
+        self.session = FakeSession({
+            1: dict(status='complete', start_time='2024-05-01'),
+            2: dict(status='executing', start_time='2024-05-02')})
+        QSettings().setValue('irmt/extract_cache_enabled', True)
+        QSettings().setValue('irmt/extract_cache_max_size_mb', 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        QSettings().remove('irmt/extract_cache_enabled')
+        QSettings().remove('irmt/extract_cache_max_size_mb')
+
+    def _make_file(self, size):
+        fd, path = tempfile.mkstemp(suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'0' * size)
+        return path
+
+    def test_store_and_lookup(self):
+        params = {'kind': 'mean', 'imt': 'PGA'}
+        path = self.cache.store(self.session, HOST, 1, 'hmaps', params,
+                                self._make_file(100))
+        self.assertTrue(os.path.isfile(path))
+        # the order of the parameters does not matter
+        self.assertEqual(
+            self.cache.lookup(self.session, HOST, 1, 'hmaps',
+                              {'imt': 'PGA', 'kind': 'mean'}),
+            path)
+        self.assertIsNone(
+            self.cache.lookup(self.session, HOST, 1, 'hmaps', {}))
+
+    def test_running_calcs_are_not_cached(self):
+        filepath = self._make_file(100)
+        self.assertIsNone(self.cache.store(
+            self.session, HOST, 2, 'hmaps', None, filepath))
+        self.assertTrue(os.path.isfile(filepath))
+        os.remove(filepath)
+
+    def test_removed_calc_is_purged(self):
+        self.cache.store(self.session, HOST, 1, 'hmaps', None,
+                         self._make_file(100))
+        self.cache._checked_calcs.clear()
+        del self.session.calcs[1]
+        self.assertIsNone(
+            self.cache.lookup(self.session, HOST, 1, 'hmaps', None))
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_lru_eviction(self):
+        size = 400 * 1024
+        self.cache.store(self.session, HOST, 1, 'a', None,
+                         self._make_file(size))
+        self.cache.store(self.session, HOST, 1, 'b', None,
+                         self._make_file(size))
+        # 'a' becomes the most recently used
+        self.cache.lookup(self.session, HOST, 1, 'a', None)
+        self.cache.store(self.session, HOST, 1, 'c', None,
+                         self._make_file(size))
+        self.assertEqual(
+            sorted(entry['output_type'] for entry in self.cache.entries()),
+            ['a', 'c'])
+        self.cache.purge()
+        self.assertEqual(self.cache.total_size(), 0)
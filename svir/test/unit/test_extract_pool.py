@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-08-05
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import threading
+from time import sleep, time
+
+import numpy
+from qgis.PyQt.QtCore import QSettings
+from qgis.testing import unittest, start_app
+
+from svir.utilities.extract_pool import ExtractPool
+
+QGIS_APP = start_app()
+
+HOST = 'http://localhost:8800'
+DELAY = 0.3
+
+
+class FakeResponse(object):
+    ok = True
+
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSession(object):
+    """
+    Answers to extract requests with a npz containing the name of the
+    output, after a delay
+    """
+    def __init__(self):
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, **kwargs):
+        with self.lock:
+            self.requested.append((url, params))
+        sleep(DELAY)
+        buf = io.BytesIO()
+        numpy.savez(buf, name=numpy.array(url.split('/')[-1]))
+        return FakeResponse(buf.getvalue())
+
+
+class ExtractPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        QSettings().setValue('irmt/extract_cache_enabled', False)
+        self.session = FakeSession()
+        self.pool = ExtractPool(self.session, HOST, 1)
+
+    def tearDown(self):
+        QSettings().remove('irmt/extract_cache_enabled')
+
+    def test_extracts_are_downloaded_concurrently(self):
+        output_types = ['oqparam', 'asset_tags', 'realizations']
+        start = time()
+        self.pool.prefetch(output_types)
+        for output_type in output_types:
+            self.assertEqual(
+                str(self.pool.result(output_type)['name']), output_type)
+        self.assertLess(time() - start, DELAY * len(output_types))
+
+    def test_extracts_are_requested_once(self):
+        params = {'kind': 'rlzs', 'loss_type': 'structural'}
+        self.pool.fetch('agg_curves', params)
+        self.pool.result('agg_curves', dict(params))
+        self.pool.result('agg_curves', params)
+        self.pool.result('agg_curves')
+        self.assertEqual(len(self.session.requested), 2)
+
+    def test_callback_is_called_in_the_main_thread(self):
+        threads = []
+        self.pool.fetch(
+            'asset_tags', callback=lambda: threads.append(
+                threading.current_thread()))
+        start = time()
+        while not threads and time() - start < 10 * DELAY:
+            QGIS_APP.processEvents()
+            sleep(0.01)
+        self.assertEqual(threads, [threading.main_thread()])
+        # once extracted, the callback is called immediately
+        self.pool.fetch('asset_tags', callback=lambda: threads.append(None))
+        self.assertEqual(len(threads), 2)
+
+    def test_collect_calls_back_once_with_all_the_results(self):
+        calls = []
+        self.pool.collect(
+            ['oqparam', ('agg_curves', {'kind': 'rlzs'})], calls.append)
+        # the main thread is not blocked while the extracts are downloaded
+        self.assertEqual(calls, [])
+        start = time()
+        while not calls and time() - start < 10 * DELAY:
+            QGIS_APP.processEvents()
+            sleep(0.01)
+        QGIS_APP.processEvents()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            [str(npz['name']) for npz in calls[0]],
+            ['oqparam', 'agg_curves'])
+
+    def test_cancel_queued_extracts(self):
+        params_list = [{'tag': str(idx)} for idx in range(20)]
+        for params in params_list:
+            self.pool.fetch('agg_losses/structural', params)
+        canceled = [self.pool.cancel('agg_losses/structural', params)
+                    for params in params_list]
+        # the first extracts are already running and they can not be canceled
+        self.assertFalse(canceled[0])
+        self.assertTrue(canceled[-1])
+        self.assertFalse(self.pool.is_done(
+            'agg_losses/structural', params_list[-1]))
+        self.assertIsNotNone(
+            self.pool.result('agg_losses/structural', params_list[0]))
+        self.assertTrue(self.pool.is_done(
+            'agg_losses/structural', params_list[0]))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-06-03
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+# import qgis libs so that we set the correct sip api version
+import os
+import shutil
+import tempfile
+import numpy
+import collections
+from time import time
+
+from qgis.core import (
+    QgsVectorLayer, QgsFeature, QgsGeometry, QgsPointXY, edit)
+from qgis.testing import unittest, start_app
+
+from svir.calculations.calculate_utils import add_attribute
+from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
+
+QGIS_APP = start_app()
+
+NUM_FLOAT_FIELDS = 10
+
+
+def make_dataset(num_rows):
+    dtype = [('lon', numpy.float32), ('lat', numpy.float32),
+             ('taxonomy', 'S20')]
+    dtype += [('value-%s' % i, numpy.float32)
+              for i in range(NUM_FLOAT_FIELDS)]
+    dataset = numpy.zeros(num_rows, dtype)
+    dataset['lon'] = numpy.linspace(-10, 10, num_rows)
+    dataset['lat'] = numpy.linspace(40, 50, num_rows)
+    dataset['taxonomy'] = [b'tax-%d' % (i % 7) for i in range(num_rows)]
+    for i in range(NUM_FLOAT_FIELDS):
+        dataset['value-%s' % i] = numpy.arange(num_rows) * (i + 1) / 3.
+    return dataset
+
+
+def make_layer(dataset):
+    layer = QgsVectorLayer('point?crs=epsg:4326', 'test', 'memory')
+    for name in dataset.dtype.names[2:]:
+        add_attribute(name, dataset[name].dtype.char, layer)
+    return layer
+
+
+def read_row_by_row(layer, dataset):
+    # this is how loaders used to populate layers, before switching to
+    # add_features_from_columns
+    field_names = dataset.dtype.names[2:]
+    with edit(layer):
+        feats = []
+        for row in dataset:
+            feat = QgsFeature(layer.fields())
+            for field_name in field_names:
+                value = row[field_name].item()
+                if isinstance(value, bytes):
+                    value = value.decode('utf8')
+                feat.setAttribute(field_name, value)
+            feat.setGeometry(QgsGeometry.fromPointXY(
+                QgsPointXY(row['lon'], row['lat'])))
+            feats.append(feat)
+        layer.addFeatures(feats)
+
+
+def read_column_wise(layer, dataset):
+    columns = {name: dataset[name] for name in dataset.dtype.names[2:]}
+    return LoadOutputAsLayerDialog.add_features_from_columns(
+        layer, columns, lons=dataset['lon'], lats=dataset['lat'],
+        chunk_size=1000)
+
+
+def group_by_site_row_by_row(dataset, field_name, taxonomy='All'):
+    # this is how loaders used to aggregate records by site, before switching
+    # to sum_by_site
+    value_by_site = collections.defaultdict(float)
+    for rec in dataset:
+        if taxonomy == 'All' or taxonomy.encode('utf8') == rec['taxonomy']:
+            value_by_site[rec['lon'], rec['lat']] += float(rec[field_name])
+    return sorted(value_by_site.items())
+
+
+class FeatureBuilderTestCase(unittest.TestCase):
+
+    def test_same_features_as_row_by_row(self):
+        dataset = make_dataset(2500)
+        expected_layer = make_layer(dataset)
+        read_row_by_row(expected_layer, dataset)
+        layer = make_layer(dataset)
+        self.assertTrue(read_column_wise(layer, dataset))
+        self.assertEqual(layer.featureCount(), len(dataset))
+        for expected, feat in zip(expected_layer.getFeatures(),
+                                  layer.getFeatures()):
+            self.assertEqual(expected.attributes(), feat.attributes())
+            self.assertEqual(expected.geometry().asWkt(),
+                             feat.geometry().asWkt())
+
+    def test_missing_columns_are_null(self):
+        dataset = make_dataset(10)
+        layer = make_layer(dataset)
+        added_ok = LoadOutputAsLayerDialog.add_features_from_columns(
+            layer, {'value-3': dataset['value-3']},
+            lons=dataset['lon'], lats=dataset['lat'])
+        self.assertTrue(added_ok)
+        feat = next(layer.getFeatures())
+        self.assertEqual(feat['value-3'], 0.0)
+        # NULL is falsy
+        self.assertFalse(feat['taxonomy'])
+
+    @unittest.skipUnless(os.environ.get('IRMT_BENCHMARK') == '1',
+                         'set IRMT_BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        dataset = make_dataset(50000)
+        rates = []
+        for read_func in (read_row_by_row, read_column_wise):
+            layer = make_layer(dataset)
+            t0 = time()
+            read_func(layer, dataset)
+            rates.append(len(dataset) / (time() - t0))
+        self.assertGreater(
+            rates[1], rates[0],
+            'Column-wise: %.0f rows/sec, row by row: %.0f rows/sec' % (
+                rates[1], rates[0]))
+
+
+class SumBySiteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dataset = make_dataset(1000)
+        # put several assets in each site, listing sites in random order
+        rng = numpy.random.default_rng(42)
+        dataset['lon'] = rng.integers(0, 10, len(dataset)) / 3.
+        dataset['lat'] = rng.integers(0, 5, len(dataset)) / 7.
+        self.dataset = dataset
+
+    def check_sums(self, taxonomy):
+        sums = LoadOutputAsLayerDialog.sum_by_site(
+            self.dataset, ['value-0', 'value-5'], taxonomy)
+        self.assertEqual(sums.dtype.names,
+                         ('lon', 'lat', 'value-0', 'value-5'))
+        for field_name in ('value-0', 'value-5'):
+            expected = group_by_site_row_by_row(
+                self.dataset, field_name, taxonomy)
+            self.assertEqual(len(sums), len(expected))
+            for rec, ((lon, lat), value) in zip(sums, expected):
+                self.assertEqual((rec['lon'], rec['lat']), (lon, lat))
+                self.assertEqual(rec[field_name], numpy.float32(value))
+
+    def test_all_taxonomies(self):
+        self.check_sums('All')
+
+    def test_single_taxonomy(self):
+        self.check_sums('tax-3')
+
+    def test_site_index(self):
+        lons = numpy.array([2., 1., 2., 1., 0.], dtype=numpy.float32)
+        lats = numpy.array([5., 6., 5., 4., 9.], dtype=numpy.float32)
+        site_lons, site_lats, site_idxs = \
+            LoadOutputAsLayerDialog.get_site_index(lons, lats)
+        self.assertEqual(site_lons.tolist(), [0., 1., 1., 2.])
+        self.assertEqual(site_lats.tolist(), [9., 4., 6., 5.])
+        self.assertEqual(site_idxs.tolist(), [3, 2, 3, 1, 0])
+
+
+class GeoPackageWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.gpkg_path = os.path.join(self.temp_dir, 'calc_42.gpkg')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_same_features_as_memory_layer(self):
+        dataset = make_dataset(2500)
+        expected_layer = make_layer(dataset)
+        read_column_wise(expected_layer, dataset)
+        layer = LoadOutputAsLayerDialog.create_gpkg_layer(
+            self.gpkg_path, make_layer(dataset))
+        self.assertTrue(layer.isValid())
+        self.assertTrue(read_column_wise(layer, dataset))
+        self.assertEqual(layer.featureCount(), len(dataset))
+        self.assertEqual(layer.extent(), expected_layer.extent())
+        for expected, feat in zip(expected_layer.getFeatures(),
+                                  layer.getFeatures()):
+            # NOTE: the first field is the fid
+            self.assertEqual(expected.attributes(), feat.attributes()[1:])
+            self.assertEqual(expected.geometry().asWkt(),
+                             feat.geometry().asWkt())
+
+    def test_tables_are_replaced(self):
+        dataset = make_dataset(10)
+        for num_rows in (10, 5):
+            layer = LoadOutputAsLayerDialog.create_gpkg_layer(
+                self.gpkg_path, make_layer(dataset))
+            read_column_wise(layer, dataset[:num_rows])
+        reopened_layer = QgsVectorLayer(
+            '%s|layername=test' % self.gpkg_path, 'test', 'ogr')
+        self.assertEqual(reopened_layer.featureCount(), 5)
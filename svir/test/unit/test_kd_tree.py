@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-29
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+from qgis.testing import unittest, start_app
+
+from svir.utilities.kd_tree import KDTree, densify_polyline
+
+start_app()
+
+
+class KDTreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.points = rng.uniform(0, 1000, size=(5000, 2))
+        self.queries = rng.uniform(-50, 1050, size=(200, 2))
+
+    def test_nearest_is_the_same_as_brute_force(self):
+        tree = KDTree(self.points)
+        for query in self.queries:
+            idx, dist = tree.query(query)
+            distances = numpy.hypot(*(self.points - query).T)
+            self.assertAlmostEqual(dist, distances.min())
+            self.assertAlmostEqual(distances[idx], distances.min())
+
+    def test_max_distance(self):
+        tree = KDTree(self.points)
+        for query in self.queries:
+            idx, dist = tree.query(query, max_distance=5)
+            distances = numpy.hypot(*(self.points - query).T)
+            if distances.min() > 5:
+                self.assertIsNone(idx)
+                self.assertEqual(dist, numpy.inf)
+            else:
+                self.assertAlmostEqual(dist, distances.min())
+
+    def test_duplicate_points(self):
+        tree = KDTree([(1, 1)] * 100 + [(3, 3)])
+        self.assertEqual(tree.query((2.9, 2.9))[0], 100)
+        self.assertLess(tree.query((1, 1))[0], 100)
+
+    def test_empty(self):
+        tree = KDTree(numpy.empty((0, 2)))
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.query((0, 0)), (None, numpy.inf))
+
+    def test_point_between_vertices_is_found(self):
+        vertices = [(0, 0), (100, 0), (100, 300)]
+        points = densify_polyline(vertices, 2.5)
+        self.assertEqual(points[0].tolist(), [0, 0])
+        self.assertEqual(points[-1].tolist(), [100, 300])
+        self.assertLessEqual(
+            numpy.hypot(*numpy.diff(points, axis=0).T).max(), 2.5 + 1e-9)
+        tree = KDTree(points)
+        self.assertIsNotNone(tree.query((50, 4), max_distance=5)[0])
+        self.assertIsNotNone(tree.query((96, 150), max_distance=5)[0])
+        self.assertIsNone(tree.query((50, 6), max_distance=5)[0])
+
+    def test_segments_out_of_bounds_are_not_sampled(self):
+        vertices = [(-1000, 0), (-500, 0), (50, 50)]
+        points = densify_polyline(vertices, 1, bounds=(0, 0, 100, 100))
+        # only the vertices of the first segment, plus the second one
+        self.assertLess(len(points), 2 + 800)
+        self.assertEqual(points[:2].tolist(), [[-1000, 0], [-500, 0]])
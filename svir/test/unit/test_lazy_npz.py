@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-05-20
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+# import qgis libs so that we set the correct sip api version
+import os
+import json
+import tempfile
+import numpy
+
+from qgis.testing import unittest, start_app
+
+from svir.utilities.utils import LazyNpz
+
+QGIS_APP = start_app()
+
+
+class LazyNpzTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.array = numpy.zeros(
+            5, dtype=[('lon', numpy.float32), ('lat', numpy.float32),
+                      ('taxonomy', 'S10')])
+        self.array['lon'] = numpy.arange(5)
+        self.array['taxonomy'] = b'Wood'
+        self.matrix = numpy.arange(12).reshape(3, 4)
+        self.json = numpy.array(json.dumps({'investigation_time': 50}))
+        fd, self.filepath = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+
+    def tearDown(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def test_uncompressed_members_are_memory_mapped(self):
+        numpy.savez(self.filepath, array=self.array, matrix=self.matrix,
+                    json=self.json)
+        npz = LazyNpz(self.filepath)
+        self.assertEqual(sorted(npz.keys()),
+                         ['array', 'investigation_time', 'matrix'])
+        self.assertIsInstance(npz['array'], numpy.memmap)
+        numpy.testing.assert_array_equal(npz['array'], self.array)
+        numpy.testing.assert_array_equal(npz['matrix'], self.matrix)
+        self.assertEqual(npz['investigation_time'], 50)
+        # copy-on-write: the file is left untouched
+        npz['matrix'][0, 0] = 99
+        with numpy.load(self.filepath) as orig:
+            self.assertEqual(orig['matrix'][0, 0], 0)
+        npz.close()
+
+    def test_compressed_members_are_loaded_on_access(self):
+        numpy.savez_compressed(
+            self.filepath, array=self.array, matrix=self.matrix)
+        npz = LazyNpz(self.filepath)
+        self.assertNotIsInstance(npz['array'], numpy.memmap)
+        numpy.testing.assert_array_equal(npz['array'], self.array)
+        numpy.testing.assert_array_equal(
+            dict(npz.items())['matrix'], self.matrix)
+        self.assertIsNone(npz.get('missing'))
+        npz.close()
+
+    def test_copies_contain_loaded_arrays(self):
+        numpy.savez_compressed(
+            self.filepath, array=self.array, matrix=self.matrix,
+            json=self.json)
+        npz = LazyNpz(self.filepath)
+        for copied in (dict(npz), {**npz}, npz.copy(), dict(npz.items())):
+            numpy.testing.assert_array_equal(copied['matrix'], self.matrix)
+            numpy.testing.assert_array_equal(copied['array'], self.array)
+            self.assertEqual(copied['investigation_time'], 50)
+        for value in npz.values():
+            self.assertIsInstance(value, (numpy.ndarray, int))
+        npz.close()
+
+    def test_remove_on_close(self):
+        numpy.savez(self.filepath, matrix=self.matrix)
+        npz = LazyNpz(self.filepath, remove_on_close=True)
+        matrix = npz['matrix']
+        npz.close()
+        self.assertFalse(os.path.exists(self.filepath))
+        numpy.testing.assert_array_equal(matrix, self.matrix)
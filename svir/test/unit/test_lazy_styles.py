@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-15
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from qgis.core import QgsVectorLayer, QgsCategorizedSymbolRenderer
+from qgis.testing import unittest, start_app
+
+from svir.utilities.lazy_styles import (
+    LazyLayerStyles, add_lazy_styles, restore_lazy_styles,
+    LAZY_STYLES_PROPERTY)
+
+start_app()
+
+
+class LazyStylesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        uri = ('Point?crs=epsg:4326'
+               '&field=a:double&field=b:double&field=c:double')
+        self.layer = QgsVectorLayer(uri, 'TestLayer', 'memory')
+        self.styled = []
+
+    def style_function(self, layer, field_name):
+        self.styled.append(field_name)
+        layer.setRenderer(QgsCategorizedSymbolRenderer(field_name, []))
+
+    def test_styles_are_built_when_they_become_current(self):
+        add_lazy_styles(self.layer, ['a', 'b', 'c'], self.style_function,
+                        current_style='b')
+        self.assertEqual(self.styled, ['b'])
+        self.assertEqual(self.layer.renderer().classAttribute(), 'b')
+        style_manager = self.layer.styleManager()
+        style_manager.setCurrentStyle('a')
+        style_manager.setCurrentStyle('b')
+        # the style of b was already built
+        self.assertEqual(self.styled, ['b', 'a'])
+        self.assertEqual(self.layer.renderer().classAttribute(), 'b')
+        state = json.loads(self.layer.customProperty(LAZY_STYLES_PROPERTY))
+        self.assertEqual(state['pending'], ['c'])
+
+    def test_least_recently_used_styles_are_evicted(self):
+        LazyLayerStyles(self.layer, ['a', 'b', 'c'], self.style_function,
+                        max_materialized=2)
+        style_manager = self.layer.styleManager()
+        for style_name in ('a', 'b', 'c', 'a'):
+            style_manager.setCurrentStyle(style_name)
+        # a was turned back into a placeholder when c was built, and b when
+        # a was built again
+        self.assertEqual(self.styled, ['a', 'b', 'c', 'a'])
+        self.assertIn('singleSymbol', style_manager.style('b').xmlData())
+        self.assertIn('categorizedSymbol', style_manager.style('c').xmlData())
+        style_manager.setCurrentStyle('b')
+        self.assertEqual(self.styled, ['a', 'b', 'c', 'a', 'b'])
+
+    def test_restore_lazy_styles(self):
+        add_lazy_styles(self.layer, ['a', 'b'], self.style_function,
+                        current_style='a')
+        # styles are already handled
+        self.assertIsNone(
+            restore_lazy_styles(self.layer, self.style_function))
+        for lazy_styles in self.layer.findChildren(LazyLayerStyles):
+            self.layer.styleManager().currentStyleChanged.disconnect(
+                lazy_styles.on_current_style_changed)
+            lazy_styles.setParent(None)
+        self.assertIsNotNone(
+            restore_lazy_styles(self.layer, self.style_function))
+        self.layer.styleManager().setCurrentStyle('b')
+        self.assertEqual(self.styled, ['a', 'b'])
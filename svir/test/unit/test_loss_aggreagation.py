@@ -27,9 +27,17 @@ import os.path
 import tempfile
 import shutil
 import time
-from qgis.core import QgsVectorLayer
+import json
+import numpy
+from unittest import mock
+from qgis.core import (
+    QgsVectorLayer, QgsFeature, QgsGeometry, QgsField, QgsPointXY)
+from qgis.PyQt.QtCore import QVariant
 from svir.calculations.process_layer import ProcessLayer
-from svir.calculations.aggregate_loss_by_zone import calculate_zonal_stats
+from svir.calculations import aggregate_loss_by_zone
+from svir.calculations.aggregate_loss_by_zone import (
+    calculate_zonal_stats, expand_site_matches, summarize_by_zone,
+    ZoneAssignmentCache)
 
 from qgis.testing import unittest, start_app
 from qgis.testing.mocked import get_iface
@@ -69,7 +77,7 @@ class AggregateLossByZoneTestCase(unittest.TestCase):
         zonal_layer = QgsVectorLayer(
             self.zonal_copy_path, 'SVI zones', 'ogr')
         self.is_test_complete = False
-        calculate_zonal_stats(
+        self.task = calculate_zonal_stats(
             self.on_calculate_zonal_stats_finished,
             zonal_layer, points_layer, self.loss_attr_names,
             'output', discard_nonmatching=False,
@@ -106,5 +114,181 @@ class AggregateLossByZoneTestCase(unittest.TestCase):
                 expected_layer):
             ProcessLayer(output_layer).pprint(usage='testing')
             ProcessLayer(expected_layer).pprint(usage='testing')
+            diff = ProcessLayer(output_layer).compare_content_with(
+                expected_layer)
             raise Exception(
-                'The output layer is different than expected (see above)')
+                'The output layer is different than expected (see above):'
+                ' %s' % diff)
+
+
+class SummarizeByZoneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # site 0 is in zone 1, site 1 is on the border between zones 0 and 2
+        # and site 2 is outside all zones
+        site_idxs = numpy.array([0, 1, 1])
+        site_zone_idxs = numpy.array([1, 0, 2])
+        point_site_idxs = numpy.array([1, 0, 2, 1, 0])
+        self.point_idxs, self.zone_idxs = expand_site_matches(
+            point_site_idxs, site_idxs, site_zone_idxs, 3)
+        self.values = numpy.array(
+            [[1, 10], [2, 20], [3, 30], [4, numpy.nan], [5, 50]])
+        self.valid = ~numpy.isnan(self.values)
+
+    def test_expand_site_matches(self):
+        self.assertEqual(self.point_idxs.tolist(), [0, 0, 1, 3, 3, 4])
+        self.assertEqual(self.zone_idxs.tolist(), [0, 2, 1, 0, 2, 1])
+
+    def test_summaries(self):
+        summaries = summarize_by_zone(
+            self.point_idxs, self.zone_idxs, self.values, self.valid, 4,
+            summaries=('count', 'sum', 'mean', 'min', 'max', 'range'))
+        expected = [
+            {'count': [2, 2, 2], 'sum': [5, 7, 5], 'mean': [2.5, 3.5, 2.5],
+             'min': [1, 2, 1], 'max': [4, 5, 4], 'range': [3, 3, 3]},
+            {'count': [1, 2, 1], 'sum': [10, 70, 10],
+             'mean': [10, 35, 10], 'min': [10, 20, 10],
+             'max': [10, 50, 10], 'range': [0, 30, 0]}]
+        for field_summaries, expected_summaries in zip(summaries, expected):
+            self.assertEqual(list(field_summaries),
+                             ['count', 'sum', 'mean', 'min', 'max', 'range'])
+            for summary, (output, output_valid) in field_summaries.items():
+                # the last zone does not contain any point
+                self.assertEqual(output_valid.tolist(),
+                                 [True, True, True, False])
+                self.assertEqual(output[:3].tolist(),
+                                 expected_summaries[summary])
+
+
+class ZoneAssignmentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ZoneAssignmentCache(max_entries=2)
+        self.zonal_layer = QgsVectorLayer(
+            'Polygon?crs=epsg:4326', 'zones', 'memory')
+        self.sites = numpy.array([[0., 0.], [1., 1.]])
+        self.matches = (numpy.array([0, 1]), numpy.array([7, 8]))
+
+    def test_lookup(self):
+        zones_key = self.cache.layer_key(self.zonal_layer)
+        self.assertIsNone(
+            self.cache.lookup(zones_key, ('intersects',), self.sites))
+        self.cache.store(zones_key, ('intersects',), self.sites,
+                         *self.matches)
+        site_idxs, zone_fids = self.cache.lookup(
+            zones_key, ('intersects',), self.sites)
+        self.assertEqual(zone_fids.tolist(), [7, 8])
+        # different sites or predicates
+        self.assertIsNone(self.cache.lookup(
+            zones_key, ('intersects',), self.sites + 1))
+        self.assertIsNone(self.cache.lookup(
+            zones_key, ('contains',), self.sites))
+
+    def test_invalidated_when_zones_are_edited(self):
+        zones_key = self.cache.layer_key(self.zonal_layer)
+        self.cache.store(zones_key, ('intersects',), self.sites,
+                         *self.matches)
+        self.zonal_layer.startEditing()
+        feat = QgsFeature(self.zonal_layer.fields())
+        feat.setGeometry(QgsGeometry.fromWkt(
+            'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'))
+        self.zonal_layer.addFeature(feat)
+        self.assertIsNone(self.cache.lookup(
+            zones_key, ('intersects',), self.sites))
+        new_zones_key = self.cache.layer_key(self.zonal_layer)
+        self.assertNotEqual(new_zones_key, zones_key)
+        # results computed before the modification are not stored
+        self.cache.store(zones_key, ('intersects',), self.sites,
+                         *self.matches)
+        self.assertIsNone(self.cache.lookup(
+            new_zones_key, ('intersects',), self.sites))
+        self.zonal_layer.rollBack()
+
+    def test_least_recently_used_are_evicted(self):
+        zones_key = self.cache.layer_key(self.zonal_layer)
+        for offset in range(3):
+            self.cache.store(zones_key, ('intersects',), self.sites + offset,
+                             *self.matches)
+        self.assertIsNone(self.cache.lookup(
+            zones_key, ('intersects',), self.sites))
+        self.assertIsNotNone(self.cache.lookup(
+            zones_key, ('intersects',), self.sites + 2))
+
+    def test_file_key(self):
+        with tempfile.NamedTemporaryFile(suffix='.geojson') as zones_file:
+            zones_key = self.cache.file_key(zones_file.name)
+            self.assertEqual(zones_key, (
+                'file:%s' % zones_file.name,
+                os.path.getmtime(zones_file.name)))
+            # entries are stored without tracking any layer
+            self.cache.store(zones_key, ('intersects',), self.sites,
+                             *self.matches)
+            self.assertIsNotNone(self.cache.lookup(
+                zones_key, ('intersects',), self.sites))
+        self.assertIsNone(self.cache.file_key(zones_file.name))
+
+
+class ZonalStatsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        zones = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'ZONE': zone_idx},
+             'geometry': {'type': 'Polygon', 'coordinates': [[
+                 [zone_idx, 0], [zone_idx + 1, 0], [zone_idx + 1, 1],
+                 [zone_idx, 1], [zone_idx, 0]]]}}
+            for zone_idx in range(2)]}
+        self.zonal_layer_path = tempfile.NamedTemporaryFile(
+            suffix='.geojson', delete=False).name
+        with open(self.zonal_layer_path, 'w') as zones_file:
+            json.dump(zones, zones_file)
+        self.points_layer = QgsVectorLayer(
+            'Point?crs=epsg:4326', 'points', 'memory')
+        self.points_layer.dataProvider().addAttributes(
+            [QgsField('LOSS', QVariant.Double)])
+        self.points_layer.updateFields()
+        feats = []
+        for x, loss in ((0.5, 1.), (0.5, 2.), (1.5, 3.)):
+            feat = QgsFeature(self.points_layer.fields())
+            feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, 0.5)))
+            feat.setAttributes([loss])
+            feats.append(feat)
+        self.points_layer.dataProvider().addFeatures(feats)
+
+    def tearDown(self):
+        os.remove(self.zonal_layer_path)
+
+    def aggregate(self):
+        output_layers = []
+        calculate_zonal_stats(
+            output_layers.append, self.zonal_layer_path, self.points_layer,
+            ['LOSS'], 'output')
+        timeout = 5
+        start_time = time.time()
+        while not output_layers:
+            if time.time() - start_time > timeout:
+                raise TimeoutError(
+                    'Unable to run the aggregation within %s seconds'
+                    % timeout)
+            QGIS_APP.processEvents()
+            time.sleep(0.01)
+        self.assertIsNotNone(output_layers[0])
+        return output_layers[0]
+
+    def test_zones_of_a_path_are_reused(self):
+        cache = ZoneAssignmentCache()
+        with mock.patch.object(
+                aggregate_loss_by_zone, '_ZONE_ASSIGNMENT_CACHE', cache), \
+                mock.patch.object(
+                    aggregate_loss_by_zone, 'match_sites_to_zones',
+                    wraps=aggregate_loss_by_zone.match_sites_to_zones) \
+                as match_sites_to_zones:
+            for _ in range(2):
+                output_layer = self.aggregate()
+                self.assertEqual(
+                    [feat['LOSS_sum'] for feat in output_layer.getFeatures()],
+                    [3., 3.])
+        # the sites were matched to the zones only once
+        self.assertEqual(match_sites_to_zones.call_count, 1)
+        # the layers opened from the path are not tracked
+        self.assertEqual(cache._stamps, {})
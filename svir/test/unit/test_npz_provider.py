@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-06-24
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+# import qgis libs so that we set the correct sip api version
+import numpy
+from unittest import mock
+
+from qgis.core import QgsFeatureRequest, QgsRectangle, edit
+from qgis.testing import unittest, start_app
+
+from svir.calculations.calculate_utils import add_attribute
+from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
+from svir.utilities.npz_provider import (
+    NPZ_PROVIDER_KEY, register_npz_provider, create_npz_layer)
+
+QGIS_APP = start_app()
+
+
+class NpzProviderTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        assert register_npz_provider()
+
+    def setUp(self):
+        self.dataset = numpy.zeros(
+            10, [('lon', numpy.float32), ('lat', numpy.float32),
+                 ('taxonomy', 'S20'), ('value', numpy.float32)])
+        self.dataset['lon'] = numpy.arange(10)
+        self.dataset['lat'] = numpy.arange(10) / 2.
+        self.dataset['taxonomy'] = [b'tax-%d' % (i % 3) for i in range(10)]
+        self.dataset['value'] = numpy.arange(10) * 1.5
+        self.layer = create_npz_layer('test')
+        self.assertTrue(self.layer.isValid())
+        self.assertEqual(self.layer.providerType(), NPZ_PROVIDER_KEY)
+        add_attribute('taxonomy', 'S', self.layer)
+        add_attribute('value', 'F', self.layer)
+        added_ok = LoadOutputAsLayerDialog.add_features_from_columns(
+            self.layer,
+            {name: self.dataset[name] for name in ('taxonomy', 'value')},
+            lons=self.dataset['lon'], lats=self.dataset['lat'])
+        self.assertTrue(added_ok)
+
+    def test_features(self):
+        self.assertEqual(self.layer.featureCount(), 10)
+        self.assertEqual(self.layer.extent(), QgsRectangle(0, 0, 9, 4.5))
+        feats = list(self.layer.getFeatures())
+        self.assertEqual([feat.id() for feat in feats], list(range(1, 11)))
+        self.assertEqual(feats[4].attributes(), ['tax-1', 6.0])
+        self.assertEqual(feats[4].geometry().asWkt(), 'Point (4 2)')
+        self.assertEqual(self.layer.maximumValue(1), 13.5)
+
+    def test_requests(self):
+        request = QgsFeatureRequest().setFilterFids([3, 5, 42])
+        self.assertEqual([feat['value'] for feat in
+                          self.layer.getFeatures(request)], [3.0, 6.0])
+        request = QgsFeatureRequest().setFilterRect(
+            QgsRectangle(1.5, 0, 3.5, 10))
+        self.assertEqual([feat.id() for feat in
+                          self.layer.getFeatures(request)], [3, 4])
+        request = QgsFeatureRequest().setFilterExpression('"value" > 10')
+        self.assertEqual([feat.id() for feat in
+                          self.layer.getFeatures(request)], [9, 10])
+        request = QgsFeatureRequest().setSubsetOfAttributes([1]).setFlags(
+            QgsFeatureRequest.NoGeometry)
+        feat = next(self.layer.getFeatures(request))
+        self.assertEqual(feat['value'], 0.0)
+        self.assertFalse(feat['taxonomy'])
+        self.assertFalse(feat.hasGeometry())
+
+    def test_subset_string(self):
+        self.assertTrue(self.layer.setSubsetString("\"taxonomy\" = 'tax-0'"))
+        self.assertEqual(self.layer.featureCount(), 4)
+        self.assertEqual([feat.id() for feat in self.layer.getFeatures()],
+                         [1, 4, 7, 10])
+
+    def test_filtered_count_is_cached(self):
+        provider = self.layer.dataProvider()
+        self.assertTrue(provider.setSubsetString("\"taxonomy\" = 'tax-0'"))
+        with mock.patch.object(provider, 'getFeatures',
+                               wraps=provider.getFeatures) as get_features:
+            self.assertEqual(provider.featureCount(), 4)
+            self.assertEqual(provider.featureCount(), 4)
+            self.assertEqual(get_features.call_count, 1)
+            self.assertTrue(provider.changeAttributeValues({2: {0: 'tax-0'}}))
+            self.assertEqual(provider.featureCount(), 5)
+            self.assertTrue(
+                provider.setSubsetString("\"taxonomy\" = 'tax-1'"))
+            self.assertEqual(provider.featureCount(), 2)
+            self.assertEqual(get_features.call_count, 3)
+
+    def test_change_attribute_values(self):
+        with edit(self.layer):
+            self.layer.changeAttributeValue(2, 1, 100.0)
+        self.assertEqual(self.layer.getFeature(2)['value'], 100.0)
+        self.assertEqual(self.layer.getFeature(3)['value'], 3.0)
+        # the original data is left untouched
+        self.assertEqual(self.dataset['value'][1], 1.5)
@@ -24,7 +24,7 @@
 
 # import qgis libs so that we set the correct sip api version
 import os.path
-from qgis.core import QgsVectorLayer, QgsField
+from qgis.core import QgsVectorLayer, QgsField, QgsFeature, NULL
 
 
 from svir.calculations.process_layer import ProcessLayer
@@ -109,6 +109,46 @@ class CompareLayerContentTestCase(unittest.TestCase):
         res = ProcessLayer(self.layer_a).has_same_content_as(self.layer_d)
         self.assertEqual(res, False)
 
+    def test_compare_content_of_equal_layers(self):
+        diff = ProcessLayer(self.layer_a).compare_content_with(self.layer_b)
+        self.assertEqual(diff['field_diffs'], {})
+        self.assertEqual(diff['differing_feat_ids'], [])
+        self.assertEqual(ProcessLayer(self.layer_a).content_digest(),
+                         ProcessLayer(self.layer_b).content_digest())
+
+    def test_compare_content_of_layers_with_different_lengths(self):
+        diff = ProcessLayer(self.layer_a).compare_content_with(self.layer_c)
+        this_count, other_count = diff['feature_counts']
+        self.assertLess(this_count, other_count)
+        self.assertTrue(diff['field_diffs'])
+        self.assertNotEqual(ProcessLayer(self.layer_a).content_digest(),
+                            ProcessLayer(self.layer_c).content_digest())
+
+    def test_compare_content_reports_differing_values(self):
+        uri = 'Point?crs=epsg:4326&field=num:double&field=txt:string'
+        layers = []
+        for values in ([(1.0, 'a'), (2.0, 'b'), (NULL, NULL), (4.0, 'd')],
+                       [(1.0, 'a'), (2.0 + 1e-9, 'x'), (NULL, NULL),
+                        (5.0, 'y')]):
+            layer = QgsVectorLayer(uri, 'TestLayer', 'memory')
+            features = []
+            for attrs in values:
+                feat = QgsFeature(layer.fields())
+                feat.setAttributes(list(attrs))
+                features.append(feat)
+            layer.dataProvider().addFeatures(features)
+            layers.append(layer)
+        diff = ProcessLayer(layers[0]).compare_content_with(layers[1])
+        self.assertEqual(diff['feature_counts'], (4, 4))
+        self.assertEqual(diff['field_diffs'], {'num': 1, 'txt': 2})
+        feat_ids = [feat.id() for feat in layers[0].getFeatures()]
+        self.assertEqual(diff['differing_feat_ids'], feat_ids[1::2])
+        self.assertFalse(
+            ProcessLayer(layers[0]).has_same_content_as(layers[1]))
+        digests = [ProcessLayer(layer).content_digest() for layer in layers]
+        self.assertEqual(digests[0].keys(), digests[1].keys())
+        self.assertNotEqual(digests[0]['num'], digests[1]['num'])
+
 
 class AddAttributesTestCase(unittest.TestCase):
 
@@ -169,3 +209,78 @@ class AddAttributesTestCase(unittest.TestCase):
         expected_dict = {'first': 'first_2',
                          'second': 'second_2'}
         self.assertEqual(added_attributes, expected_dict)
+
+    def test_add_many_attributes_at_once(self):
+        attributes = []
+        for i in range(300):
+            field = QgsField('field-%s' % (i % 100), INT_FIELD_TYPE)
+            field.setTypeName(INT_FIELD_TYPE_NAME)
+            attributes.append(field)
+        ProcessLayer(self.layer).add_attributes(attributes)
+        # names assigned within the same call are laundered too
+        field_names = self.layer.fields().names()
+        self.assertEqual(len(field_names), 300)
+        self.assertEqual(len(set(field_names)), 300)
+        self.assertIn('field-7_2', field_names)
+        field_idx = self.layer.fields().indexOf('field-7_2')
+        self.assertEqual(self.layer.attributeAlias(field_idx), 'field-7')
+
+    def test_launder_attribute_name(self):
+        launder = ProcessLayer.launder_attribute_name
+        self.assertEqual(launder('long attribute name'),
+                         'long attribute name')
+        self.assertEqual(launder('long attribute name', suffix_num=3),
+                         'long attribute name_3')
+        self.assertEqual(launder('long attribute name', is_shapefile=True),
+                         'LONG_ATTRI')
+        self.assertEqual(
+            launder('long attribute name', is_shapefile=True, suffix_num=12),
+            'LONG_AT_12')
+
+
+class TransformAttributeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        uri = 'Point?crs=epsg:4326&field=value:double'
+        self.layer = QgsVectorLayer(uri, 'TestLayer', 'memory')
+        features = []
+        for value in (7, 6, NULL, 0, 6):
+            feat = QgsFeature(self.layer.fields())
+            feat.setAttributes([value])
+            features.append(feat)
+        self.layer.dataProvider().addFeatures(features)
+        self.expected = [4, 2.5, NULL, 1, 2.5]
+
+    def get_values(self, attr_name):
+        return [feat[attr_name] for feat in self.layer.getFeatures()]
+
+    def test_transform_into_new_attribute(self):
+        progress = []
+        res_attr_name, invalid_input_values = ProcessLayer(
+            self.layer).transform_attribute(
+                'value', 'RANK', 'AVERAGE', new_attr_name='ranked',
+                set_progress=progress.append)
+        self.assertEqual(res_attr_name, 'ranked')
+        self.assertIsNone(invalid_input_values)
+        self.assertFalse(self.layer.isEditable())
+        self.assertEqual(self.get_values('ranked'), self.expected)
+        self.assertEqual(progress[-1], 100)
+
+    def test_overwrite_attribute_being_edited(self):
+        # changes go through the edit buffer and they are not committed
+        self.layer.startEditing()
+        ProcessLayer(self.layer).transform_attribute(
+            'value', 'RANK', 'AVERAGE', new_attr_name='value')
+        self.assertTrue(self.layer.isEditable())
+        self.assertEqual(self.get_values('value'), self.expected)
+        self.layer.rollBack()
+        self.assertEqual(self.get_values('value'), [7, 6, NULL, 0, 6])
+
+    def test_canceled_transformation_leaves_layer_unchanged(self):
+        res = ProcessLayer(self.layer).transform_attribute(
+            'value', 'RANK', 'AVERAGE', new_attr_name='ranked',
+            is_canceled=lambda: True)
+        self.assertIsNone(res)
+        self.assertEqual(self.layer.fields().names(), ['value'])
+        self.assertEqual(self.get_values('value'), [7, 6, NULL, 0, 6])
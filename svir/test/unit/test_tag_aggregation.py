@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-08-19
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy
+
+from qgis.testing import unittest, start_app
+
+from svir.calculations.tag_aggregation import TagAggregator
+
+start_app()
+
+
+def make_npz(num_assets=1000, rlzs=('rlz-000', 'rlz-001')):
+    rng = numpy.random.RandomState(42)
+    dtype = [('taxonomy', 'S20'), ('NAME_1', 'S10'),
+             ('lon', numpy.float32), ('lat', numpy.float32),
+             ('structural-no_damage', numpy.float32),
+             ('structural-ds1', numpy.float32)]
+    taxonomies = numpy.array([b'"Wood"', b'"Adobe"', b'"Concrete"'])[
+        rng.randint(0, 3, num_assets)]
+    regions = numpy.array([b'East', b'West'])[rng.randint(0, 2, num_assets)]
+    npz = {'extra': numpy.zeros(1)}
+    for rlz in rlzs:
+        records = numpy.zeros(num_assets, dtype)
+        records['taxonomy'] = taxonomies
+        records['NAME_1'] = regions
+        records['structural-no_damage'] = rng.uniform(size=num_assets)
+        records['structural-ds1'] = rng.uniform(size=num_assets)
+        npz[rlz] = records
+    return npz
+
+
+class TagAggregatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.npz = make_npz()
+        self.field_names = ['structural-no_damage', 'structural-ds1']
+        self.aggregator = TagAggregator.from_npz(
+            self.npz, ['taxonomy', 'NAME_1', 'not_a_field'])
+
+    def expected_sums(self, mask):
+        return numpy.array([
+            [self.npz[rlz][field_name][mask].astype(numpy.float64).sum()
+             for field_name in self.field_names]
+            for rlz in ('rlz-000', 'rlz-001')])
+
+    def test_only_fields_are_indexed(self):
+        self.assertEqual(sorted(self.aggregator.index), ['NAME_1', 'taxonomy'])
+        self.assertEqual(sorted(self.aggregator.index['taxonomy']),
+                         ['Adobe', 'Concrete', 'Wood'])
+
+    def test_aggregate(self):
+        rlz_records = self.npz['rlz-000']
+        mask = (numpy.isin(rlz_records['taxonomy'], [b'"Wood"', b'"Adobe"'])
+                & (rlz_records['NAME_1'] == b'West'))
+        sums = self.aggregator.aggregate(
+            self.field_names, {'taxonomy': ['Wood', 'Adobe'],
+                               'NAME_1': ['West']})
+        numpy.testing.assert_allclose(sums, self.expected_sums(mask))
+        # without tags, all assets are aggregated
+        numpy.testing.assert_allclose(
+            self.aggregator.aggregate(self.field_names, {}),
+            self.expected_sums(numpy.ones(len(rlz_records), dtype=bool)))
+
+    def test_nothing_selected(self):
+        self.assertIsNone(self.aggregator.aggregate(
+            self.field_names, {'taxonomy': ['Steel']}))
+
+    def test_aggregate_by_tag(self):
+        rlz_records = self.npz['rlz-000']
+        tag_values, sums = self.aggregator.aggregate_by_tag(
+            self.field_names, {'taxonomy': ['*'], 'NAME_1': ['East']},
+            'taxonomy')
+        self.assertEqual(tag_values, ['Adobe', 'Concrete', 'Wood'])
+        for tag_value, tag_sums in zip(tag_values, sums):
+            mask = ((rlz_records['taxonomy'] == ('"%s"' % tag_value).encode())
+                    & (rlz_records['NAME_1'] == b'East'))
+            numpy.testing.assert_allclose(tag_sums, self.expected_sums(mask))
+
+    def test_missing_tag_or_field(self):
+        with self.assertRaises(KeyError):
+            self.aggregator.aggregate(self.field_names, {'occupancy': ['a']})
+        with self.assertRaises(KeyError):
+            self.aggregator.aggregate(['structural-ds2'], {})
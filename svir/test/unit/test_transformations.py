@@ -26,7 +26,11 @@ import numpy as np
 
 from svir.calculations.transformation_algs import (
     transform,
-    TRANSFORMATION_ALGS)
+    transform_column,
+    to_column,
+    from_column,
+    TRANSFORMATION_ALGS,
+    RANK_VARIANTS)
 from qgis.core import NULL
 from qgis.testing import unittest, start_app
 
@@ -63,6 +67,59 @@ class MissingValuesTestCase(unittest.TestCase):
             self.assertEqual(transformed_dict, expected_dict)
 
 
+class ColumnarTransformationTestCase(unittest.TestCase):
+
+    def test_to_column_and_back(self):
+        values, valid = to_column([3, None, 1.5, NULL])
+        np.testing.assert_array_equal(valid, [True, False, True, False])
+        self.assertEqual(values.dtype, np.float64)
+        self.assertEqual(values[0], 3)
+        self.assertEqual(values[2], 1.5)
+        output_valid = np.array([True, False, False, False])
+        self.assertEqual(
+            from_column(values, output_valid, valid), [3.0, None, NULL, None])
+
+    def test_missing_values_are_ignored(self):
+        values = np.array([2, 0, 1000, 1])
+        valid = np.array([True, True, False, True])
+        output, output_valid, invalid_idxs = transform_column(
+            values, valid, 'MIN_MAX')
+        np.testing.assert_array_equal(output_valid, valid)
+        np.testing.assert_array_equal(output[valid], [1, 0, 0.5])
+        self.assertEqual(len(invalid_idxs), 0)
+
+    def test_invalid_inputs_reported_as_indices(self):
+        values = np.array([0.5, 1, 0.2, 1, 0.7])
+        valid = np.array([True, True, True, False, True])
+        output, output_valid, invalid_idxs = transform_column(
+            values, valid, 'SIGMOID', inverse=True)
+        np.testing.assert_array_equal(invalid_idxs, [1])
+        np.testing.assert_array_equal(
+            output_valid, [True, False, True, False, True])
+
+    def test_columnar_and_list_algorithms_agree(self):
+        rng = np.random.RandomState(42)
+        input_list = rng.uniform(0.01, 0.99, 1000).tolist()
+        input_list[10] = None
+        input_list[20] = None
+        for algorithm_name, variants in (
+                ('RANK', RANK_VARIANTS),
+                ('Z_SCORE', ('',)),
+                ('MIN_MAX', ('',)),
+                ('QUADRATIC', ('INCREASING', 'DECREASING')),
+                ('SIGMOID', ('',))):
+            for variant_name in variants:
+                for inverse in (False, True):
+                    transformed_list, _ = TRANSFORMATION_ALGS[
+                        algorithm_name](input_list, variant_name, inverse)
+                    values, valid = to_column(input_list)
+                    output, output_valid, _ = transform_column(
+                        values, valid, algorithm_name, variant_name, inverse)
+                    self.assertEqual(
+                        transformed_list,
+                        from_column(output, output_valid, valid))
+
+
 class RankTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -120,6 +177,109 @@ class RankTestCase(unittest.TestCase):
             self.input_list, variant_name="ORDINAL", inverse=True)
         self.assertEqual(rank_list, [2, 7, 3, 6, 4, 1, 5])
 
+    def test_rank_with_missing_values(self):
+        input_list = [2, None, 0, NULL, 2]
+        rank_list, _ = self.alg(input_list, variant_name="AVERAGE")
+        self.assertEqual(rank_list, [2.5, None, 1, None, 2.5])
+        rank_list, _ = self.alg(
+            input_list, variant_name="MIN", inverse=True)
+        self.assertEqual(rank_list, [1, None, 3, None, 1])
+
+    def test_rank_without_valid_values(self):
+        rank_list, _ = self.alg([None, None])
+        self.assertEqual(rank_list, [None, None])
+
+    def test_rank_unknown_variant(self):
+        with self.assertRaises(NotImplementedError):
+            self.alg(self.input_list, variant_name="UNKNOWN")
+
+    def test_rank_equivalent_to_previous_implementation(self):
+        # randomly generated inputs, with many ties, must obtain exactly the
+        # same ranks (values and types) produced by the previous quadratic
+        # implementation
+        rng = np.random.RandomState(42)
+        for _ in range(200):
+            len_input = rng.randint(1, 60)
+            max_value = rng.randint(1, 20)
+            if rng.randint(2):
+                input_list = rng.randint(
+                    -max_value, max_value, len_input).tolist()
+            else:
+                input_list = (rng.randint(
+                    -max_value, max_value, len_input) / 4.0).tolist()
+            for variant_name in RANK_VARIANTS:
+                for inverse in (False, True):
+                    rank_list, _ = self.alg(
+                        input_list, variant_name=variant_name,
+                        inverse=inverse)
+                    expected = quadratic_rank(
+                        input_list, variant_name=variant_name,
+                        inverse=inverse)
+                    self.assertEqual(rank_list, expected)
+                    self.assertEqual([type(r) for r in rank_list],
+                                     [type(r) for r in expected])
+
+
+def quadratic_rank(input_values, variant_name="AVERAGE", inverse=False):
+    # the previous implementation of the RANK transformation, used as a
+    # reference for the current one
+    input_copy = input_values[:]
+    len_input_values = len(input_values)
+    rank_list = [0] * len_input_values
+    previous_ties = 0
+    if not inverse:
+        above_max_input = max(input_values) + 1
+        curr_idx = 1
+        while curr_idx <= len_input_values:
+            bottom_indices = np.argwhere(
+                input_copy == np.amin(input_copy)).flatten().tolist()
+            bottom_amount = len(bottom_indices)
+            for bottom_idx in bottom_indices:
+                if variant_name == "AVERAGE":
+                    rank_list[bottom_idx] = \
+                        (2 * curr_idx + bottom_amount - 1) / 2.0
+                elif variant_name == "MIN":
+                    rank_list[bottom_idx] = curr_idx
+                elif variant_name == "MAX":
+                    rank_list[bottom_idx] = curr_idx + bottom_amount - 1
+                elif variant_name == "DENSE":
+                    rank_list[bottom_idx] = curr_idx - previous_ties
+                elif variant_name == "ORDINAL":
+                    rank_list[bottom_idx] = curr_idx
+                    curr_idx += 1
+                input_copy[bottom_idx] = above_max_input
+            if variant_name != "ORDINAL":
+                curr_idx += bottom_amount
+            previous_ties += bottom_amount - 1
+    else:
+        below_min_input = min(input_values) - 1
+        curr_idx = len_input_values
+        while curr_idx > 0:
+            top_indices = np.argwhere(
+                input_copy == np.amax(input_copy)).flatten().tolist()
+            top_amount = len(top_indices)
+            for top_idx in top_indices:
+                if variant_name == "AVERAGE":
+                    rank_list[top_idx] = (
+                        len_input_values - (2 * curr_idx - top_amount - 1) /
+                        2.0)
+                elif variant_name == "MIN":
+                    rank_list[top_idx] = len_input_values - curr_idx + 1
+                elif variant_name == "MAX":
+                    rank_list[top_idx] = (
+                        len_input_values - curr_idx + top_amount)
+                elif variant_name == "DENSE":
+                    rank_list[top_idx] = \
+                        len_input_values - curr_idx - previous_ties + 1
+                elif variant_name == "ORDINAL":
+                    rank_list[top_idx] = len_input_values - curr_idx + 1
+                    curr_idx -= 1
+                input_copy[top_idx] = below_min_input
+            if variant_name != "ORDINAL":
+                curr_idx -= top_amount
+            previous_ties += top_amount - 1
+    return rank_list
+
 
 class MinMaxTestCase(unittest.TestCase):
 
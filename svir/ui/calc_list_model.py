@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-09-09
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from qgis.PyQt.QtCore import (
+    Qt, QAbstractTableModel, QModelIndex, QEvent, pyqtSignal)
+from qgis.PyQt.QtGui import QColor, QBrush
+from qgis.PyQt.QtWidgets import QStyledItemDelegate
+
+# (key in the json of the calculation, header)
+CALC_COLUMNS = (
+    ('description', 'Description'),
+    ('id', 'Job ID'),
+    ('calculation_mode', 'Calculation Mode'),
+    ('owner', 'Owner'),
+    ('status', 'Status'),
+)
+CALC_ID_COLUMN = 1
+
+CALC_ACTIONS = (
+    {'label': 'Console', 'bg_color': '#3cb3c5', 'txt_color': 'white'},
+    {'label': 'Remove', 'bg_color': '#d9534f', 'txt_color': 'white'},
+    {'label': 'Outputs', 'bg_color': '#3cb3c5', 'txt_color': 'white'},
+    {'label': 'Continue', 'bg_color': 'white', 'txt_color': 'black'},
+    {'label': 'Abort', 'bg_color': '#d9534f', 'txt_color': 'white'},
+)
+
+COMPLETE_STATUSES = ('complete', 'shared')
+
+
+def is_action_available(calc, action_label):
+    """
+    Tell if the button of the given action has to be displayed for the
+    given calculation
+    """
+    calc_status = calc['status']
+    if action_label == 'Abort':
+        # only if the calc is running
+        return bool(calc.get('is_running'))
+    if action_label == 'Remove':
+        # only if the calc is failed, complete or shared
+        return calc_status in ('failed',) + COMPLETE_STATUSES
+    if action_label in ('Outputs', 'Continue'):
+        # only if the calc is complete or shared
+        return calc_status in COMPLETE_STATUSES
+    return True
+
+
+class CalcListModel(QAbstractTableModel):
+    """
+    Model of the list of calculations of the OpenQuake Engine server. When
+    the list is refreshed, the new one is compared with the current one by
+    job id, so only the rows that were added, removed or changed are
+    notified to the views.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.calcs = []
+        self._rows_by_id = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.calcs)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(CALC_COLUMNS) + len(CALC_ACTIONS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation != Qt.Horizontal or role != Qt.DisplayRole:
+            return None
+        if section < len(CALC_COLUMNS):
+            return CALC_COLUMNS[section][1]
+        return ''
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        calc = self.calcs[index.row()]
+        col = index.column()
+        if col >= len(CALC_COLUMNS):
+            action = CALC_ACTIONS[col - len(CALC_COLUMNS)]
+            if not is_action_available(calc, action['label']):
+                return None
+            if role == Qt.DisplayRole:
+                return action['label']
+            elif role == Qt.BackgroundRole:
+                return QColor(action['bg_color'])
+            elif role == Qt.ForegroundRole:
+                return QBrush(QColor(action['txt_color']))
+            return None
+        if role == Qt.DisplayRole:
+            key = CALC_COLUMNS[col][0]
+            # NOTE: from engine2.5 to engine2.6, job_type was changed into
+            # calculation_mode. This check prevents the plugin to break when
+            # using an old version of the engine.
+            if key == 'calculation_mode':
+                return calc.get(key, 'unknown')
+            return calc[key]
+        elif role == Qt.BackgroundRole:
+            if calc['status'] == 'failed':
+                return QColor('#f2dede')
+            elif calc['status'] in COMPLETE_STATUSES:
+                return QColor('#dff0d8')
+            return QColor(Qt.white)
+        elif role == Qt.ForegroundRole:
+            return QBrush(Qt.black)
+        return None
+
+    def calc_id(self, row):
+        return self.calcs[row]['id']
+
+    def row_of(self, calc_id):
+        """
+        :returns: the row of the given calculation, or None
+        """
+        return self._rows_by_id.get(calc_id)
+
+    def update_calcs(self, calcs):
+        """
+        Replace the list of calculations, notifying only the rows that
+        changed. The order of the calculations that are kept is expected not
+        to change (otherwise the whole model is reset).
+        """
+        new_ids = [calc['id'] for calc in calcs]
+        new_id_set = set(new_ids)
+        kept_ids = [calc['id'] for calc in self.calcs
+                    if calc['id'] in new_id_set]
+        if (len(new_id_set) != len(new_ids)
+                or kept_ids != [calc_id for calc_id in new_ids
+                                if calc_id in self._rows_by_id]):
+            self.beginResetModel()
+            self.calcs = list(calcs)
+            self._reindex()
+            self.endResetModel()
+            return
+        # remove the calculations that disappeared, from the bottom
+        for row in range(len(self.calcs) - 1, -1, -1):
+            if self.calcs[row]['id'] not in new_id_set:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.calcs[row]
+                self.endRemoveRows()
+        # insert the new calculations and update the changed ones
+        last_col = self.columnCount() - 1
+        for row, calc in enumerate(calcs):
+            if (row >= len(self.calcs)
+                    or self.calcs[row]['id'] != calc['id']):
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.calcs.insert(row, calc)
+                self.endInsertRows()
+            elif self.calcs[row] != calc:
+                self.calcs[row] = calc
+                self.dataChanged.emit(
+                    self.index(row, 0), self.index(row, last_col))
+        self._reindex()
+
+    def _reindex(self):
+        self._rows_by_id = {
+            calc['id']: row for row, calc in enumerate(self.calcs)}
+
+
+class CalcActionsDelegate(QStyledItemDelegate):
+    """
+    Draw the action buttons of the list of calculations, instead of using a
+    widget for each of them, and notify which one was clicked
+    """
+
+    action_clicked = pyqtSignal(int, str)
+
+    def paint(self, painter, option, index):
+        label = index.data(Qt.DisplayRole)
+        if not label:
+            return
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        painter.save()
+        painter.fillRect(rect, index.data(Qt.BackgroundRole))
+        painter.setPen(index.data(Qt.ForegroundRole).color())
+        painter.drawText(rect, Qt.AlignCenter, label)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if (event.type() == QEvent.MouseButtonRelease
+                and event.button() == Qt.LeftButton
+                and index.data(Qt.DisplayRole)
+                and option.rect.contains(event.pos())):
+            self.action_clicked.emit(
+                model.calc_id(index.row()), index.data(Qt.DisplayRole))
+            return True
+        return super().editorEvent(event, model, option, index)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-22
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+import numpy
+from qgis.core import QgsFeatureRequest
+
+from svir.calculations.transformation_algs import to_column
+
+
+class CurveFieldLayout(object):
+    """
+    Index of the fields of a layer of hazard curves or of uniform hazard
+    spectra, telling which attributes contain the ordinates of each curve
+    and what the corresponding abscissae are.
+
+    Fields of hazard curves are named like 'mean_PGA_0.005'
+    (rlz_or_stat, imt, iml), and curves are identified by (rlz_or_stat, imt).
+    Fields of uniform hazard spectra are named like 'mean_SA(0.025)'
+    (rlz_or_stat, imt), and curves are identified by (rlz_or_stat, None),
+    using the periods as abscissae (0.0 for PGA).
+
+    :param fields: the QgsFields of the layer
+    :param output_type: 'hcurves' or 'uhs'
+    :raises ValueError: if the periods of uniform hazard spectra can not be
+        read from the names of the fields
+    """
+
+    def __init__(self, fields, output_type):
+        self.output_type = output_type
+        # (rlz_or_stat, imt) -> indices of the attributes, in field order
+        self.attr_idxs = OrderedDict()
+        # (rlz_or_stat, imt) -> abscissae of the curve
+        self.abscissae = OrderedDict()
+        # True if some intensity measure levels are not numeric (in which
+        # case they are kept as strings)
+        self.non_numeric_abscissae = False
+        for attr_idx, field in enumerate(fields):
+            field_name = field.name()
+            if field_name == 'fid':
+                continue
+            if output_type == 'hcurves':
+                parts = field_name.split('_')
+                if len(parts) < 3:
+                    continue
+                rlz_or_stat, imt, abscissa = parts[:3]
+                try:
+                    abscissa = float(abscissa)
+                except ValueError:
+                    self.non_numeric_abscissae = True
+            elif output_type == 'uhs':
+                rlz_or_stat, _, imt = field_name.partition('_')
+                if imt == 'PGA':
+                    abscissa = 0.0
+                elif '(' in imt:
+                    abscissa = float(imt[imt.find('(') + 1:imt.find(')')])
+                else:
+                    continue
+                imt = None
+            else:
+                raise NotImplementedError(output_type)
+            key = (rlz_or_stat, imt)
+            self.attr_idxs.setdefault(key, []).append(attr_idx)
+            self.abscissae.setdefault(key, []).append(abscissa)
+        if not self.non_numeric_abscissae:
+            for key, abscissae in self.abscissae.items():
+                self.abscissae[key] = numpy.array(abscissae)
+        self.rlzs_or_stats = sorted(set(key[0] for key in self.attr_idxs))
+        self.imts = sorted(set(
+            key[1] for key in self.attr_idxs if key[1] is not None))
+
+    def fetch(self, layer, feat_ids, keys):
+        """
+        Read the ordinates of the given curves for the given features, with
+        a single request limited to the corresponding attributes
+
+        :param layer: the layer the index was built for
+        :param feat_ids: ids of the features to be read
+        :param keys: list of (rlz_or_stat, imt) identifying the curves
+        :returns: (feat_ids, ordinates), where feat_ids are the ids of the
+            features in the order they were read, and ordinates is a dict
+            associating to each key a float64 array with a row for each
+            feature (missing values are nan)
+        """
+        keys = [key for key in keys if key in self.attr_idxs]
+        attr_idxs = [attr_idx for key in keys
+                     for attr_idx in self.attr_idxs[key]]
+        request = QgsFeatureRequest().setFlags(
+            QgsFeatureRequest.NoGeometry).setFilterFids(
+                list(feat_ids)).setSubsetOfAttributes(attr_idxs)
+        read_feat_ids = []
+        values = []
+        for feature in layer.getFeatures(request):
+            read_feat_ids.append(feature.id())
+            attrs = feature.attributes()
+            values.extend([attrs[attr_idx] for attr_idx in attr_idxs])
+        matrix = to_column(values)[0].reshape(
+            len(read_feat_ids), len(attr_idxs))
+        ordinates = {}
+        start = 0
+        for key in keys:
+            stop = start + len(self.attr_idxs[key])
+            ordinates[key] = matrix[:, start:stop]
+            start = stop
+        return read_feat_ids, ordinates
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-09-02
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+HTTP client used for all the calls to the OpenQuake Engine server, with a
+pool of connections sized for concurrent extracts, retries of idempotent
+calls, timeouts depending on the endpoint and metrics of the requests.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from time import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from svir.utilities.extract_pool import MAX_CONCURRENT_EXTRACTS
+
+# maximum number of connections kept alive with each host. Besides the
+# extracts downloaded concurrently, the dialog to drive the engine polls the
+# list of calculations and the logs, and outputs can be downloaded meanwhile
+POOL_SIZE = MAX_CONCURRENT_EXTRACTS + 6
+
+# retries of failed idempotent calls, waiting BACKOFF_FACTOR * 2 ** n seconds
+# before the n-th retry
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# seconds to wait for a connection to be established
+CONNECT_TIMEOUT = 10
+
+# (name of the endpoint, pattern of the path of the url, seconds to wait for
+# the server to send data) for each kind of call. The first matching pattern
+# is used. Extracts and downloads can take the engine an arbitrarily long
+# time to be built, so they have no read timeout, and a call whose response
+# is slow is never repeated (see LONG_ENDPOINTS)
+ENDPOINT_TIMEOUTS = (
+    ('extract', re.compile(r'/v1/calc/\d+/extract/'), None),
+    ('download', re.compile(r'/v1/calc/(result/|\d+/datastore)'), None),
+    ('run', re.compile(r'/v1/(calc/run|on_same_fs)'), 20),
+    ('login', re.compile(r'/accounts/'), 10),
+    ('calc', re.compile(r'/v1/calc/'), 10),
+    ('other', re.compile(r''), 10),
+)
+
+
+def get_endpoint(url):
+    """
+    :returns: (name of the endpoint, read timeout) corresponding to the url
+    """
+    for endpoint, pattern, read_timeout in ENDPOINT_TIMEOUTS:
+        if pattern.search(url):
+            return endpoint, read_timeout
+
+
+# endpoints whose calls are not retried after a failure reading the
+# response (the error is raised as is), since the server would compute it
+# again
+LONG_ENDPOINTS = frozenset(['extract', 'download'])
+
+
+def make_retry(read=None):
+    """
+    :param read: number of retries after errors reading the response (by
+        default, limited only by MAX_RETRIES), or False to raise the error
+        without retrying
+    """
+    kwargs = dict(total=MAX_RETRIES, read=read,
+                  backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES,
+                  # the last response is returned instead of raising an
+                  # exception, so callers can report the error of the server
+                  raise_on_status=False)
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+class RequestMetrics(object):
+    """
+    Thread-safe counters of the requests made to the engine server, by
+    endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()
+
+    def record(self, endpoint, latency, num_bytes=0, retries=0, error=False):
+        """
+        :param latency: seconds until the response arrived (only its
+            headers, for streamed responses), including retries
+        :param num_bytes: size of the body of the response (for streamed
+            responses, the one declared by the server, if any)
+        """
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, dict(
+                requests=0, errors=0, retries=0, bytes=0,
+                total_latency=0.0, max_latency=0.0))
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['retries'] += retries
+            stats['bytes'] += num_bytes
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+
+    def summary(self):
+        """
+        :returns: a dict {endpoint: dict of counters}, including the mean
+            latency
+        """
+        with self._lock:
+            summary = OrderedDict()
+            for endpoint, stats in self._stats.items():
+                summary[endpoint] = dict(
+                    stats, mean_latency=stats['total_latency'] / max(
+                        stats['requests'], 1))
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def __str__(self):
+        return '\n'.join(
+            '%s: %s requests (%s errors, %s retries), %.1f kB,'
+            ' latency %.3f s (max %.3f s)' % (
+                endpoint, stats['requests'], stats['errors'],
+                stats['retries'], stats['bytes'] / 1024,
+                stats['mean_latency'], stats['max_latency'])
+            for endpoint, stats in self.summary().items())
+
+
+class EngineSession(Session):
+    """
+    Session with the OpenQuake Engine server, keeping connections alive in a
+    pool shared by all the threads. Idempotent calls are retried with
+    exponential backoff on connection errors and on 502, 503 and 504
+    responses (also on errors reading the response, except for extracts and
+    downloads), and each call gets the timeout of its endpoint unless a
+    timeout is given explicitly.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=make_retry())
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        # NOTE: retries are a property of the adapter, so calls to long
+        #       endpoints use another one (see get_adapter)
+        self.long_call_adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=make_retry(read=False))
+        self.metrics = RequestMetrics()
+
+    def get_adapter(self, url):
+        adapter = super().get_adapter(url)
+        if (isinstance(adapter, HTTPAdapter)
+                and get_endpoint(url)[0] in LONG_ENDPOINTS):
+            return self.long_call_adapter
+        return adapter
+
+    def close(self):
+        super().close()
+        self.long_call_adapter.close()
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint, read_timeout = get_endpoint(url)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (CONNECT_TIMEOUT, read_timeout)
+        start_time = time()
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+        except Exception:
+            self.metrics.record(endpoint, time() - start_time, error=True)
+            raise
+        latency = time() - start_time
+        retries = getattr(resp.raw, 'retries', None)
+        if kwargs.get('stream'):
+            num_bytes = int(resp.headers.get('content-length') or 0)
+        else:
+            num_bytes = len(resp.content)
+        self.metrics.record(
+            endpoint, latency, num_bytes=num_bytes,
+            retries=len(retries.history) if retries is not None else 0,
+            error=not resp.ok)
+        return resp
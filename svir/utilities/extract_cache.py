@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-05-27
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from time import time
+
+from qgis.core import QgsApplication
+from qgis.PyQt.QtCore import QSettings
+
+from svir.utilities.shared import DEFAULT_SETTINGS
+
+# only the outputs of calculations in these states can not change anymore
+CACHEABLE_CALC_STATUSES = ('complete', 'shared')
+
+# seconds during which the status of a calculation, once checked, is
+# considered still valid
+CALC_STATUS_TTL = 60
+
+INDEX_FILENAME = 'index.json'
+
+
+class ExtractCache(object):
+    """
+    Persistent on-disk cache of the .npz files extracted from the
+    OpenQuake Engine server.
+
+    Entries are keyed by (hostname, calc_id, output_type, params). Outputs of
+    completed calculations are immutable, so they can be reused as long as
+    the calculation is still available on the server and it is still the
+    same calculation (e.g. the engine database was not reset, assigning the
+    same id to a different calculation). When the total size exceeds the
+    given limit, the least recently used entries are evicted.
+
+    :param cache_dir: directory where the .npz files and the index are
+        stored
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self._lock = threading.RLock()
+        # (hostname, calc_id) -> (time of the check, fingerprint or None)
+        self._checked_calcs = {}
+        self._index = None
+
+    @property
+    def enabled(self):
+        return QSettings().value(
+            'irmt/extract_cache_enabled',
+            DEFAULT_SETTINGS['extract_cache_enabled'], type=bool)
+
+    @property
+    def max_size(self):
+        max_size_mb = QSettings().value(
+            'irmt/extract_cache_max_size_mb',
+            DEFAULT_SETTINGS['extract_cache_max_size_mb'], type=int)
+        return max_size_mb * 1024 * 1024
+
+    @staticmethod
+    def make_key(hostname, calc_id, output_type, params=None):
+        params = sorted((params or {}).items())
+        key = json.dumps([hostname.rstrip('/'), int(calc_id), output_type,
+                          params], default=str)
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        try:
+            with open(self.index_path, 'r') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        # discard entries whose files were removed externally
+        for key in list(self._index):
+            if not os.path.isfile(self._entry_path(key)):
+                del self._index[key]
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def _remove_entry(self, key):
+        entry = self._index.pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            # NOTE: on Windows a file can not be removed while it is
+            # memory-mapped. It will be removed together with the index
+            # the next time the cache is purged.
+            pass
+        return entry
+
+    def get_calc_fingerprint(self, session, hostname, calc_id):
+        """
+        Return a fingerprint identifying a completed calculation, or None
+        if the calculation does not exist anymore or if its outputs can
+        still change. The result is memoized for CALC_STATUS_TTL seconds.
+        """
+        calc = (hostname.rstrip('/'), int(calc_id))
+        with self._lock:
+            checked = self._checked_calcs.get(calc)
+        if checked is not None and time() - checked[0] < CALC_STATUS_TTL:
+            return checked[1]
+        url = '%s/v1/calc/%s/status' % calc
+        # FIXME: enable the user to set verify=True
+        resp = session.get(url, verify=False)
+        if resp.status_code == 404:
+            fingerprint = None
+        else:
+            resp.raise_for_status()
+            status = json.loads(resp.text)
+            if status.get('status') not in CACHEABLE_CALC_STATUSES:
+                fingerprint = None
+            else:
+                fingerprint = json.dumps(
+                    [status.get(attr) for attr in (
+                        'calculation_mode', 'description', 'owner',
+                        'start_time', 'parent_id')], default=str)
+        with self._lock:
+            self._checked_calcs[calc] = (time(), fingerprint)
+        return fingerprint
+
+    def lookup(self, session, hostname, calc_id, output_type, params=None):
+        """
+        Return the path of the cached .npz file corresponding to the given
+        extraction, or None if it is not cached or it is no longer valid.
+        """
+        if not self.enabled:
+            return None
+        key = self.make_key(hostname, calc_id, output_type, params)
+        with self._lock:
+            if key not in self._load_index():
+                return None
+        try:
+            fingerprint = self.get_calc_fingerprint(
+                session, hostname, calc_id)
+        except Exception:
+            # without a connection we can not tell if the entry is still
+            # valid, but the extraction would fail anyway
+            return None
+        with self._lock:
+            index = self._load_index()
+            if fingerprint is None:
+                # the calculation was removed: its entries are useless
+                self._purge_calc(hostname, calc_id)
+                self._save_index()
+                return None
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if entry['fingerprint'] != fingerprint:
+                # the calculation was re-run
+                self._purge_calc(hostname, calc_id)
+                self._save_index()
+                return None
+            entry['last_access'] = time()
+            self._save_index()
+            return self._entry_path(key)
+
+    def store(self, session, hostname, calc_id, output_type, params,
+              filepath):
+        """
+        Move the given .npz file into the cache, evicting the least recently
+        used entries if needed.
+
+        :returns: the path of the cached file, or None if the extraction
+            could not be cached (in which case the file is left untouched)
+        """
+        if not self.enabled:
+            return None
+        size = os.path.getsize(filepath)
+        if size > self.max_size:
+            return None
+        try:
+            fingerprint = self.get_calc_fingerprint(
+                session, hostname, calc_id)
+        except Exception:
+            return None
+        if fingerprint is None:
+            return None
+        key = self.make_key(hostname, calc_id, output_type, params)
+        with self._lock:
+            index = self._load_index()
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._remove_entry(key)
+            shutil.move(filepath, self._entry_path(key))
+            index[key] = dict(
+                hostname=hostname.rstrip('/'), calc_id=int(calc_id),
+                output_type=output_type, params=params or {}, size=size,
+                fingerprint=fingerprint, last_access=time())
+            self._evict(self.max_size)
+            self._save_index()
+            return self._entry_path(key)
+
+    def discard(self, hostname, calc_id, output_type, params=None):
+        """
+        Remove a single entry (e.g. because its file turned out to be
+        corrupted)
+        """
+        key = self.make_key(hostname, calc_id, output_type, params)
+        with self._lock:
+            self._load_index()
+            self._remove_entry(key)
+            self._save_index()
+
+    def _evict(self, max_size):
+        index = self._index
+        tot_size = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_access']):
+            if tot_size <= max_size:
+                break
+            tot_size -= self._remove_entry(key)['size']
+
+    def _purge_calc(self, hostname, calc_id):
+        hostname = hostname.rstrip('/')
+        for key, entry in list(self._index.items()):
+            if (entry['hostname'] == hostname
+                    and entry['calc_id'] == int(calc_id)):
+                self._remove_entry(key)
+
+    def entries(self):
+        """
+        Return the list of cached entries, most recently used first
+        """
+        with self._lock:
+            index = self._load_index()
+            return sorted(
+                (dict(entry, key=key) for key, entry in index.items()),
+                key=lambda entry: entry['last_access'], reverse=True)
+
+    def total_size(self):
+        with self._lock:
+            return sum(entry['size']
+                       for entry in self._load_index().values())
+
+    def purge(self, hostname=None, calc_id=None):
+        """
+        Remove the entries of the given calculation, or all entries if no
+        calculation is specified
+        """
+        with self._lock:
+            self._load_index()
+            if calc_id is not None:
+                self._purge_calc(hostname, calc_id)
+            else:
+                for key in list(self._index):
+                    self._remove_entry(key)
+                self._checked_calcs.clear()
+                if os.path.isdir(self.cache_dir):
+                    for filename in os.listdir(self.cache_dir):
+                        if filename.endswith('.npz'):
+                            try:
+                                os.remove(
+                                    os.path.join(self.cache_dir, filename))
+                            except OSError:
+                                pass
+            self._save_index()
+
+    def shrink(self):
+        """
+        Evict the least recently used entries until the total size fits the
+        current limit
+        """
+        with self._lock:
+            self._load_index()
+            self._evict(self.max_size)
+            self._save_index()
+
+
+_EXTRACT_CACHE = None
+
+
+def get_extract_cache():
+    """
+    Return the extract cache shared by all the components of the plugin
+    """
+    global _EXTRACT_CACHE
+    if _EXTRACT_CACHE is None:
+        _EXTRACT_CACHE = ExtractCache(os.path.join(
+            QgsApplication.qgisSettingsDirPath(), 'irmt', 'extract_cache'))
+    return _EXTRACT_CACHE
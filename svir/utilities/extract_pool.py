@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-08-05
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from svir.utilities.utils import extract_npz, log_msg, WaitCursorManager
+
+# maximum number of extracts that are downloaded at the same time
+MAX_CONCURRENT_EXTRACTS = 4
+
+_EXTRACT_EXECUTOR = None
+
+
+def get_extract_executor():
+    """
+    Return the thread pool shared by all the components of the plugin to
+    download extracts concurrently
+    """
+    global _EXTRACT_EXECUTOR
+    if _EXTRACT_EXECUTOR is None:
+        _EXTRACT_EXECUTOR = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_EXTRACTS,
+            thread_name_prefix='irmt_extract')
+    return _EXTRACT_EXECUTOR
+
+
+class ExtractPool(QObject):
+    """
+    Extracts of a calculation, downloaded concurrently in background threads.
+    Each extract (with its parameters) is requested at most once, so the
+    extracts that do not depend on each other can be requested in advance
+    and collected when they are needed. The pool must be created in the main
+    thread, where callbacks are called.
+
+    :param session: the session with the OpenQuake Engine server
+    :param hostname: the url of the server
+    :param calc_id: the id of the calculation
+    :param message_bar: errors are displayed here when results are collected
+        (widgets can not be used from the worker threads)
+    """
+
+    # NOTE: emitted from the worker threads, so the connected slot runs in
+    #       the main thread
+    extract_done = pyqtSignal(object)
+
+    def __init__(self, session, hostname, calc_id, message_bar=None):
+        super().__init__()
+        self.extract_done.connect(self._on_extract_done)
+        self.session = session
+        self.hostname = hostname
+        self.calc_id = calc_id
+        self.message_bar = message_bar
+        self._futures = {}
+
+    @staticmethod
+    def _key(output_type, params):
+        return output_type, json.dumps(params, sort_keys=True, default=str)
+
+    def fetch(self, output_type, params=None, callback=None):
+        """
+        Start extracting the given output, unless it was already requested
+
+        :param callback: an optional callable without arguments, called in
+            the main thread when the extraction is over (immediately, if it
+            is over already)
+        :returns: a concurrent.futures.Future, whose result is the extracted
+            npz (or None if the extraction failed)
+        """
+        key = self._key(output_type, params)
+        if key not in self._futures:
+            self._futures[key] = get_extract_executor().submit(
+                extract_npz, self.session, self.hostname, self.calc_id,
+                output_type, message_bar=None, params=params)
+        future = self._futures[key]
+        if callback is not None:
+            if future.done():
+                callback()
+            else:
+                future.add_done_callback(
+                    lambda _: self.extract_done.emit(callback))
+        return future
+
+    def _on_extract_done(self, callback):
+        callback()
+
+    def is_done(self, output_type, params=None):
+        """
+        Tell if the given output was already extracted, so that its result
+        can be collected without waiting
+        """
+        future = self._futures.get(self._key(output_type, params))
+        return future is not None and future.done()
+
+    def cancel(self, output_type, params=None):
+        """
+        Cancel the extraction of the given output, if it did not start yet.
+        Extractions that are already running are completed, and their results
+        are kept for later use.
+
+        :returns: True if the extraction was canceled
+        """
+        key = self._key(output_type, params)
+        future = self._futures.get(key)
+        if future is None or not future.cancel():
+            return False
+        del self._futures[key]
+        return True
+
+    def prefetch(self, output_types):
+        """
+        Start extracting all the given outputs (without parameters) at once
+        """
+        return [self.fetch(output_type) for output_type in output_types]
+
+    def collect(self, requests, callback):
+        """
+        Call back with the results of the given extracts, in the main thread,
+        as soon as all of them are available (requesting them if needed),
+        without blocking while they are downloaded
+
+        :param requests: list of output types, or of (output_type, params)
+        :param callback: callable taking the list of the extracted npz (None
+            for the extractions that failed), in the same order as requests
+        """
+        requests = [(request, None) if isinstance(request, str) else request
+                    for request in requests]
+        futures = [self.fetch(output_type, params)
+                   for output_type, params in requests]
+        called = []
+
+        def on_done():
+            if called or not all(future.done() for future in futures):
+                return
+            called.append(True)
+            results = []
+            for (output_type, params), future in zip(requests, futures):
+                try:
+                    results.append(self._take(output_type, params, future))
+                except Exception as exc:
+                    log_msg('Unable to extract %s' % output_type, level='C',
+                            message_bar=self.message_bar, exception=exc)
+                    results.append(None)
+            callback(results)
+
+        for (output_type, params), future in zip(requests, futures):
+            self.fetch(output_type, params, callback=on_done)
+
+    def result(self, output_type, params=None):
+        """
+        Wait for the given output to be extracted (requesting it if needed).
+        In the GUI, use collect instead, unless the output is already
+        extracted (see is_done).
+
+        :returns: the extracted npz, or None if the extraction failed
+        """
+        future = self.fetch(output_type, params)
+        if not future.done():
+            with WaitCursorManager(
+                    'Extracting...', message_bar=self.message_bar):
+                wait([future])
+        return self._take(output_type, params, future)
+
+    def _take(self, output_type, params, future):
+        # NOTE: the future is done
+        try:
+            extracted = future.result()
+        except Exception:
+            # failed extractions are requested again the next time
+            self._forget(output_type, params, future)
+            raise
+        if extracted is None:
+            self._forget(output_type, params, future)
+            # NOTE: the reason was logged by the worker thread
+            log_msg('Unable to extract %s with parameters %s (see the log'
+                    ' for details)' % (output_type, params), level='C',
+                    message_bar=self.message_bar)
+        return extracted
+
+    def _forget(self, output_type, params, future):
+        key = self._key(output_type, params)
+        if self._futures.get(key) is future:
+            del self._futures[key]
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-29
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+# maximum number of points stored in each leaf of the tree
+KD_TREE_LEAF_SIZE = 32
+# maximum number of points sampled on a segment of a polyline
+MAX_POINTS_PER_SEGMENT = 10000
+
+
+class KDTree(object):
+    """
+    Minimal 2D k-d tree, answering nearest neighbour queries in logarithmic
+    time (scipy is not necessarily available in QGIS)
+
+    :param points: array-like of shape (n, 2)
+    """
+
+    def __init__(self, points, leaf_size=KD_TREE_LEAF_SIZE):
+        self.points = numpy.asarray(points, dtype=numpy.float64).reshape(
+            -1, 2)
+        self.leaf_size = leaf_size
+        # indices of the points, reordered so that each node of the tree
+        # corresponds to a contiguous slice
+        self.idxs = numpy.arange(len(self.points))
+        self.root = self._build(0, len(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, start, stop):
+        # NOTE: leaves are (start, stop) and the other nodes are
+        #       (axis, split_value, left_child, right_child)
+        if stop - start <= self.leaf_size:
+            return (start, stop)
+        idxs = self.idxs[start:stop]
+        coords = self.points[idxs]
+        # split along the axis with the largest spread
+        axis = int(numpy.argmax(coords.max(axis=0) - coords.min(axis=0)))
+        mid = (stop - start) // 2
+        order = numpy.argpartition(coords[:, axis], mid)
+        self.idxs[start:stop] = idxs[order]
+        split_value = self.points[self.idxs[start + mid], axis]
+        return (axis, split_value,
+                self._build(start, start + mid),
+                self._build(start + mid, stop))
+
+    def query(self, point, max_distance=numpy.inf):
+        """
+        Find the point closest to the given one
+
+        :param point: (x, y)
+        :param max_distance: points farther than this are ignored
+        :returns: (index of the closest point, distance), or (None, inf) if
+            no point is within max_distance
+        """
+        point = numpy.asarray(point, dtype=numpy.float64)
+        best = [None, max_distance]
+        if len(self.points):
+            self._query(self.root, point, best)
+        if best[0] is None:
+            return None, numpy.inf
+        return best[0], best[1]
+
+    def _query(self, node, point, best):
+        if len(node) == 2:
+            start, stop = node
+            idxs = self.idxs[start:stop]
+            distances = numpy.hypot(*(self.points[idxs] - point).T)
+            closest = int(numpy.argmin(distances))
+            if distances[closest] <= best[1]:
+                best[0] = int(idxs[closest])
+                best[1] = float(distances[closest])
+            return
+        axis, split_value, left, right = node
+        diff = point[axis] - split_value
+        near, far = (left, right) if diff < 0 else (right, left)
+        self._query(near, point, best)
+        if abs(diff) <= best[1]:
+            self._query(far, point, best)
+
+
+def densify_polyline(vertices, spacing, bounds=None,
+                     max_points_per_segment=MAX_POINTS_PER_SEGMENT):
+    """
+    Sample a polyline so that consecutive points are at most spacing apart,
+    in order to find the segments close to a point by querying a KDTree
+
+    :param vertices: array-like of shape (n, 2)
+    :param spacing: maximum distance between consecutive points
+    :param bounds: optional (xmin, ymin, xmax, ymax). Segments lying
+        completely on one side of them are not sampled (only their vertices
+        are kept)
+    :param max_points_per_segment: limit to the number of points sampled on
+        each segment
+    :returns: array of shape (m, 2), including the vertices
+    """
+    vertices = numpy.asarray(vertices, dtype=numpy.float64).reshape(-1, 2)
+    if len(vertices) < 2:
+        return vertices
+    starts = vertices[:-1]
+    deltas = numpy.diff(vertices, axis=0)
+    lengths = numpy.hypot(deltas[:, 0], deltas[:, 1])
+    num_points = numpy.clip(numpy.ceil(lengths / spacing), 1,
+                            max_points_per_segment).astype(int)
+    if bounds is not None:
+        xmin, ymin, xmax, ymax = bounds
+        ends = vertices[1:]
+        outside = (
+            ((starts[:, 0] < xmin) & (ends[:, 0] < xmin))
+            | ((starts[:, 0] > xmax) & (ends[:, 0] > xmax))
+            | ((starts[:, 1] < ymin) & (ends[:, 1] < ymin))
+            | ((starts[:, 1] > ymax) & (ends[:, 1] > ymax)))
+        num_points[outside] = 1
+    segment_idxs = numpy.repeat(numpy.arange(len(starts)), num_points)
+    # position of each point along its segment, from 0 (included) to 1
+    offsets = numpy.repeat(numpy.cumsum(num_points) - num_points, num_points)
+    fractions = ((numpy.arange(len(segment_idxs)) - offsets)
+                 / numpy.repeat(num_points, num_points))
+    points = (starts[segment_idxs]
+              + deltas[segment_idxs] * fractions[:, None])
+    return numpy.concatenate((points, vertices[-1:]))
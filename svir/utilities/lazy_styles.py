@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-07-15
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Styles of a layer that are registered in its style manager as placeholders,
+and whose renderers are built only the first time they become current.
+"""
+
+import json
+from collections import OrderedDict
+
+from qgis.core import QgsMapLayerStyle
+from qgis.PyQt.QtCore import QObject
+
+from svir.utilities.utils import log_msg
+
+# maximum number of lazy styles of a layer whose renderers are kept at the
+# same time. The least recently used ones are turned back into placeholders.
+MAX_MATERIALIZED_STYLES = 20
+
+LAZY_STYLES_PROPERTY = 'irmt/lazy_styles'
+
+
+class LazyLayerStyles(QObject):
+    """
+    Keep track of the lazy styles of a layer. The object is owned by the
+    layer, so it lives as long as the layer does.
+
+    :param layer: the layer to be styled
+    :param style_names: names of the styles to be added to the style manager
+        of the layer (if they are not there already)
+    :param style_function: callable taking the layer and the name of the
+        current style, that sets the renderer of the layer
+    :param placeholder: the QgsMapLayerStyle assigned to styles not built yet
+        (by default, the current style of the layer)
+    :param pending_names: names of the styles that are still placeholders
+        (by default, all of them)
+    """
+
+    def __init__(self, layer, style_names, style_function, placeholder=None,
+                 pending_names=None,
+                 max_materialized=MAX_MATERIALIZED_STYLES):
+        super().__init__(layer)
+        self.layer = layer
+        self.style_names = list(style_names)
+        self.style_function = style_function
+        self.max_materialized = max_materialized
+        if placeholder is None:
+            placeholder = QgsMapLayerStyle()
+            placeholder.readFromLayer(layer)
+        self.placeholder = placeholder
+        if pending_names is None:
+            pending_names = self.style_names
+        self.pending = set(pending_names)
+        # names of the built styles, least recently used first
+        self.materialized = OrderedDict(
+            (name, None) for name in self.style_names
+            if name not in self.pending)
+        style_manager = layer.styleManager()
+        existing_names = style_manager.styles()
+        for name in self.style_names:
+            if name not in existing_names:
+                style_manager.addStyle(name, self.placeholder)
+        style_manager.currentStyleChanged.connect(
+            self.on_current_style_changed)
+        self.evict()
+        self.save_state()
+
+    def on_current_style_changed(self, style_name):
+        if style_name not in self.style_names:
+            return
+        if style_name in self.pending:
+            try:
+                self.style_function(self.layer, style_name)
+            except Exception as exc:
+                log_msg('Unable to build style %s of layer %s' % (
+                    style_name, self.layer.name()), level='C',
+                    exception=exc)
+                return
+            self.pending.discard(style_name)
+        self.materialized[style_name] = None
+        self.materialized.move_to_end(style_name)
+        self.evict()
+        self.save_state()
+
+    def evict(self):
+        """
+        Turn the least recently used styles back into placeholders, keeping
+        at most max_materialized styles built
+        """
+        style_manager = self.layer.styleManager()
+        current_style = style_manager.currentStyle()
+        for style_name in list(self.materialized):
+            if len(self.materialized) <= self.max_materialized:
+                break
+            if style_name == current_style:
+                continue
+            style_manager.removeStyle(style_name)
+            style_manager.addStyle(style_name, self.placeholder)
+            del self.materialized[style_name]
+            self.pending.add(style_name)
+
+    def save_state(self):
+        # NOTE: the state is saved with the project, so placeholders can be
+        #       built also after the project is reopened
+        self.layer.setCustomProperty(LAZY_STYLES_PROPERTY, json.dumps(dict(
+            styles=self.style_names,
+            pending=[name for name in self.style_names
+                     if name in self.pending])))
+
+
+def add_lazy_styles(layer, style_names, style_function, current_style=None):
+    """
+    Register the given styles of the layer as placeholders, that are built
+    calling style_function the first time each of them becomes current
+
+    :param current_style: name of the style to be made current (and built)
+    :returns: the LazyLayerStyles object handling the styles
+    """
+    lazy_styles = LazyLayerStyles(layer, style_names, style_function)
+    if current_style is not None:
+        layer.styleManager().setCurrentStyle(current_style)
+    return lazy_styles
+
+
+def restore_lazy_styles(layer, style_function):
+    """
+    Resume handling the lazy styles of a layer loaded from a project, if any
+
+    :returns: the LazyLayerStyles object handling the styles, or None
+    """
+    state = layer.customProperty(LAZY_STYLES_PROPERTY)
+    if not state:
+        return None
+    if layer.findChild(LazyLayerStyles) is not None:
+        # already handled (e.g. the layer was just created)
+        return None
+    try:
+        state = json.loads(state)
+    except ValueError:
+        return None
+    placeholder = None
+    style_manager = layer.styleManager()
+    for style_name in state['pending']:
+        if style_name != style_manager.currentStyle():
+            placeholder = style_manager.style(style_name)
+            break
+    return LazyLayerStyles(
+        layer, state['styles'], style_function, placeholder=placeholder,
+        pending_names=state['pending'])
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2024-06-24
+#        copyright            : (C) 2024 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Vector data provider serving features straight from the numpy arrays
+extracted from the OpenQuake Engine (possibly memory-mapped from the extract
+cache), instead of copying each value into the features of a memory layer.
+
+Layers using this provider are created by create_npz_layer and populated by
+set_npz_layer_columns. Their data lives only in memory, like the data of
+memory layers, so they are not restored when a project is reopened.
+"""
+
+import uuid
+import threading
+import weakref
+import numpy
+
+from qgis.core import (
+    QgsAbstractFeatureIterator,
+    QgsAbstractFeatureSource,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsDataProvider,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsFeatureIterator,
+    QgsFeatureRequest,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPoint,
+    QgsProviderMetadata,
+    QgsProviderRegistry,
+    QgsRectangle,
+    QgsVectorDataProvider,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+NPZ_PROVIDER_KEY = 'irmt_npz'
+
+# number of rows whose attributes are converted to python objects at once
+# while iterating over features
+FETCH_CHUNK_SIZE = 1000
+
+# tables are kept alive by the providers using them
+_TABLES = weakref.WeakValueDictionary()
+_TABLES_LOCK = threading.Lock()
+
+
+class NpzTable(object):
+    """
+    Columns of the features of a layer served by NpzProvider. Each column is
+    a numpy array (or None if all its values are NULL). Features have ids
+    starting from 1, like the features of memory layers.
+
+    :param geometry_type: 'point' or 'none'
+    :param crs: the authid of the coordinate reference system
+    """
+
+    def __init__(self, geometry_type='point', crs='EPSG:4326'):
+        self.table_id = uuid.uuid4().hex
+        if geometry_type.lower() == 'point':
+            self.wkb_type = QgsWkbTypes.Point
+        else:
+            self.wkb_type = QgsWkbTypes.NoGeometry
+        self.crs = QgsCoordinateReferenceSystem(crs)
+        self.fields = QgsFields()
+        self.columns = []
+        self.lons = numpy.empty(0)
+        self.lats = numpy.empty(0)
+        self.num_features = 0
+        # incremented whenever the data changes, to invalidate the extent
+        self.version = 0
+        self.lock = threading.RLock()
+
+    @property
+    def uri(self):
+        return 'table=%s' % self.table_id
+
+    def add_fields(self, fields):
+        with self.lock:
+            for field in fields:
+                if self.fields.indexFromName(field.name()) != -1:
+                    return False
+            for field in fields:
+                self.fields.append(QgsField(field))
+                self.columns.append(None)
+            self.version += 1
+            return True
+
+    def set_columns(self, columns, lons=None, lats=None):
+        """
+        Replace the data of the table
+
+        :param columns: dict {field_name: values}, where values are numpy
+            arrays or lists containing one item per feature. Fields
+            that are not listed are NULL.
+        :param lons: longitudes of point features
+        :param lats: latitudes of point features
+        """
+        num_features = None
+        table_columns = [None] * self.fields.count()
+        for field_name, values in columns.items():
+            field_idx = self.fields.indexFromName(field_name)
+            if field_idx == -1:
+                raise KeyError('Field %s not found' % field_name)
+            column = to_column(values)
+            table_columns[field_idx] = column
+            num_features = len(column)
+        if lons is not None:
+            lons = numpy.asarray(lons, dtype=numpy.float64)
+            lats = numpy.asarray(lats, dtype=numpy.float64)
+            num_features = len(lons)
+        if num_features is None:
+            num_features = 0
+        for column in table_columns:
+            if column is not None and len(column) != num_features:
+                raise ValueError('All columns must have the same length')
+        with self.lock:
+            self.columns = table_columns
+            if lons is None:
+                self.lons = numpy.full(num_features, numpy.nan)
+                self.lats = numpy.full(num_features, numpy.nan)
+            else:
+                self.lons, self.lats = lons, lats
+            self.num_features = num_features
+            self.version += 1
+
+    def change_values(self, attr_map):
+        """
+        :param attr_map: dict {fid: {field_idx: value}}
+        """
+        with self.lock:
+            for fid, attrs in attr_map.items():
+                row = fid - 1
+                if not 0 <= row < self.num_features:
+                    return False
+                for field_idx, value in attrs.items():
+                    column = self.columns[field_idx]
+                    if column is None or column.dtype.kind != 'O':
+                        # NOTE: the original arrays might be read-only (e.g.
+                        #       memory-mapped), so the column is copied the
+                        #       first time it is modified
+                        column = numpy.array(
+                            [None] * self.num_features if column is None
+                            else column.tolist(), dtype=object)
+                        self.columns[field_idx] = column
+                    column[row] = None if value is None or (
+                        hasattr(value, 'isNull') and value.isNull()) \
+                        else value
+            self.version += 1
+            return True
+
+    def snapshot(self):
+        """
+        Return a consistent copy of the references to the data, that can be
+        used from any thread while the table is modified
+        """
+        with self.lock:
+            return (QgsFields(self.fields), list(self.columns), self.lons,
+                    self.lats, self.num_features)
+
+
+def to_column(values):
+    """
+    Convert a column of values to a numpy array holding python-friendly
+    values (bytes are decoded as utf8 strings)
+    """
+    if not isinstance(values, numpy.ndarray):
+        values = [value.decode('utf8') if isinstance(value, bytes)
+                  else value for value in values]
+        return numpy.array(values, dtype=object)
+    if values.dtype.kind == 'S':
+        return numpy.char.decode(values, 'utf8')
+    if values.dtype.kind == 'O':
+        return to_column(values.tolist())
+    return values
+
+
+def get_table(uri):
+    params = dict(param.split('=', 1)
+                  for param in uri.split('&') if '=' in param)
+    with _TABLES_LOCK:
+        return _TABLES.get(params.get('table'))
+
+
+class NpzFeatureSource(QgsAbstractFeatureSource):
+
+    def __init__(self, provider):
+        super().__init__()
+        self.crs = provider.crs()
+        self.has_geometry = provider.wkbType() != QgsWkbTypes.NoGeometry
+        (self.fields, self.columns, self.lons, self.lats,
+         self.num_features) = provider.table.snapshot()
+        self.subset_string = provider.subsetString()
+
+    def getFeatures(self, request=QgsFeatureRequest()):
+        return QgsFeatureIterator(NpzFeatureIterator(self, request))
+
+
+class NpzFeatureIterator(QgsAbstractFeatureIterator):
+
+    def __init__(self, source, request):
+        super().__init__(request)
+        self._source = source
+        self._request = request
+        self._transform = QgsCoordinateTransform()
+        if (request.destinationCrs().isValid()
+                and request.destinationCrs() != source.crs):
+            self._transform = QgsCoordinateTransform(
+                source.crs, request.destinationCrs(),
+                request.transformContext())
+        try:
+            self._rows = self._select_rows()
+        except QgsCsException:
+            self._rows = numpy.empty(0, dtype=numpy.int64)
+        if request.flags() & QgsFeatureRequest.SubsetOfAttributes:
+            self._attr_idxs = [
+                idx for idx in request.subsetOfAttributes()
+                if 0 <= idx < source.fields.count()]
+        else:
+            self._attr_idxs = list(range(source.fields.count()))
+        self._fetch_geometry = (
+            source.has_geometry
+            and not request.flags() & QgsFeatureRequest.NoGeometry)
+        self._expression = None
+        if source.subset_string:
+            self._expression = QgsExpression(source.subset_string)
+            self._context = QgsExpressionContext()
+            self._context.appendScope(
+                QgsExpressionContextUtils.globalScope())
+            self._context.setFields(source.fields)
+            self._expression.prepare(self._context)
+            # the subset can refer to any field
+            self._attr_idxs = list(range(source.fields.count()))
+        self._pos = 0
+        self._chunk_start = None
+        self._chunk = None
+
+    def _select_rows(self):
+        source = self._source
+        request = self._request
+        if request.filterType() == QgsFeatureRequest.FilterFid:
+            rows = numpy.array([request.filterFid() - 1], dtype=numpy.int64)
+        elif request.filterType() == QgsFeatureRequest.FilterFids:
+            rows = numpy.array(
+                sorted(request.filterFids()), dtype=numpy.int64) - 1
+        else:
+            rows = numpy.arange(source.num_features, dtype=numpy.int64)
+        rows = rows[(rows >= 0) & (rows < source.num_features)]
+        filter_rect = self.filterRectToSourceCrs(self._transform)
+        if not filter_rect.isNull() and source.has_geometry:
+            lons = source.lons[rows]
+            lats = source.lats[rows]
+            rows = rows[(lons >= filter_rect.xMinimum())
+                        & (lons <= filter_rect.xMaximum())
+                        & (lats >= filter_rect.yMinimum())
+                        & (lats <= filter_rect.yMaximum())]
+        return rows
+
+    def _load_chunk(self):
+        source = self._source
+        self._chunk_start = self._pos - self._pos % FETCH_CHUNK_SIZE
+        rows = self._rows[
+            self._chunk_start:self._chunk_start + FETCH_CHUNK_SIZE]
+        self._chunk = {}
+        for attr_idx in self._attr_idxs:
+            column = source.columns[attr_idx]
+            if column is None:
+                self._chunk[attr_idx] = [None] * len(rows)
+            else:
+                self._chunk[attr_idx] = column[rows].tolist()
+
+    def fetchFeature(self, f):
+        source = self._source
+        while self._pos < len(self._rows):
+            if (self._chunk_start is None
+                    or self._pos >= self._chunk_start + FETCH_CHUNK_SIZE):
+                self._load_chunk()
+            row = int(self._rows[self._pos])
+            chunk_idx = self._pos - self._chunk_start
+            self._pos += 1
+            f.setFields(source.fields, True)
+            f.setId(row + 1)
+            f.setValid(True)
+            for attr_idx in self._attr_idxs:
+                value = self._chunk[attr_idx][chunk_idx]
+                if value is not None:
+                    f.setAttribute(attr_idx, value)
+            if self._fetch_geometry:
+                geometry = QgsGeometry(QgsPoint(
+                    float(source.lons[row]), float(source.lats[row])))
+                if self._transform.isValid():
+                    try:
+                        geometry.transform(self._transform)
+                    except QgsCsException:
+                        continue
+                f.setGeometry(geometry)
+            else:
+                f.clearGeometry()
+            if self._expression is not None:
+                self._context.setFeature(f)
+                if not self._expression.evaluate(self._context):
+                    continue
+            return True
+        return False
+
+    def __iter__(self):
+        self._pos = 0
+        return self
+
+    def __next__(self):
+        f = QgsFeature()
+        if not self.nextFeature(f):
+            raise StopIteration
+        return f
+
+    def rewind(self):
+        self._pos = 0
+        return True
+
+    def close(self):
+        self._pos = len(self._rows)
+        return True
+
+
+class NpzProvider(QgsVectorDataProvider):
+    """
+    Read-only (except for adding and changing attributes) data provider,
+    serving the features of an NpzTable
+    """
+
+    @classmethod
+    def providerKey(cls):
+        return NPZ_PROVIDER_KEY
+
+    @classmethod
+    def description(cls):
+        return 'OpenQuake Engine outputs'
+
+    @classmethod
+    def createProvider(cls, uri, providerOptions,
+                       flags=QgsDataProvider.ReadFlags()):
+        return NpzProvider(uri, providerOptions, flags)
+
+    def __init__(self, uri='',
+                 providerOptions=QgsDataProvider.ProviderOptions(),
+                 flags=QgsDataProvider.ReadFlags()):
+        super().__init__(uri, providerOptions, flags)
+        self._uri = uri
+        self.table = get_table(uri)
+        self._subset_string = ''
+        self._extent = None
+        self._extent_version = None
+        # number of features matching the subset string
+        self._filtered_count = None
+        self._filtered_count_version = None
+
+    def isValid(self):
+        return self.table is not None
+
+    def name(self):
+        return self.providerKey()
+
+    def storageType(self):
+        return 'NumPy arrays'
+
+    def dataSourceUri(self, expandAuthConfig=True):
+        return self._uri
+
+    def featureSource(self):
+        return NpzFeatureSource(self)
+
+    def getFeatures(self, request=QgsFeatureRequest()):
+        return QgsFeatureIterator(
+            NpzFeatureIterator(NpzFeatureSource(self), request))
+
+    def capabilities(self):
+        return (QgsVectorDataProvider.AddAttributes
+                | QgsVectorDataProvider.ChangeAttributeValues
+                | QgsVectorDataProvider.SelectAtId)
+
+    def wkbType(self):
+        return self.table.wkb_type
+
+    def crs(self):
+        return self.table.crs
+
+    def fields(self):
+        return QgsFields(self.table.fields)
+
+    def featureCount(self):
+        if not self._subset_string:
+            return self.table.num_features
+        if (self._filtered_count is None
+                or self._filtered_count_version != self.table.version):
+            version = self.table.version
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            self._filtered_count = sum(1 for _ in self.getFeatures(request))
+            self._filtered_count_version = version
+        return self._filtered_count
+
+    def extent(self):
+        if self._extent_version != self.table.version:
+            self.updateExtents()
+        return self._extent
+
+    def updateExtents(self):
+        fields, columns, lons, lats, num_features = self.table.snapshot()
+        valid = ~(numpy.isnan(lons) | numpy.isnan(lats))
+        if (self.table.wkb_type == QgsWkbTypes.NoGeometry
+                or not valid.any()):
+            self._extent = QgsRectangle()
+        else:
+            self._extent = QgsRectangle(
+                float(lons[valid].min()), float(lats[valid].min()),
+                float(lons[valid].max()), float(lats[valid].max()))
+        self._extent_version = self.table.version
+
+    def supportsSubsetString(self):
+        return True
+
+    def subsetString(self):
+        return self._subset_string
+
+    def setSubsetString(self, subset, updateFeatureCount=True):
+        if subset:
+            expression = QgsExpression(subset)
+            if expression.hasParserError():
+                return False
+        self._subset_string = subset or ''
+        self._filtered_count = None
+        self.clearMinMaxCache()
+        return True
+
+    def _numeric_column(self, field_idx):
+        if self._subset_string or not 0 <= field_idx < len(self.table.columns):
+            return None
+        column = self.table.columns[field_idx]
+        if column is None or column.dtype.kind not in 'biuf':
+            return None
+        return column
+
+    def minimumValue(self, fieldIndex):
+        column = self._numeric_column(fieldIndex)
+        if column is None:
+            return super().minimumValue(fieldIndex)
+        if column.dtype.kind == 'f':
+            return float(numpy.nanmin(column)) if len(column) else None
+        return column.min().item() if len(column) else None
+
+    def maximumValue(self, fieldIndex):
+        column = self._numeric_column(fieldIndex)
+        if column is None:
+            return super().maximumValue(fieldIndex)
+        if column.dtype.kind == 'f':
+            return float(numpy.nanmax(column)) if len(column) else None
+        return column.max().item() if len(column) else None
+
+    def uniqueValues(self, fieldIndex, limit=-1):
+        column = self._numeric_column(fieldIndex)
+        if column is None:
+            return super().uniqueValues(fieldIndex, limit)
+        values = numpy.unique(column).tolist()
+        if limit >= 0:
+            values = values[:limit]
+        return set(values)
+
+    def addAttributes(self, attributes):
+        added = self.table.add_fields(attributes)
+        if added:
+            self.clearMinMaxCache()
+        return added
+
+    def changeAttributeValues(self, attr_map):
+        changed = self.table.change_values(attr_map)
+        if changed:
+            self._filtered_count = None
+            self.clearMinMaxCache()
+        return changed
+
+
+def register_npz_provider():
+    """
+    Register the provider, unless it was already registered (e.g. before
+    reloading the plugin)
+    """
+    registry = QgsProviderRegistry.instance()
+    if registry.providerMetadata(NPZ_PROVIDER_KEY) is not None:
+        return True
+    metadata = QgsProviderMetadata(
+        NpzProvider.providerKey(), NpzProvider.description(),
+        NpzProvider.createProvider)
+    return registry.registerProvider(metadata)
+
+
+def is_npz_provider_registered():
+    return (QgsProviderRegistry.instance().providerMetadata(NPZ_PROVIDER_KEY)
+            is not None)
+
+
+def create_npz_layer(layer_name, geometry_type='point', crs='EPSG:4326'):
+    """
+    Create an empty layer using the NPZ provider. Fields can be added as for
+    any other layer, then data can be set through set_npz_layer_columns.
+    """
+    table = NpzTable(geometry_type, crs)
+    with _TABLES_LOCK:
+        _TABLES[table.table_id] = table
+    layer = QgsVectorLayer(table.uri, layer_name, NPZ_PROVIDER_KEY)
+    # NOTE: the table is kept alive by the provider
+    return layer
+
+
+def set_npz_layer_columns(layer, columns, lons=None, lats=None):
+    """
+    Set the data of a layer created by create_npz_layer, without copying the
+    given arrays
+
+    :returns: True on success
+    """
+    table = get_table(layer.source())
+    if table is None:
+        return False
+    table.set_columns(columns, lons, lats)
+    layer.updateExtents()
+    return True
@@ -186,6 +186,11 @@ DEFAULT_SETTINGS = dict(
     experimental_enabled=False,
     developer_mode=False,
     log_level='C',
+    extract_cache_enabled=True,
+    extract_cache_max_size_mb=2048,
+    save_outputs_to_gpkg=False,
+    max_plotted_curves=500,
+    local_tag_aggregation=False,
 )
 
 DEFAULT_ENGINE_PROFILES = (
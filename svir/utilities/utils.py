@@ -31,6 +31,11 @@ import traceback
 import locale
 import zlib
 import io
+import struct
+import weakref
+import zipfile
+import tempfile
+from collections.abc import MutableMapping
 from datetime import datetime
 from pygments import highlight
 from pygments.lexers import PythonLexer
@@ -38,6 +43,7 @@ from pygments.formatters import HtmlFormatter
 from copy import deepcopy
 from time import time
 from pprint import pformat
+from numpy.lib.npyio import NpzFile
 from qgis.core import (
                        QgsProject,
                        QgsMessageLog,
@@ -52,7 +58,8 @@ from qgis.gui import QgsMessageBar, QgsMessageBarItem
 from qgis.utils import iface
 
 from qgis.PyQt import uic
-from qgis.PyQt.QtCore import Qt, QSettings, QUrl, QUrlQuery
+from qgis.PyQt.QtCore import (
+    Qt, QSettings, QUrl, QUrlQuery, QThread, QCoreApplication)
 from qgis.PyQt.QtWidgets import (
                                  QApplication,
                                  QProgressBar,
@@ -70,6 +77,7 @@ from svir.utilities.shared import (
                                    DEFAULT_SETTINGS,
                                    DEFAULT_ENGINE_PROFILES,
                                    )
+from svir.utilities.extract_cache import get_extract_cache
 
 F32 = numpy.float32
 
@@ -126,6 +134,13 @@ def log_msg(message, tag='GEM OpenQuake IRMT plugin', level='I',
               }
     if level not in levels:
         raise ValueError('Level must be one of %s' % levels.keys())
+    if (message_bar is not None and QCoreApplication.instance() is not None
+            and QThread.currentThread()
+            != QCoreApplication.instance().thread()):
+        # NOTE: widgets can be used only from the main thread (e.g. layers
+        #       can be populated by background tasks), so in other threads
+        #       messages are only written to the log
+        message_bar = None
     tb_text = ''
     if exception is not None:
         tb_lines = traceback.format_exception(
@@ -142,7 +157,7 @@ def log_msg(message, tag='GEM OpenQuake IRMT plugin', level='I',
                 or level in ('I', 'S') and log_verbosity in ('I', 'S')):
             QgsMessageLog.logMessage(
                 tr(message) + tb_text, tr(tag), levels[level])
-            if exception is not None:
+            if exception is not None and message_bar is not None:
                 tb_btn = QToolButton(message_bar)
                 tb_btn.setText('Show Traceback')
                 tb_btn.clicked.connect(
@@ -510,7 +525,6 @@ def _login(login_url, username, password, session):
                                         "username": username,
                                         "password": password
                                     },
-                                    timeout=10,
                                     )
     except Exception:
         msg = "Unable to login. %s" % traceback.format_exc()
@@ -1090,6 +1104,22 @@ def extract_npz(
     # NOTE: there is also an asynchronous extract_npz utility that contains
     # some duplicated code
     url = '%s/v1/calc/%s/extract/%s' % (hostname, calc_id, output_type)
+    cache = get_extract_cache()
+    cached_filepath = cache.lookup(
+        session, hostname, calc_id, output_type, params)
+    if cached_filepath is not None:
+        try:
+            extracted_npz = LazyNpz(cached_filepath)
+        except Exception as exc:
+            log_msg('Discarding the corrupted cached extract %s: %s' % (
+                        cached_filepath, exc),
+                    level='W', print_to_stderr=True)
+            cache.discard(hostname, calc_id, output_type, params)
+        else:
+            log_msg('Extract %s with parameters %s read from cache' % (
+                        url, params),
+                    level='I', print_to_stderr=True)
+            return extracted_npz
     log_msg('GET: %s, with parameters: %s' % (url, params), level='I',
             print_to_stderr=True)
     resp = session.get(url, params=params)
@@ -1115,9 +1145,163 @@ def extract_npz(
             dic.update(json.loads(bytes(v)))
         else:
             dic[k] = v
+    if cache.enabled:
+        fd, filepath = tempfile.mkstemp(suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(resp_content)
+        if cache.store(session, hostname, calc_id, output_type, params,
+                       filepath) is None:
+            os.remove(filepath)
     return dic
 
 
+def _npz_load_kwargs():
+    if numpy.__version__ >= '1.24.0':
+        return {'max_header_size': 100000}
+    return {}
+
+
+# NOTE: local file header of a zip member: signature, version, flags,
+# compression, mod time, mod date, crc32, sizes (2), name and extra lengths
+_ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+_NOT_LOADED = object()
+
+
+def _close_npz(npz, filepath_to_remove):
+    npz.close()
+    if filepath_to_remove is not None:
+        try:
+            os.remove(filepath_to_remove)
+        except OSError:
+            # NOTE: on Windows the file can not be removed while some of its
+            # members are still memory-mapped. It is in the temporary
+            # directory anyway, so we can leave it there.
+            pass
+
+
+class LazyNpz(MutableMapping):
+    """
+    Dictionary of the arrays contained in a .npz file on disk, that reads
+    each array only when it is accessed for the first time. Members that
+    are stored without compression are memory-mapped (copy-on-write), so
+    their data is paged in by the OS only when it is actually used.
+    As in extract_npz, the contents of the 'json' member are merged into
+    the dictionary.
+    It is not a dict subclass, so that every way of reading its values
+    (including dict(npz), {**npz}, items() and values()) goes through
+    __getitem__.
+
+    :param filepath: path of the .npz file
+    :param remove_on_close: if True, the file is deleted when the object is
+        closed or garbage-collected
+    """
+
+    def __init__(self, filepath, remove_on_close=False):
+        self._data = {}
+        self.filepath = filepath
+        npz = numpy.load(filepath, allow_pickle=False, **_npz_load_kwargs())
+        if not isinstance(npz, NpzFile):
+            raise ValueError('%s is not a valid NPZ file' % filepath)
+        self._npz = npz
+        self._finalizer = weakref.finalize(
+            self, _close_npz, npz, filepath if remove_on_close else None)
+        self._stored_offsets = self._get_stored_offsets(npz.zip)
+        for key in npz.files:
+            if key == 'json':
+                self._data.update(json.loads(bytes(npz[key])))
+            else:
+                self._data[key] = _NOT_LOADED
+
+    def _get_stored_offsets(self, zip_file):
+        # find where the data of uncompressed members starts in the file
+        offsets = {}
+        with open(self.filepath, 'rb') as f:
+            for info in zip_file.infolist():
+                if (info.compress_type != zipfile.ZIP_STORED
+                        or not info.filename.endswith('.npy')):
+                    continue
+                f.seek(info.header_offset)
+                header = f.read(_ZIP_LOCAL_HEADER.size)
+                if len(header) != _ZIP_LOCAL_HEADER.size:
+                    continue
+                fields = _ZIP_LOCAL_HEADER.unpack(header)
+                name_len, extra_len = fields[-2:]
+                offsets[info.filename[:-4]] = (
+                    info.header_offset + _ZIP_LOCAL_HEADER.size
+                    + name_len + extra_len)
+        return offsets
+
+    def _memmap(self, key):
+        with open(self.filepath, 'rb') as f:
+            f.seek(self._stored_offsets[key])
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                read_header = numpy.lib.format.read_array_header_1_0
+            else:
+                read_header = numpy.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(
+                f, **_npz_load_kwargs())
+            offset = f.tell()
+        if (dtype.hasobject or not shape
+                or not numpy.prod(shape, dtype=numpy.int64)):
+            # object arrays can not be mapped, and it makes no sense to map
+            # scalars or empty arrays
+            return None
+        return numpy.memmap(
+            self.filepath, dtype=dtype, mode='c', shape=shape,
+            order='F' if fortran_order else 'C', offset=offset)
+
+    def _load(self, key):
+        if key in self._stored_offsets:
+            try:
+                array = self._memmap(key)
+            except Exception as exc:
+                log_msg('Unable to memory-map %s from %s: %s' % (
+                            key, self.filepath, exc),
+                        level='W', print_to_stderr=True)
+                array = None
+            if array is not None:
+                return array
+        return self._npz[key]
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if value is _NOT_LOADED:
+            value = self._load(key)
+            self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # NOTE: without reading the array, unlike Mapping.__contains__
+        return key in self._data
+
+    def copy(self):
+        """
+        :returns: a dict with all the arrays (loading the missing ones)
+        """
+        return dict(self)
+
+    def close(self):
+        """
+        Close the underlying file (and delete it, if requested). Arrays that
+        were already memory-mapped remain usable.
+        """
+        self._finalizer()
+
+
 def convert_bytes(num):
     """
     this function will convert bytes to MB.... GB... etc
@@ -1153,7 +1337,7 @@ def check_is_lockdown(hostname, session):
         # it can raise exceptions, caught by self.attempt_login
         # FIXME: enable the user to set verify=True
         resp = session.get(
-            engine_version_url, timeout=10, verify=False,
+            engine_version_url, verify=False,
             allow_redirects=False)
         if resp.status_code == 403:
             return True